@@ -0,0 +1,147 @@
+"""
+Scalable Bloom filters for cheap membership pre-checks
+
+A ScalableBloomFilter grows by appending slices with doubling capacity and
+tightening error rates, so the overall false positive rate stays bounded
+no matter how many keys are added. Filters can be backed by a file, in
+which case each add writes only the bytes it changed.
+"""
+import math
+import os
+import struct
+from hashlib import blake2b
+
+FILE_MAGIC = b'RBLM'
+FILE_HEADER = struct.Struct('<4sH')
+SLICE_HEADER = struct.Struct('<QQHQ') # capacity, count, k, nbits
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float, salt: int = 0):
+        nbits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.nbits = max(64, (nbits + 7) // 8 * 8)
+        self.k = max(1, round(self.nbits / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self.salt = salt
+        self.bits = bytearray(self.nbits // 8)
+
+    def _positions(self, key: bytes):
+        digest = blake2b(key, digest_size=16, salt=self.salt.to_bytes(16, 'little')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.k)]
+
+    def add(self, key: bytes) -> set[int]:
+        """
+        Add a key and return the indexes of the bytes that changed.
+        """
+        changed = set()
+        for pos in self._positions(key):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                changed.add(byte)
+        self.count += 1
+        return changed
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class ScalableBloomFilter:
+    def __init__(
+            self,
+            initial_capacity: int = 1024,
+            error_rate: float = 0.01,
+            growth: int = 2,
+            tightening: float = 0.9,
+            path: str | None = None):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.path = path
+        self.slices = []
+        self._offsets = []
+
+    @staticmethod
+    def _key(key) -> bytes:
+        return key.encode('utf-8') if isinstance(key, str) else bytes(key)
+
+    def __contains__(self, key) -> bool:
+        key = self._key(key)
+        return any(key in s for s in self.slices)
+
+    def __len__(self) -> int:
+        return sum(s.count for s in self.slices)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(s.bits) for s in self.slices)
+
+    def add(self, key) -> bool:
+        """
+        Add a key, returning False if it was (possibly) already present.
+        """
+        key = self._key(key)
+        present = any(key in s for s in self.slices)
+        if not self.slices or self.slices[-1].count >= self.slices[-1].capacity:
+            self._add_slice()
+        changed = self.slices[-1].add(key)
+        if self.path is not None:
+            self._write_changes(len(self.slices) - 1, changed)
+        return not present
+
+    def _add_slice(self):
+        i = len(self.slices)
+        s = BloomFilter(
+            capacity=self.initial_capacity * self.growth ** i,
+            # slice error rates sum to at most error_rate
+            error_rate=self.error_rate * (1 - self.tightening) * self.tightening ** i,
+            salt=i
+        )
+        self.slices.append(s)
+        if self.path is not None:
+            if not os.path.exists(self.path):
+                with open(self.path, 'wb') as f:
+                    f.write(FILE_HEADER.pack(FILE_MAGIC, 1))
+            with open(self.path, 'ab') as f:
+                self._offsets.append(f.tell())
+                f.write(SLICE_HEADER.pack(s.capacity, s.count, s.k, s.nbits))
+                f.write(s.bits)
+
+    def _write_changes(self, index: int, changed: set[int]):
+        s = self.slices[index]
+        offset = self._offsets[index]
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, struct.pack('<Q', s.count), offset + 8)
+            for byte in changed:
+                os.pwrite(fd, s.bits[byte:byte + 1], offset + SLICE_HEADER.size + byte)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> 'ScalableBloomFilter':
+        """
+        Load a filter saved by a file-backed filter, and keep it attached.
+        """
+        f = cls(path=path, **kwargs)
+        with open(path, 'rb') as fin:
+            data = fin.read()
+        magic, _ = FILE_HEADER.unpack_from(data, 0)
+        if magic != FILE_MAGIC:
+            raise ValueError(f"{path} is not a bloom filter file")
+        offset = FILE_HEADER.size
+        while offset < len(data):
+            capacity, count, k, nbits = SLICE_HEADER.unpack_from(data, offset)
+            s = BloomFilter.__new__(BloomFilter)
+            s.capacity, s.count, s.k, s.nbits = capacity, count, k, nbits
+            s.salt = len(f.slices)
+            start = offset + SLICE_HEADER.size
+            s.bits = bytearray(data[start:start + nbits // 8])
+            f.slices.append(s)
+            f._offsets.append(offset)
+            offset = start + nbits // 8
+        return f
@@ -1,7 +1,17 @@
 """
 Bonding curve functions and price calculations
+
+Two engines compute the prices: `float` is the original float path,
+and `fixed` is an integer implementation that rounds exactly and gives the
+same result on every machine.
 """
+import importlib.util
 import math
+from collections import OrderedDict
+from fractions import Fraction
+from functools import lru_cache
+
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
 
 
 def polynomial(
@@ -88,3 +98,371 @@ def _round_decimal(orig: float, decimal_places: int = 2) -> float:
     factor = 10**decimal_places
     final = round(orig*factor) / factor
     return final
+
+
+def get_prices_fixed(
+        int_base_price: int,
+        total_supply: int,
+        initial_supply: int,
+        int_smoothing: int,
+        int_exponent: int,
+        int_decimals: int = 6,
+        round_decimals: int = 4,
+        fees: list[float] = []) -> int:
+    """
+    Fixed point version of `get_prices`.
+
+    Prices are computed in integer units of 10**-round_decimals, and every
+    rounding step rounds the exact value half to even, so the results only
+    differ from `get_prices` where float error pushes it across a half.
+    """
+    buy_price = polynomial_fixed(
+        int_base_price,
+        total_supply=total_supply,
+        initial_supply=initial_supply,
+        int_smoothing=int_smoothing,
+        int_exponent=int_exponent,
+        int_decimals=int_decimals,
+        round_decimals=round_decimals
+    )
+    if total_supply >= initial_supply:
+        rounded_fees = []
+        for fee in fees:
+            fee = _fee_fraction(fee)
+            rounded_fees.append(_div_round(buy_price * fee.numerator, fee.denominator))
+        buy_price = buy_price + sum(rounded_fees)
+    else:
+        rounded_fees = [0 for x in fees]
+
+    if total_supply <= initial_supply:
+        sell_price = 0
+    else:
+        sell_price = polynomial_fixed(
+            int_base_price,
+            total_supply=total_supply - 1,
+            initial_supply=initial_supply,
+            int_smoothing=int_smoothing,
+            int_exponent=int_exponent,
+            int_decimals=int_decimals,
+            round_decimals=round_decimals
+        )
+
+    def _to_decimals(value: int) -> int:
+        if int_decimals >= round_decimals:
+            return value * 10**(int_decimals - round_decimals)
+        return _div_round(value, 10**(round_decimals - int_decimals))
+
+    final_fees = [_to_decimals(x) for x in rounded_fees]
+
+    return _to_decimals(sell_price), _to_decimals(buy_price), final_fees
+
+
+def polynomial_fixed(
+        int_base_price: int,
+        total_supply: int,
+        initial_supply: int,
+        int_smoothing: int,
+        int_exponent: int,
+        int_decimals: int = 6,
+        round_decimals: int = 4) -> int:
+    """
+    Return the price of the piecewise polynomial in units of
+    10**-round_decimals, rounded half to even.
+    """
+    unit = 10**round_decimals
+    if total_supply < initial_supply:
+        # like `polynomial`, the base price is truncated to whole tokens
+        return int_base_price // 10**int_decimals * unit
+
+    # price * unit = base / 10**d * unit + x**(p/q) / smoothing * unit
+    # so with den = 10**d * smoothing:
+    # price * unit * den = base * unit * smoothing + x**(p/q) * unit * 10**d
+    x = total_supply - initial_supply
+    g = math.gcd(int_exponent, 1000)
+    p, q = int_exponent // g, 1000 // g
+    scale = unit * 10**int_decimals
+    den = 10**int_decimals * int_smoothing
+
+    # floor(2 * x**(p/q) * scale) and whether it is exact
+    twice_root, exact = _scaled_root(x, p, q, 2 * scale)
+
+    # round((a + r) / den) == floor((2a + den + 2r) / 2den)
+    num = 2 * int_base_price * unit * int_smoothing + den + twice_root
+    price, rem = divmod(num, 2 * den)
+    if exact and rem == 0 and price % 2 == 1:
+        price -= 1
+    return price
+
+
+PRICE_ENGINES = {
+    'float': get_prices,
+    'fixed': get_prices_fixed,
+}
+
+
+def get_prices_engine(engine: str):
+    """
+    Return the `get_prices` function of the given curve engine.
+    """
+    if engine not in PRICE_ENGINES:
+        raise Exception(f"Unknown bonding curve engine {engine}")
+    return PRICE_ENGINES[engine]
+
+
+def _div_round(num: int, den: int) -> int:
+    """
+    Integer division rounding half to even.
+    """
+    quotient, rem = divmod(num, den)
+    if 2 * rem > den or 2 * rem == den and quotient % 2 == 1:
+        quotient += 1
+    return quotient
+
+
+@lru_cache(maxsize=64)
+def _fee_fraction(fee) -> Fraction:
+    # fees are configured as decimal floats, so read them as written
+    return Fraction(str(fee))
+
+
+@lru_cache(maxsize=64)
+def _scale_power(scale: int, q: int) -> int:
+    return scale**q
+
+
+@lru_cache(maxsize=4096)
+def _scaled_root(x: int, p: int, q: int, scale: int) -> tuple[int, bool]:
+    """
+    Return floor(x**(p/q) * scale) and whether it is exact.
+    """
+    return _iroot(x**p * _scale_power(scale, q), q)
+
+
+def _iroot(n: int, k: int) -> tuple[int, bool]:
+    """
+    Return floor(n ** (1/k)) for a non negative integer, and whether it is
+    exact.
+    """
+    if k == 1 or n < 2:
+        return n, True
+    if k == 2:
+        y = math.isqrt(n)
+        return y, y * y == n
+    try:
+        y = int(math.exp(math.log(n) / k))
+    except OverflowError:
+        y = 1 << -(-n.bit_length() // k)
+    if y < 2**48:
+        # the float estimate is off by at most one or two
+        power = y**k
+        while power > n:
+            y -= 1
+            power = y**k
+        while True:
+            next_power = (y + 1)**k
+            if next_power > n:
+                return y, power == n
+            y += 1
+            power = next_power
+    # start just above the root, then Newton down
+    y = y + (y >> 32) + 2
+    while True:
+        z = ((k - 1) * y + n // y**(k - 1)) // k
+        if z >= y:
+            return y, y**k == n
+        y = z
+
+
+class QuoteCache:
+    """
+    Bounded LRU cache of `get_prices` results.
+
+    Quotes are keyed by engine, curve parameters, decimals, fees and supply.
+    The whole cache is dropped when the fees change, since no cached quote
+    can be hit again after that.
+    """
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.fees = None
+        self._quotes = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get_prices(
+            self,
+            int_base_price: int,
+            total_supply: int,
+            initial_supply: int,
+            int_smoothing: int,
+            int_exponent: int,
+            int_decimals: int = 6,
+            round_decimals: int = 4,
+            fees: list[float] = [],
+            engine: str = 'float') -> int:
+        """
+        Return `get_prices` for the given engine, computing it on a miss.
+        """
+        fees = tuple(fees)
+        if fees != self.fees:
+            if self._quotes:
+                self.stats['invalidations'] += 1
+            self._quotes.clear()
+            self.fees = fees
+
+        key = (engine, int_base_price, initial_supply, int_smoothing, int_exponent,
+               int_decimals, round_decimals, total_supply)
+        quote = self._quotes.get(key)
+        if quote is not None:
+            self._quotes.move_to_end(key)
+            self.stats['hits'] += 1
+        else:
+            self.stats['misses'] += 1
+            quote = get_prices_engine(engine)(
+                int_base_price,
+                total_supply=total_supply,
+                initial_supply=initial_supply,
+                int_smoothing=int_smoothing,
+                int_exponent=int_exponent,
+                int_decimals=int_decimals,
+                round_decimals=round_decimals,
+                fees=list(fees)
+            )
+            self._quotes[key] = quote
+            if len(self._quotes) > self.maxsize:
+                self._quotes.popitem(last=False)
+                self.stats['evictions'] += 1
+
+        sell, buy, final_fees = quote
+        return sell, buy, list(final_fees)
+
+    def clear(self):
+        self._quotes.clear()
+
+    def __len__(self) -> int:
+        return len(self._quotes)
+
+    def get_stats(self) -> dict:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return {
+            **self.stats,
+            'hit_rate': self.stats['hits'] / lookups if lookups else 0.0,
+            'entries': len(self._quotes),
+            'max_entries': self.maxsize,
+        }
+
+
+def get_prices_many(
+        int_base_price,
+        total_supply,
+        initial_supply,
+        int_smoothing,
+        int_exponent,
+        int_decimals: int = 6,
+        round_decimals: int = 4,
+        fees: list[float] = []):
+    """
+    Batched version of `get_prices`.
+
+    `total_supply` and the curve parameters can be integers or arrays that
+    broadcast together. Returns the sell prices, buy prices and a
+    (n, len(fees)) array of fees, matching `get_prices` element by element.
+
+    Requires numpy.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise Exception("get_prices_many requires the numpy package")
+
+    params = (int_base_price, total_supply, initial_supply, int_smoothing, int_exponent)
+    try:
+        params = np.broadcast_arrays(*(np.atleast_1d(np.asarray(x, dtype=np.int64)) for x in params))
+        scalar_params = params
+        out_of_range = np.zeros(params[0].shape, dtype=bool)
+    except OverflowError:
+        # UInt128 values past int64 are priced by the scalar path, numpy
+        # gets a harmless placeholder for them
+        scalar_params = np.broadcast_arrays(*(np.atleast_1d(np.asarray(x, dtype=object)) for x in params))
+        out_of_range = np.zeros(scalar_params[0].shape, dtype=bool)
+        for values in scalar_params:
+            out_of_range |= ((values < -2**63) | (values >= 2**63)).astype(bool)
+        params = [np.where(out_of_range, 1, values).astype(np.int64) for values in scalar_params]
+    int_base_price, total_supply, initial_supply, int_smoothing, int_exponent = params
+    if int_base_price.ndim != 1:
+        raise Exception("get_prices_many takes one dimensional arrays")
+
+    base_price = int_base_price / 10**int_decimals
+    smoothing = int_smoothing.astype(np.float64)
+    exponent = int_exponent.astype(np.float64) / 1000.0
+    factor = 10**round_decimals
+
+    def _polynomial(supply):
+        x = np.maximum(supply - initial_supply, 0).astype(np.float64)
+        p = base_price + np.power(x, exponent) / smoothing
+        return np.where(supply < initial_supply, np.trunc(base_price), p)
+
+    with np.errstate(all='ignore'):
+        buy_scaled = _polynomial(total_supply) * factor
+        sell_scaled = _polynomial(total_supply - 1) * factor
+
+        buy_price = np.rint(buy_scaled) / factor
+        above = total_supply >= initial_supply
+        rounded_fees = np.zeros((len(buy_price), len(fees)))
+        fees_total = np.zeros(len(buy_price))
+        for i, fee in enumerate(fees):
+            rounded_fees[:, i] = np.where(above, np.rint(fee * buy_price * factor) / factor, 0)
+            fees_total = fees_total + rounded_fees[:, i]
+        buy_price = np.where(above, buy_price + fees_total, buy_price)
+
+        sell_price = np.where(total_supply <= initial_supply, 0.0, np.rint(sell_scaled) / factor)
+
+        final_sell = np.rint(sell_price * 10**int_decimals)
+        final_buy = np.rint(buy_price * 10**int_decimals)
+        final_fees = np.rint(rounded_fees * 10**int_decimals)
+
+    # np.power may differ from math.pow in the last bits, which only matters
+    # when the value is about to be rounded half way. Those elements, and
+    # anything numpy can't represent, are recomputed with the scalar path.
+    def _near_tie(scaled):
+        distance = np.abs(np.abs(scaled - np.floor(scaled)) - 0.5)
+        return distance <= 1e-9 + np.abs(scaled) * 1e-12
+
+    limit = float(2**62)
+    recompute = (
+        out_of_range
+        | _near_tie(buy_scaled)
+        | (_near_tie(sell_scaled) & (total_supply > initial_supply))
+        | ~np.isfinite(buy_scaled) | ~np.isfinite(sell_scaled)
+        | (np.abs(final_buy) >= limit) | (np.abs(final_sell) >= limit)
+        | np.any(np.abs(final_fees) >= limit, axis=1)
+    )
+
+    with np.errstate(invalid='ignore'):
+        final_sell = final_sell.astype(np.int64)
+        final_buy = final_buy.astype(np.int64)
+        final_fees = final_fees.astype(np.int64)
+    if recompute.any():
+        dtype = np.int64
+        scalar = {}
+        scalar_base_price, scalar_supply, scalar_initial_supply, scalar_smoothing, scalar_exponent = scalar_params
+        for i in np.flatnonzero(recompute):
+            scalar[i] = get_prices(
+                int(scalar_base_price[i]),
+                total_supply=int(scalar_supply[i]),
+                initial_supply=int(scalar_initial_supply[i]),
+                int_smoothing=int(scalar_smoothing[i]),
+                int_exponent=int(scalar_exponent[i]),
+                int_decimals=int_decimals,
+                round_decimals=round_decimals,
+                fees=fees
+            )
+            if max([abs(scalar[i][0]), abs(scalar[i][1])] + [abs(f) for f in scalar[i][2]]) >= 2**63:
+                dtype = object
+        final_sell = final_sell.astype(dtype)
+        final_buy = final_buy.astype(dtype)
+        final_fees = final_fees.astype(dtype)
+        for i, (sell, buy, fee_values) in scalar.items():
+            final_sell[i] = sell
+            final_buy[i] = buy
+            final_fees[i, :] = fee_values
+
+    return final_sell, final_buy, final_fees
@@ -1,4 +1,5 @@
 import os
+import mmap
 from pydantic import BaseModel
 import logging
 from hashlib import sha256
@@ -6,6 +7,9 @@ from typing import Optional, List
 import tempfile
 import json
 import base64
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from cartesi.abi import String, Bytes, Bytes32, UInt, UInt128
 
@@ -15,13 +19,21 @@ from cartesapp.input import query, mutation
 from cartesapp.output import event, output, add_output, emit_event, contract_call
 from cartesapp.wallet import dapp_wallet
 
-from .riv import riv_get_cartridge_info, riv_get_cartridge_screenshot, riv_get_cartridges_path, riv_get_cover, riv_get_cartridge_outcard, replay_log
+from .riv import riv_get_cartridge_files, riv_get_cartridges_path, riv_get_emulator_version, replay_log
 from .settings import AppSettings
-from .bonding_curve import get_prices
+from .bonding_curve import get_prices_engine, get_prices_many, QuoteCache, HAS_NUMPY
 from .upload_price import get_upload_price
+from .common import make_thumbnail
+from .cid import get_cid
+from .search import SearchIndex
+from .pagination import check_page, decode_cursor, encode_cursor, fetch_page, page_cursor, DEFAULT_PAGE_SIZE
+from .chunk_store import chunk_hashes
+from .pipeline import run_stages, format_timings
 
 LOGGER = logging.getLogger(__name__)
 TOKEN_DECIMALS = int(1e3)
+IN_QUERY_BATCH = 500 # ids per IN (...) query, below sqlite's variable limit
+SEARCH_FIELD_WEIGHTS = {'name': 4.0, 'authors': 2.0, 'tags': 1.5, 'summary': 1.5, 'description': 1.0}
 
 ###
 # Model
@@ -34,17 +46,73 @@ class Cartridge(Entity):
     info            = helpers.Optional(helpers.Json, lazy=True)
     created_at      = helpers.Required(int)
     cover           = helpers.Optional(bytes, lazy=True)
+    cover_cid       = helpers.Optional(str)
     base_price      = helpers.Required(int)
     initial_supply  = helpers.Required(int)
     smoothing_factor= helpers.Required(int)
     exponent        = helpers.Required(int)
+    curve_engine    = helpers.Required(str, 16, default='float') # bonding curve engine: float or fixed
+    total_supply    = helpers.Required(int, default=0) # count of cartridge_owners
     cartridge_owners= helpers.Set('CartridgeUser')
+    owner_copies    = helpers.Set('CartridgeUserCopies')
+    thumbnails      = helpers.Set('CartridgeThumbnail')
+    tags            = helpers.Set('CartridgeTag')
+    image_chunks    = helpers.Optional(helpers.Json, lazy=True) # ImageChunk ids, when the image is in the chunk store
+    helpers.composite_index(created_at, id) # listing order
+
+
+CARTRIDGE_INTERNAL_ATTRS = ['image_chunks'] # kept out of the query outputs
+
+
+class CartridgeValidation(Entity):
+    id              = helpers.PrimaryKey(str, 64) # cartridge hash
+    version         = helpers.Required(str, 64) # emulator + test log digest
+    info            = helpers.Optional(helpers.Json, lazy=True)
+    cover           = helpers.Optional(bytes, lazy=True)
+    screenshot      = helpers.Optional(bytes, lazy=True)
+    last_used       = helpers.Required(int, default=0, index=True) # order of the last hit or run, for eviction
+
+
+class CartridgeTag(Entity):
+    id              = helpers.PrimaryKey(int, auto=True)
+    cartridge       = helpers.Required(Cartridge)
+    tag             = helpers.Required(str)
+    helpers.composite_key(tag, cartridge)
+
+
+class CoverThumbnail(Entity):
+    cid             = helpers.PrimaryKey(str, 64)
+    data            = helpers.Required(bytes, lazy=True)
+    cartridges      = helpers.Set('CartridgeThumbnail')
+
+
+class ImageChunk(Entity):
+    id              = helpers.PrimaryKey(str, 64) # sha256 of the data
+    data            = helpers.Required(bytes, lazy=True)
+    refs            = helpers.Required(int) # occurrences in cartridge images
+
+
+class CartridgeThumbnail(Entity):
+    id              = helpers.PrimaryKey(int, auto=True)
+    cartridge       = helpers.Required(Cartridge)
+    size            = helpers.Required(int)
+    thumbnail       = helpers.Required(CoverThumbnail)
+    helpers.composite_key(cartridge, size)
 
 
 class CartridgeUser(Entity):
     id              = helpers.PrimaryKey(int, auto=True)
     cartridge       = helpers.Required(Cartridge)
     user_address    = helpers.Required(str, 42)
+    helpers.composite_index(cartridge, user_address)
+
+
+class CartridgeUserCopies(Entity):
+    id              = helpers.PrimaryKey(int, auto=True)
+    cartridge       = helpers.Required(Cartridge)
+    user_address    = helpers.Required(str, 42)
+    copies          = helpers.Required(int) # count of the user's cartridge_owners
+    helpers.composite_key(cartridge, user_address)
 
 
 # Inputs
@@ -62,6 +130,11 @@ class RemoveCartridgePayload(BaseModel):
     id: Bytes32
 
 
+class SetCartridgeCurveEnginePayload(BaseModel):
+    id: Bytes32
+    curve_engine: String # float or fixed
+
+
 class BuyCartridgePayload(BaseModel):
     id: Bytes32
 
@@ -70,17 +143,43 @@ class SellCartridgePayload(BaseModel):
     id: Bytes32
 
 
+class TradeCartridgeCopiesPayload(BaseModel):
+    id: Bytes32
+    quantity: UInt128
+
+
 class CartridgePayload(BaseModel):
     id: String
     owner: Optional[str]
+    compact: Optional[bool] # leave the cover out, clients get it by cover_cid
+
+class CartridgeChunksPayload(BaseModel):
+    id:         String
+    offset:     Optional[int] # first byte wanted, default 0
+    length:     Optional[int] # bytes wanted, default up to the end of the image
+
+class CartridgeCoversPayload(BaseModel):
+    ids:        List[str]
+    size:       Optional[int] # width wanted, served by the smallest thumbnail that fits
 
 # TODO: TypeError: unhashable type: 'ABIType' allow python cartesi types
 class CartridgesPayload(BaseModel):
     name:       Optional[str]
+    search:     Optional[str] # words matched in names, summaries, descriptions, authors and tags, best first
     tags:       Optional[List[str]]
     page:       Optional[int]
     page_size:  Optional[int]
     owner:      Optional[str]
+    compact:    Optional[bool] # leave the covers out, clients get them by cover_cid
+    cover_size: Optional[int] # return the smallest cover thumbnail that fits this width
+    cursor:     Optional[str] # next_cursor of the previous page, empty for the first page
+    with_total: Optional[bool] # also count the total when paging by cursor
+
+class PriceLadderPayload(BaseModel):
+    id:         String
+    start:      Optional[int]
+    count:      Optional[int]
+    step:       Optional[int]
 
 
 # Outputs
@@ -118,26 +217,115 @@ class CartridgeInfo(BaseModel):
     info: Optional[Info]
     created_at: UInt
     cover: Optional[str] # encode to base64
+    cover_cid: Optional[str]
     base_price: UInt128
     initial_supply: UInt128
     smoothing_factor: UInt128
     exponent: UInt128
+    curve_engine: Optional[String]
     sell_price: UInt128
     buy_price: UInt128
     total_supply: UInt128
     owned_copies: Optional[UInt128]
 
+@output()
+class CartridgeChunksOutput(BaseModel):
+    id:             String
+    size:           UInt # of the whole image
+    offset:         UInt # first byte returned, the range is widened to whole chunks
+    length:         UInt # bytes returned
+    chunk_size:     UInt
+    chunk_hashes:   List[str] # sha256 of each returned chunk, in order
+
 @output()
 class CartridgesOutput(BaseModel):
     data:   List[CartridgeInfo]
-    total:  UInt
+    total:  Optional[UInt]
+    next_cursor: Optional[str]
     page:   UInt
 
+class CartridgeCover(BaseModel):
+    id:             String
+    cover_cid:      Optional[str]
+    cover:          Optional[str] # encode to base64
+    size:           Optional[int] # thumbnail size, None for the original cover
+    thumbnail_cid:  Optional[str]
+
+class TagCount(BaseModel):
+    tag:            str
+    count:          UInt
+
+@output()
+class CartridgeTagsOutput(BaseModel):
+    data:   List[TagCount]
+
+@output()
+class CartridgeCoversOutput(BaseModel):
+    data:   List[CartridgeCover]
+
+@output()
+class PriceLadderOutput(BaseModel):
+    cartridge_id:   String
+    total_supply:   UInt128
+    supplies:       List[UInt128]
+    sell_prices:    List[UInt128]
+    buy_prices:     List[UInt128]
+    fees:           List[List[UInt128]]
+
+@output()
+class SupplyCountersCheck(BaseModel):
+    mismatches:     UInt
+
+@output()
+class PriceQuoteCacheStats(BaseModel):
+    hits:           UInt
+    misses:         UInt
+    evictions:      UInt
+    invalidations:  UInt
+    hit_rate:       float
+    entries:        UInt
+    max_entries:    UInt
+
 
 ###
 # Seed data
 
 
+@seed()
+def rebuild_supply_counters():
+    check_supply_counters(rebuild=True)
+
+
+@seed()
+def backfill_covers():
+    for cartridge in Cartridge.select(lambda c: not c.cover_cid):
+        if cartridge.cover:
+            cartridge.cover_cid = get_cid(cartridge.cover)
+    backfill_cover_thumbnails()
+
+
+@seed()
+def backfill_cartridge_tags():
+    for cartridge in Cartridge.select(lambda c: c.tags.is_empty()):
+        add_cartridge_tags(cartridge)
+
+
+@seed()
+def chunk_cartridge_images():
+    if AppSettings.cartridge_store != 'chunks':
+        return
+    for cartridge in Cartridge.select():
+        path = f"{riv_get_cartridges_path()}/{cartridge.id}"
+        if not os.path.exists(path):
+            continue
+        if cartridge.image_chunks:
+            # left materialized by a previous run
+            os.remove(path)
+        else:
+            with open(path, 'rb') as f:
+                store_cartridge_image(cartridge, f.read())
+
+
 @seed()
 def initialize_data():
     try:
@@ -273,11 +461,7 @@ def insert_cartridge(payload: InsertCartridgePayload) -> bool:
     balance = _get_erc20_balance(dev_addr, AppSettings.token_addr)
     cartridge_size = len(payload.data)
 
-    upload_price = get_upload_price(
-        cartridge_bytes=cartridge_size,
-        initial_supply=payload.initial_supply
-    )
-    upload_price = int(upload_price * 10**AppSettings.token_decimals)
+    upload_price = get_upload_fee(cartridge_size, payload.initial_supply)
 
     if upload_price > balance:
         msg = (
@@ -338,12 +522,73 @@ def remove_cartridge(payload: RemoveCartridgePayload) -> bool:
     return True
 
 
+@mutation()
+def set_cartridge_curve_engine(payload: SetCartridgeCurveEnginePayload) -> bool:
+    """
+    Switch the bonding curve engine of a cartridge. New cartridges get the
+    node default, and their owner can pick another engine until a copy is
+    bought, so no trade is priced by two engines.
+    """
+    metadata = get_metadata()
+    cartridge_id = payload.id.hex()
+    cartridge = Cartridge.get(id=cartridge_id)
+
+    msg = None
+    if cartridge is None:
+        msg = f"Cartridge {cartridge_id} doesn't exist"
+    elif cartridge.user_address != metadata.msg_sender.lower():
+        msg = f"Sender not allowed"
+    elif cartridge.total_supply > 0:
+        msg = f"Cartridge {cartridge_id} already has copies, its curve engine can't change"
+    else:
+        try:
+            get_prices_engine(payload.curve_engine)
+        except Exception as e:
+            msg = str(e)
+    if msg is not None:
+        msg = f"Couldn't set curve engine: {msg}"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    cartridge.curve_engine = payload.curve_engine
+    LOGGER.info(f"Cartridge {cartridge_id} now uses the {payload.curve_engine} curve engine")
+    return True
+
+
 @mutation()
 def buy_cartridge(payload: BuyCartridgePayload) -> bool:
+    return _buy_cartridge_copies(payload.id.hex(), 1)
+
+
+@mutation()
+def sell_cartridge(payload: BuyCartridgePayload) -> bool:
+    return _sell_cartridge_copies(payload.id.hex(), 1)
+
+
+@mutation()
+def buy_cartridge_copies(payload: TradeCartridgeCopiesPayload) -> bool:
+    return _buy_cartridge_copies(payload.id.hex(), payload.quantity)
+
+
+@mutation()
+def sell_cartridge_copies(payload: TradeCartridgeCopiesPayload) -> bool:
+    return _sell_cartridge_copies(payload.id.hex(), payload.quantity)
+
+
+def _refuse_trade(msg: str) -> bool:
+    LOGGER.info(msg)
+    add_output(msg, tags=['error'])
+    return False
+
+
+def _buy_cartridge_copies(cartridge_id: str, quantity: int) -> bool:
     metadata = get_metadata()
     buyer = metadata.msg_sender
-    cartridge_id = payload.id.hex()
-    LOGGER.info('User %s wants to buy cartridge %s', buyer, cartridge_id)
+    LOGGER.info('User %s wants to buy %i copies of cartridge %s', buyer, quantity, cartridge_id)
+
+    if quantity < 1 or quantity > AppSettings.cartridge_trade_max_copies:
+        return _refuse_trade(f'Invalid quantity {quantity} for cartridge {cartridge_id}. Refusing tx')
 
     # Get cartridge
     cartridge = (
@@ -352,43 +597,40 @@ def buy_cartridge(payload: BuyCartridgePayload) -> bool:
     )
 
     if cartridge is None:
-        msg = f'Cartridge {cartridge_id} not found. Refusing tx'
-        LOGGER.info(msg)
-        add_output(msg, tags=['error'])
-        return False
+        return _refuse_trade(f'Cartridge {cartridge_id} not found. Refusing tx')
 
-    sell, buy, fees, supply = get_prices_supply_for_cartridge(
-        cartridge,
-    )
+    # Copy i is bought at supply + i, exactly as with quantity single buys
+    supply = cartridge.total_supply
+    supplies = list(range(supply, supply + quantity))
+    _, buy_prices, copy_fees = get_price_ladder(cartridge, supplies)
 
-    if buy == 0:
-        msg = f'Cartridge {cartridge_id} has zero buy price. Refusing tx'
-        LOGGER.info(msg)
-        add_output(msg, tags=['error'])
-        return False
+    if min(buy_prices) == 0:
+        return _refuse_trade(f'Cartridge {cartridge_id} has zero buy price. Refusing tx')
 
+    buy = sum(buy_prices)
     balance = _get_erc20_balance(buyer.lower(), AppSettings.token_addr)
 
     if balance < buy:
-        msg = (
+        return _refuse_trade(
             f'User ({buyer.lower()}) balance ({balance}) is lower than buy '
-            f'price ({buy}) for cartridge {cartridge.name} ({cartridge_id}). '
-            'Refusing tx.'
+            f'price ({buy}) for {quantity} copies of cartridge {cartridge.name} '
+            f'({cartridge_id}). Refusing tx.'
         )
-        LOGGER.info(msg)
-        add_output(msg, tags=['error'])
-        return False
 
     LOGGER.debug('User balance=%i buy=%i', balance, buy)
 
-    # Split fee between game developer and foundation
-    if supply < cartridge.initial_supply:
-        developer_amount = buy
-        treasury_amount = 0
-        protocol_amount = 0
-    else:
-        developer_amount, treasury_amount = fees
-        protocol_amount = buy - developer_amount - treasury_amount
+    # Split fee between game developer and foundation, adding up the copies
+    # so each receiver gets a single transfer
+    developer_amount = 0
+    treasury_amount = 0
+    protocol_amount = 0
+    for copy_supply, copy_buy, (copy_developer, copy_treasury) in zip(supplies, buy_prices, copy_fees):
+        if copy_supply < cartridge.initial_supply:
+            developer_amount += copy_buy
+        else:
+            developer_amount += copy_developer
+            treasury_amount += copy_treasury
+            protocol_amount += copy_buy - copy_developer - copy_treasury
 
     if developer_amount:
         dapp_wallet.transfer_erc20(
@@ -412,17 +654,20 @@ def buy_cartridge(payload: BuyCartridgePayload) -> bool:
             amount=protocol_amount,
         )
 
-    cartridge.cartridge_owners.create(user_address=buyer.lower())
+    for _ in range(quantity):
+        cartridge.cartridge_owners.create(user_address=buyer.lower())
+    _add_owner_copies(cartridge, buyer.lower(), quantity)
 
     return True
 
 
-@mutation()
-def sell_cartridge(payload: BuyCartridgePayload) -> bool:
+def _sell_cartridge_copies(cartridge_id: str, quantity: int) -> bool:
     metadata = get_metadata()
     seller = metadata.msg_sender
-    cartridge_id = payload.id.hex()
-    LOGGER.info('User %s wants to sell cartridge %s', seller, cartridge_id)
+    LOGGER.info('User %s wants to sell %i copies of cartridge %s', seller, quantity, cartridge_id)
+
+    if quantity < 1 or quantity > AppSettings.cartridge_trade_max_copies:
+        return _refuse_trade(f'Invalid quantity {quantity} for cartridge {cartridge_id}. Refusing tx')
 
     # Get cartridge
     cartridge = (
@@ -431,40 +676,43 @@ def sell_cartridge(payload: BuyCartridgePayload) -> bool:
     )
 
     if cartridge is None:
-        msg = f'Cartridge {cartridge_id} not found. Refusing tx'
-        LOGGER.info(msg)
-        add_output(msg, tags=['error'])
-        return False
+        return _refuse_trade(f'Cartridge {cartridge_id} not found. Refusing tx')
 
-    sell, buy, fees, supply = get_prices_supply_for_cartridge(cartridge)
+    owner_copies = CartridgeUserCopies.get(cartridge=cartridge, user_address=seller.lower())
 
-    LOGGER.debug(f'{sell=} {buy=} {supply=}')
-
-    if sell == 0:
-        msg = f'Cartridge {cartridge_id} has zero sell price. Refusing tx'
-        LOGGER.info(msg)
-        add_output(msg, tags=['error'])
-        return False
+    if owner_copies is None or owner_copies.copies < quantity:
+        return _refuse_trade(
+            f'User {seller} does not own {quantity} copies of {cartridge_id}. Refusing tx'
+        )
 
-    cartridge_user = cartridge.cartridge_owners.select(
-        lambda co: co.user_address == seller.lower()
-    ).first()
+    supply = cartridge.total_supply
 
-    if cartridge_user is None:
-        msg = (
-            f'User {seller} does not own a copy of {cartridge_id}. Refusing tx'
+    if supply < quantity:
+        return _refuse_trade(
+            f'Cartridge {cartridge_id} supply ({supply}) is lower than {quantity} copies. Refusing tx'
         )
-        LOGGER.info(msg)
-        add_output(msg, tags=['error'])
-        return False
+
+    # Copy i is sold at supply - i, exactly as with quantity single sells
+    supplies = list(range(supply, supply - quantity, -1))
+    sell_prices, _, _ = get_price_ladder(cartridge, supplies)
+
+    LOGGER.debug(f'{sell_prices=} {supply=}')
+
+    if min(sell_prices) == 0:
+        return _refuse_trade(f'Cartridge {cartridge_id} has zero sell price. Refusing tx')
 
     dapp_wallet.transfer_erc20(
         token=AppSettings.token_addr,
         sender=AppSettings.protocol_addr,
         receiver=seller,
-        amount=sell)
+        amount=sum(sell_prices))
 
-    cartridge_user.delete()
+    cartridge_users = cartridge.cartridge_owners.select(
+        lambda co: co.user_address == seller.lower()
+    )[:quantity]
+    for cartridge_user in cartridge_users:
+        cartridge_user.delete()
+    _add_owner_copies(cartridge, seller.lower(), -quantity)
 
     return True
 
@@ -478,8 +726,8 @@ def cartridge(payload: CartridgePayload) -> bool:
 
     cartridge_data = b''
     if query.count() > 0:
-        cartridge_file = open(f"{riv_get_cartridges_path()}/{payload.id}",'rb')
-        cartridge_data = cartridge_file.read()
+        with cartridge_image(payload.id) as path, open(path,'rb') as cartridge_file:
+            cartridge_data = cartridge_file.read()
 
     add_output(cartridge_data)
 
@@ -487,25 +735,61 @@ def cartridge(payload: CartridgePayload) -> bool:
 
     return True
 
+@query(splittable_output=True)
+def cartridge_chunks(payload: CartridgeChunksPayload) -> bool:
+    if helpers.count(c for c in Cartridge if c.id == payload.id) == 0:
+        msg = f"Cartridge {payload.id} doesn't exist"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    chunk_size = AppSettings.cartridge_chunk_size
+    with cartridge_image(payload.id) as path:
+        size = os.path.getsize(path)
+        try:
+            start, end = get_chunk_range(size, payload.offset, payload.length, chunk_size)
+        except Exception as e:
+            LOGGER.error(e)
+            add_output(str(e),tags=['error'])
+            return False
+
+        # the chunks are read twice from the mapped file, once for the hashes
+        # and once for the data, instead of buffering the range
+        chunk_hashes = [sha256(chunk).hexdigest() for chunk in iter_file_chunks(path, start, end, chunk_size)]
+        out = CartridgeChunksOutput(
+            id=payload.id,
+            size=size,
+            offset=start,
+            length=end - start,
+            chunk_size=chunk_size,
+            chunk_hashes=chunk_hashes
+        )
+        add_output(out)
+        for chunk in iter_file_chunks(path, start, end, chunk_size):
+            add_output(chunk)
+
+    LOGGER.info(f"Returning {len(chunk_hashes)} chunks of cartridge {payload.id} from byte {start} to {end}")
+
+    return True
+
 @query()
 def cartridge_info(payload: CartridgePayload) -> bool:
     cartridge = helpers.select(c for c in Cartridge if c.id == payload.id).first()
 
     if cartridge is not None:
-        cartridge_dict = cartridge.to_dict(with_lazy=True)
-        cartridge_dict['cover'] = base64.b64encode(cartridge_dict['cover'])
+        cartridge_dict = _cartridge_to_dict(cartridge, payload.compact)
 
-        sell, buy, fees, total_supply = get_prices_supply_for_cartridge(cartridge)
+        supplies, owned_copies = get_owner_counts([cartridge.id], payload.owner)
+        sell, buy, fees, total_supply = get_prices_supply_for_cartridge(
+            cartridge,
+            total_supply=supplies[cartridge.id]
+        )
         cartridge_dict['sell_price'] = sell
         cartridge_dict['buy_price'] = buy
         cartridge_dict['total_supply'] = total_supply
 
         if payload.owner:
-            cartridge_dict['owned_copies'] = (
-                cartridge.cartridge_owners
-                .select(lambda co: co.user_address == payload.owner.lower())
-                .count()
-            )
+            cartridge_dict['owned_copies'] = owned_copies[cartridge.id]
 
         out = CartridgeInfo.parse_obj(cartridge_dict)
         add_output(out)
@@ -524,49 +808,234 @@ def cartridges(payload: CartridgesPayload) -> bool:
         cartridges_query = cartridges_query.filter(lambda c: payload.name in c.name)
 
     if payload.tags is not None and len(payload.tags) > 0:
-        for tag in payload.tags:
-            cartridges_query = cartridges_query.filter(lambda c: tag in c.info['tags'])
+        # every tag is an indexed lookup in CartridgeTag, and sqlite
+        # intersects them instead of decoding the info of every cartridge
+        for tag in set(payload.tags):
+            cartridges_query = cartridges_query.filter(
+                lambda c: c.id in helpers.select(t.cartridge.id for t in CartridgeTag if t.tag == tag)
+            )
     
-    total = cartridges_query.count()
+    # load the lazy info and cover with the page instead of one by one
+    cover_size = None if payload.compact else get_thumbnail_size(payload.cover_size)
+    if payload.compact or cover_size is not None:
+        prefetch_attrs = [Cartridge.info]
+    else:
+        prefetch_attrs = [Cartridge.info, Cartridge.cover]
+
+    try:
+        check_page(payload.page, payload.page_size)
+        cursor_values = None
+        if payload.cursor and payload.search:
+            # the ranking is in memory, so its cursor is just an offset
+            cursor_values = decode_cursor(payload.cursor, int)
+            if cursor_values[0] < 0:
+                raise Exception("Invalid cursor")
+        elif payload.cursor:
+            cursor_values = decode_cursor(payload.cursor, int, str)
+    except Exception as e:
+        msg = f"Couldn't list cartridges: {e}"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
 
     page = 1
-    if payload.page is not None:
-        page = payload.page
-        if payload.page_size is not None:
-            cartridges = cartridges_query.page(payload.page,payload.page_size)
+    next_cursor = None
+    if payload.search:
+        # ranked by the search index, narrowed down by the other filters
+        within = None
+        if payload.name is not None or payload.tags:
+            within = set(helpers.select(c.id for c in cartridges_query))
+        offset, limit = 0, None
+        count = True
+        if payload.cursor is not None:
+            if cursor_values is not None:
+                offset, = cursor_values
+            limit = payload.page_size if payload.page_size is not None else DEFAULT_PAGE_SIZE
+            # counting goes through every match, skip it like the other listings
+            count = bool(payload.with_total)
+        elif payload.page is not None:
+            page = payload.page
+            limit = payload.page_size if payload.page_size is not None else DEFAULT_PAGE_SIZE
+            offset = (page - 1) * limit
+        if count:
+            total, cartridge_ids = get_search_index().search(payload.search, offset, limit, within)
+            has_more = limit is not None and offset + len(cartridge_ids) < total
         else:
-            cartridges = cartridges_query.page(payload.page)
+            # one more than the page tells whether there is a next one
+            total, cartridge_ids = get_search_index().search(payload.search, offset, limit + 1, within, count=False)
+            has_more = len(cartridge_ids) > limit
+            cartridge_ids = cartridge_ids[:limit]
+        if has_more:
+            next_cursor = encode_cursor(offset + len(cartridge_ids))
+        cartridges = get_cartridges_by_ids(cartridge_ids, prefetch_attrs)
     else:
-        cartridges = cartridges_query.fetch()
-    
+        total = None
+        if payload.cursor is None or payload.with_total:
+            total = cartridges_query.count()
+        cartridges_query = cartridges_query. \
+            order_by(Cartridge.created_at, Cartridge.id). \
+            prefetch(*prefetch_attrs)
+        if payload.cursor is not None:
+            if cursor_values is not None:
+                last_created_at, last_id = cursor_values
+                cartridges_query = cartridges_query.filter(
+                    lambda c: c.created_at >= last_created_at and (c.created_at > last_created_at or c.id > last_id)
+                )
+            cartridges, next_cursor = fetch_page(cartridges_query, payload.page_size, lambda c: (c.created_at, c.id))
+        elif payload.page is not None:
+            page = payload.page
+            if payload.page_size is not None:
+                cartridges = cartridges_query.page(payload.page,payload.page_size)
+            else:
+                cartridges = cartridges_query.page(payload.page)
+            next_cursor = page_cursor(cartridges, page, payload.page_size, total, lambda c: (c.created_at, c.id))
+        else:
+            cartridges = cartridges_query.fetch()
+
+    supplies, owned_copies = get_owner_counts(
+        [cartridge.id for cartridge in cartridges],
+        payload.owner
+    )
+    if cover_size is not None:
+        thumbnails = get_cover_thumbnails([cartridge.id for cartridge in cartridges], cover_size)
 
     dict_list_result = []
     for cartridge in cartridges:
-        cartridge_dict = cartridge.to_dict(with_lazy=True)
-        cartridge_dict['cover'] = base64.b64encode(cartridge_dict['cover'])
-
-        sell, buy, fees, total_supply = get_prices_supply_for_cartridge(cartridge)
+        cartridge_dict = _cartridge_to_dict(cartridge, payload.compact or cover_size is not None)
+        if cover_size is not None:
+            thumbnail = thumbnails[cartridge.id][1]
+            cartridge_dict['cover'] = base64.b64encode(thumbnail) if thumbnail else None
+
+        sell, buy, fees, total_supply = get_prices_supply_for_cartridge(
+            cartridge,
+            total_supply=supplies[cartridge.id]
+        )
         cartridge_dict['sell_price'] = sell
         cartridge_dict['buy_price'] = buy
         cartridge_dict['total_supply'] = total_supply
         if payload.owner:
-            cartridge_dict['owned_copies'] = (
-                cartridge.cartridge_owners
-                .select(lambda co: co.user_address == payload.owner.lower())
-                .count()
-            )
+            cartridge_dict['owned_copies'] = owned_copies[cartridge.id]
 
         dict_list_result.append(cartridge_dict)
 
     LOGGER.info(f"Returning {len(dict_list_result)} of {total} cartridges")
     
-    out = CartridgesOutput.parse_obj({'data':dict_list_result,'total':total,'page':page})
+    out = CartridgesOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
     
     add_output(out)
 
     return True
 
 
+@query()
+def cartridge_price_ladder(payload: PriceLadderPayload) -> bool:
+    cartridge = helpers.select(c for c in Cartridge if c.id == payload.id).first()
+
+    if cartridge is None:
+        add_output("null")
+        LOGGER.info(f"Cartridge {payload.id} not found")
+        return True
+
+    total_supply = cartridge.total_supply
+    start = payload.start if payload.start is not None else 0
+    count = payload.count if payload.count is not None else AppSettings.price_ladder_default_points
+    step = payload.step if payload.step is not None else 1
+    if start < 0 or count < 0 or step < 1:
+        msg = f"Invalid price ladder range {start=} {count=} {step=}"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+    count = min(count, AppSettings.price_ladder_max_points)
+    supplies = list(range(start, start + count * step, step))
+
+    sell, buy, fees = get_price_ladder(cartridge, supplies)
+
+    out = PriceLadderOutput.parse_obj({
+        'cartridge_id': cartridge.id,
+        'total_supply': total_supply,
+        'supplies': supplies,
+        'sell_prices': sell,
+        'buy_prices': buy,
+        'fees': fees
+    })
+    add_output(out)
+
+    LOGGER.info(f"Returning price ladder of cartridge {payload.id} with {len(supplies)} points")
+
+    return True
+
+
+@query()
+def cartridge_tags() -> bool:
+    tag_counts = helpers.select(
+        (t.tag, helpers.count()) for t in CartridgeTag
+    ).order_by(lambda tag, count: (helpers.desc(count), tag))
+
+    data = [{'tag': tag, 'count': count} for tag, count in tag_counts]
+
+    out = CartridgeTagsOutput.parse_obj({'data':data})
+    add_output(out)
+
+    LOGGER.info(f"Returning {len(data)} cartridge tags")
+
+    return True
+
+@query()
+def cartridge_covers(payload: CartridgeCoversPayload) -> bool:
+    if len(payload.ids) > AppSettings.cover_batch_max:
+        msg = f"Too many covers requested ({len(payload.ids)} > {AppSettings.cover_batch_max})"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    ids = payload.ids
+    size = get_thumbnail_size(payload.size)
+    if size is None:
+        covers = helpers.select(
+            (c.id, c.cover_cid, c.cover) for c in Cartridge if c.id in ids
+        )
+    else:
+        thumbnails = get_cover_thumbnails(ids, size)
+        covers = [
+            (cartridge_id, cover_cid, thumbnails[cartridge_id][1])
+            for cartridge_id, cover_cid in helpers.select(
+                (c.id, c.cover_cid) for c in Cartridge if c.id in ids
+            )
+        ]
+
+    data = []
+    for cartridge_id, cover_cid, cover in covers:
+        thumbnail_cid = thumbnails[cartridge_id][0] if size is not None else None
+        data.append({
+            'id': cartridge_id,
+            'cover_cid': cover_cid,
+            'cover': base64.b64encode(cover) if cover else None,
+            'size': size if thumbnail_cid else None,
+            'thumbnail_cid': thumbnail_cid
+        })
+
+    out = CartridgeCoversOutput.parse_obj({'data':data})
+    add_output(out)
+
+    LOGGER.info(f"Returning {len(data)} of {len(ids)} cartridge covers")
+
+    return True
+
+@query()
+def supply_counters_check() -> bool:
+    out = SupplyCountersCheck(mismatches=check_supply_counters())
+    add_output(out)
+
+    return True
+
+@query()
+def price_quote_cache_stats() -> bool:
+    out = PriceQuoteCacheStats.parse_obj(get_quote_cache().get_stats())
+    add_output(out)
+
+    return True
+
+
 ###
 # Helpers
 
@@ -590,23 +1059,31 @@ def create_cartridge(cartridge_payload, **metadata):
     cartridge_file.write(cartridge_data)
     cartridge_file.close()
 
-    cartridge_info = riv_get_cartridge_info(data_hash)
+    add_cartridge(data_hash, cartridge_payload, cartridge_data, **metadata)
 
-    # validate info
-    cartridge_info_json = json.loads(cartridge_info)
-    Info(**cartridge_info_json)
+    return data_hash
 
-    # check if cartridge runs
-    test_replay_file = open('misc/test.rivlog', 'rb')
-    test_replay = test_replay_file.read()
-    test_replay_file.close()
-    # TODO: allow one of theses tests
-    outcard_raw, outhash, screenshot = replay_log(data_hash,test_replay,'',b'')
 
-    LOGGER.info("So far so good")
-    cartridge_cover = riv_get_cover(data_hash)
-    if cartridge_cover is None or len(cartridge_cover) == 0:
-        cartridge_cover = screenshot
+def add_cartridge(data_hash: str, curve, cartridge_data: bytes | None = None, **metadata):
+    """
+    Validate the image file written for `data_hash` and add its cartridge,
+    with the bonding curve parameters of `curve`. The image is read from
+    the file if `cartridge_data` isn't given, and the file is removed if
+    the cartridge is invalid.
+    """
+    cartridge_path = f"{riv_get_cartridges_path()}/{data_hash}"
+    try:
+        stages = {}
+        if AppSettings.cartridge_store == 'chunks':
+            if cartridge_data is None:
+                with open(cartridge_path, 'rb') as f:
+                    cartridge_data = f.read()
+            stages['chunks'] = lambda cancel: chunk_hashes(cartridge_data)
+        cartridge_info_json, cartridge_cover, results = validate_cartridge(data_hash, stages)
+    except Exception:
+        if os.path.exists(cartridge_path):
+            os.remove(cartridge_path)
+        raise
 
     user_address = metadata.get('msg_sender')
     if user_address is not None: user_address = user_address.lower()
@@ -617,15 +1094,104 @@ def create_cartridge(cartridge_payload, **metadata):
         created_at=metadata.get('timestamp') or 0,
         info=cartridge_info_json,
         cover=cartridge_cover,
-        base_price=cartridge_payload.base_price,
-        initial_supply=cartridge_payload.initial_supply,
-        smoothing_factor=cartridge_payload.smoothing_factor,
-        exponent=cartridge_payload.exponent
+        cover_cid=get_cid(cartridge_cover) if cartridge_cover else '',
+        base_price=curve.base_price,
+        initial_supply=curve.initial_supply,
+        smoothing_factor=curve.smoothing_factor,
+        exponent=curve.exponent,
+        curve_engine=AppSettings.bonding_curve_engine
     )
 
+    add_cover_thumbnails(c)
+    add_cartridge_tags(c)
+    add_search_document(c)
+    if 'chunks' in results:
+        store_cartridge_image(c, cartridge_data, results['chunks'])
+
     LOGGER.info(c)
 
-    return data_hash
+
+def validate_cartridge(cartridge_id, stages=None):
+    """
+    Check the cartridge info and that it runs, returning its info, cover
+    and the results of the extra `stages`.
+
+    Reading the info and the test replay run concurrently with the extra
+    stages, and the first failure cancels the others. Results are cached by
+    cartridge hash, and the cache is invalidated when the emulator or the
+    test log change.
+    """
+    stages = dict(stages or {})
+    with open(AppSettings.test_replay_path, 'rb') as test_replay_file:
+        test_replay = test_replay_file.read()
+    version = sha256(
+        bytes.fromhex(riv_get_emulator_version()) + sha256(test_replay).digest()
+    ).hexdigest()
+
+    validation = CartridgeValidation.get(id=cartridge_id)
+    cached = validation is not None and validation.version == version
+    if cached:
+        LOGGER.info(f"Using cached validation for cartridge {cartridge_id}")
+        Info(**validation.info)
+        _touch_validation(validation)
+    else:
+        stages['info'] = lambda cancel: _read_cartridge_info(cartridge_id)
+        # check if cartridge runs
+        # TODO: allow one of theses tests
+        stages['replay'] = lambda cancel: replay_log(cartridge_id,test_replay,'',b'',cancel)
+
+    start = time.perf_counter()
+    results, timings = run_stages(stages)
+    timings['total'] = time.perf_counter() - start
+    LOGGER.info(f"Validation stages of cartridge {cartridge_id}: {format_timings(timings)}")
+    if cached:
+        return validation.info, validation.cover or validation.screenshot, results
+
+    LOGGER.info("So far so good")
+    cartridge_info_json, cartridge_cover = results.pop('info')
+    outcard_raw, outhash, screenshot = results.pop('replay')
+
+    if validation is None:
+        validation = CartridgeValidation(id=cartridge_id, version=version)
+    validation.version = version
+    validation.info = cartridge_info_json
+    validation.cover = cartridge_cover
+    validation.screenshot = screenshot
+    _touch_validation(validation)
+
+    if cartridge_cover is None or len(cartridge_cover) == 0:
+        cartridge_cover = screenshot
+
+    return cartridge_info_json, cartridge_cover, results
+
+
+def _touch_validation(validation: CartridgeValidation):
+    """
+    Mark the validation as the most recently used and evict the least
+    recently used ones past AppSettings.cartridge_validation_max.
+
+    Validations outlive their cartridges, so inserting a removed cartridge
+    again is a cache hit.
+    """
+    validation.last_used = (helpers.max(v.last_used for v in CartridgeValidation) or 0) + 1
+    excess = CartridgeValidation.select().count() - AppSettings.cartridge_validation_max
+    if excess > 0:
+        oldest = CartridgeValidation.select().order_by(CartridgeValidation.last_used)[:excess]
+        for old in oldest:
+            old.delete()
+
+
+def _read_cartridge_info(cartridge_id):
+    # read info and cover in a single pass over the image
+    cartridge_files = riv_get_cartridge_files(cartridge_id,["/info.json","/cover.png"])
+    cartridge_info = cartridge_files["/info.json"]
+    if cartridge_info is None:
+        raise Exception("Error getting info: /info.json not found")
+
+    # validate info
+    cartridge_info_json = json.loads(cartridge_info)
+    Info(**cartridge_info_json)
+    return cartridge_info_json, cartridge_files["/cover.png"]
 
 
 def delete_cartridge(cartridge_id,**metadata):
@@ -636,16 +1202,282 @@ def delete_cartridge(cartridge_id,**metadata):
     if cartridge.user_address != metadata['msg_sender'].lower():
         raise Exception(f"Sender not allowed")
 
+    thumbnails = [t.thumbnail for t in cartridge.thumbnails]
+    image_chunks = cartridge.image_chunks
     cartridge.delete()
-    os.remove(f"{riv_get_cartridges_path()}/{cartridge_id}")
+    for thumbnail in set(thumbnails):
+        if thumbnail.cartridges.is_empty():
+            thumbnail.delete()
+    if image_chunks:
+        release_image_chunks(image_chunks)
+    get_search_index().remove(cartridge_id)
+    _materialized.pop(cartridge_id, None)
+    path = f"{riv_get_cartridges_path()}/{cartridge_id}"
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def get_chunk_range(size: int, offset: int | None, length: int | None, chunk_size: int) -> tuple[int, int]:
+    """
+    Return the byte range to serve for a requested range of a file, widened
+    to whole chunks so chunk hashes don't depend on the request.
+    """
+    offset = offset or 0
+    if offset < 0 or offset > size:
+        raise Exception(f"Offset {offset} out of range for {size} bytes")
+    if length is None:
+        length = size - offset
+    if length < 0:
+        raise Exception(f"Invalid length {length}")
+    start = offset - offset % chunk_size
+    end = min(size, -(-(offset + length) // chunk_size) * chunk_size)
+    return start, end
+
+
+def iter_file_chunks(path: str, start: int, end: int, chunk_size: int):
+    """
+    Yield the chunks of a byte range of a file, read from a memory map so
+    only one chunk is held at a time.
+    """
+    if end <= start:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for pos in range(start, end, chunk_size):
+            yield mm[pos:min(pos + chunk_size, end)]
+
+
+def store_cartridge_image(cartridge: Cartridge, data: bytes, chunks: list | None = None):
+    """
+    Move a cartridge image into the chunk store, sharing the chunks it has
+    in common with the stored images. The image file is removed, and
+    materialized again when the emulator needs it. `chunks` are the
+    `chunk_hashes` of data, if already computed.
+    """
+    if chunks is None:
+        chunks = chunk_hashes(data)
+    chunk_ids = []
+    new_bytes = 0
+    for chunk_id, chunk in chunks:
+        image_chunk = ImageChunk.get(id=chunk_id)
+        if image_chunk is None:
+            image_chunk = ImageChunk(id=chunk_id, data=bytes(chunk), refs=0)
+            new_bytes += len(chunk)
+        image_chunk.refs += 1
+        chunk_ids.append(chunk_id)
+    cartridge.image_chunks = chunk_ids
+    _materialized.pop(cartridge.id, None)
+    path = f"{riv_get_cartridges_path()}/{cartridge.id}"
+    if os.path.exists(path):
+        os.remove(path)
+    LOGGER.info(f"Stored cartridge {cartridge.id} in {len(chunk_ids)} chunks, {new_bytes} of {len(data)} bytes new")
+
+
+def release_image_chunks(chunk_ids: list[str]):
+    """
+    Drop the references of a deleted image to its chunks, deleting the
+    chunks no other image uses.
+    """
+    counts = {}
+    for chunk_id in chunk_ids:
+        counts[chunk_id] = counts.get(chunk_id, 0) + 1
+    for chunk_id, count in counts.items():
+        image_chunk = ImageChunk.get(id=chunk_id)
+        if image_chunk is None:
+            continue
+        image_chunk.refs -= count
+        if image_chunk.refs <= 0:
+            image_chunk.delete()
+
+
+_materialized = OrderedDict() # ids of the images reassembled from chunks, least recently used first
+_materialized_pins = {} # id -> number of users of a materialized image
+
+def _select_chunk_data(chunk_ids: list[str]) -> dict[str, bytes]:
+    """
+    Get the data of the given image chunks. This is raw sql because the
+    db_session keeps query results until it ends, while these are dropped
+    once written.
+    """
+    params = {f'id{i}': chunk_id for i, chunk_id in enumerate(chunk_ids)}
+    placeholders = ', '.join(f'${name}' for name in params)
+    rows = ImageChunk._database_.select(
+        f'id, data FROM "{ImageChunk._table_}" WHERE id IN ({placeholders})', params
+    )
+    return dict(rows)
+
+
+def materialize_cartridge(cartridge_id: str) -> str:
+    """
+    Make sure the image file of a cartridge exists for the emulator, and
+    return its path. Images in the chunk store are reassembled, and only
+    the AppSettings.cartridge_materialized_max most recently used are kept,
+    along with the images in use by `cartridge_image`.
+    """
+    path = f"{riv_get_cartridges_path()}/{cartridge_id}"
+    if cartridge_id in _materialized:
+        _materialized.move_to_end(cartridge_id)
+    if os.path.exists(path):
+        return path
+
+    cartridge = Cartridge.get(id=cartridge_id)
+    if cartridge is None or not cartridge.image_chunks:
+        raise Exception(f"Cartridge {cartridge_id} image not found")
+    chunk_ids = cartridge.image_chunks
+
+    # chunks are written in order a batch at a time, so the image is never
+    # held whole in memory
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with open(f"{path}.tmp", 'wb') as f:
+            for i in range(0, len(chunk_ids), IN_QUERY_BATCH):
+                ids = chunk_ids[i:i + IN_QUERY_BATCH]
+                unique_ids = list(set(ids))
+                chunks = _select_chunk_data(unique_ids)
+                missing = [chunk_id for chunk_id in unique_ids if chunk_id not in chunks]
+                if missing:
+                    raise Exception(f"Cartridge {cartridge_id} is missing chunk {missing[0]}")
+                for chunk_id in ids:
+                    f.write(chunks[chunk_id])
+    except:
+        os.remove(f"{path}.tmp")
+        raise
+    os.replace(f"{path}.tmp", path)
+
+    _materialized[cartridge_id] = True
+    evict_materialized_cartridges(keep=cartridge_id)
+    return path
+
+
+@contextmanager
+def cartridge_image(cartridge_id: str):
+    """
+    Materialize the image of a cartridge and yield its path. The image
+    isn't evicted until the block exits.
+    """
+    _materialized_pins[cartridge_id] = _materialized_pins.get(cartridge_id, 0) + 1
+    try:
+        yield materialize_cartridge(cartridge_id)
+    finally:
+        _materialized_pins[cartridge_id] -= 1
+        if not _materialized_pins[cartridge_id]:
+            del _materialized_pins[cartridge_id]
+        evict_materialized_cartridges()
+
+
+def evict_materialized_cartridges(keep: str | None = None):
+    """
+    Remove the least recently used materialized images that are not in
+    use, down to AppSettings.cartridge_materialized_max. The `keep` image
+    is about to be used and is never removed.
+    """
+    excess = len(_materialized) - AppSettings.cartridge_materialized_max
+    if excess <= 0:
+        return
+    evicted_ids = [
+        cartridge_id for cartridge_id in _materialized
+        if cartridge_id not in _materialized_pins and cartridge_id != keep
+    ][:excess]
+    for evicted_id in evicted_ids:
+        del _materialized[evicted_id]
+        evicted_path = f"{riv_get_cartridges_path()}/{evicted_id}"
+        if os.path.exists(evicted_path):
+            os.remove(evicted_path)
+
+
+def add_cartridge_tags(cartridge: Cartridge):
+    """
+    Index the tags in the cartridge info.
+    """
+    info = cartridge.info or {}
+    for tag in set(info.get('tags') or []):
+        CartridgeTag(cartridge=cartridge, tag=tag)
+
+
+def add_cover_thumbnails(cartridge: Cartridge):
+    """
+    Store the cover thumbnails of a cartridge, content addressed by CID so
+    identical thumbnails are kept once.
+    """
+    if not cartridge.cover:
+        return
+    existing = {t.size for t in cartridge.thumbnails}
+    for size in AppSettings.cover_thumbnail_sizes:
+        if size in existing:
+            continue
+        data = make_thumbnail(cartridge.cover, size)
+        cid = get_cid(data)
+        thumbnail = CoverThumbnail.get(cid=cid)
+        if thumbnail is None:
+            thumbnail = CoverThumbnail(cid=cid, data=data)
+        CartridgeThumbnail(cartridge=cartridge, size=size, thumbnail=thumbnail)
+
+
+def backfill_cover_thumbnails() -> int:
+    """
+    Add missing thumbnails to existing cartridges, returning how many
+    cartridges were updated.
+    """
+    sizes = len(AppSettings.cover_thumbnail_sizes)
+    updated = 0
+    for cartridge in Cartridge.select(lambda c: helpers.count(c.thumbnails) < sizes):
+        add_cover_thumbnails(cartridge)
+        updated += 1
+    if updated:
+        LOGGER.info(f"Added cover thumbnails to {updated} cartridges")
+    return updated
+
 
+def get_thumbnail_size(width: int | None) -> int | None:
+    """
+    Return the smallest thumbnail size that fits width, or None if only the
+    original cover does.
+    """
+    if width is None:
+        return None
+    for size in sorted(AppSettings.cover_thumbnail_sizes):
+        if size >= width:
+            return size
+    return None
+
+
+def get_cover_thumbnails(cartridge_ids: list[str], size: int) -> dict:
+    """
+    Get the (cid, data) of the thumbnail of each cartridge in one query.
 
-def get_prices_supply_for_cartridge(cartridge: Cartridge):
+    Cartridges without a stored thumbnail get one made on the fly, and
+    cartridges without a cover get (None, None).
+    """
+    thumbnails = {}
+    for i in range(0, len(cartridge_ids), IN_QUERY_BATCH):
+        ids = cartridge_ids[i:i + IN_QUERY_BATCH]
+        thumbnails.update(
+            (cartridge_id, (cid, data))
+            for cartridge_id, cid, data in helpers.select(
+                (t.cartridge.id, t.thumbnail.cid, t.thumbnail.data)
+                for t in CartridgeThumbnail if t.cartridge.id in ids and t.size == size
+            )
+        )
+    for cartridge_id in cartridge_ids:
+        if cartridge_id in thumbnails:
+            continue
+        cartridge = Cartridge.get(id=cartridge_id)
+        if cartridge is None or not cartridge.cover:
+            thumbnails[cartridge_id] = (None, None)
+            continue
+        data = make_thumbnail(cartridge.cover, size)
+        thumbnails[cartridge_id] = (get_cid(data), data)
+    return thumbnails
+
+
+def get_prices_supply_for_cartridge(cartridge: Cartridge, total_supply: int | None = None):
     """
     Get prices and current supply for the given cartridge.
+
+    The supply is the stored counter unless it is given.
     """
-    total_supply = cartridge.cartridge_owners.count()
-    sell, buy, fees = get_prices(
+    if total_supply is None:
+        total_supply = cartridge.total_supply
+    sell, buy, fees = get_quote_cache().get_prices(
         cartridge.base_price,
         total_supply=total_supply,
         initial_supply=cartridge.initial_supply,
@@ -653,11 +1485,200 @@ def get_prices_supply_for_cartridge(cartridge: Cartridge):
         int_exponent=cartridge.exponent,
         int_decimals=AppSettings.token_decimals,
         fees=[AppSettings.developer_fee, AppSettings.treasury_fee],
+        engine=cartridge.curve_engine,
     )
 
     return sell, buy, fees, total_supply
 
 
+def _cartridge_to_dict(cartridge: Cartridge, compact: bool | None = False) -> dict:
+    # internal columns aren't prefetched, to_dict would load them row by row
+    if compact:
+        cartridge_dict = cartridge.to_dict(with_lazy=True, exclude=CARTRIDGE_INTERNAL_ATTRS + ['cover'])
+        cartridge_dict['cover'] = None
+    else:
+        cartridge_dict = cartridge.to_dict(with_lazy=True, exclude=CARTRIDGE_INTERNAL_ATTRS)
+        if cartridge_dict['cover'] is not None:
+            cartridge_dict['cover'] = base64.b64encode(cartridge_dict['cover'])
+    return cartridge_dict
+
+
+def get_owner_counts(cartridge_ids: list[str], owner: str | None = None):
+    """
+    Get the total supply and the copies owned by `owner` of each cartridge.
+
+    Both come from the stored counters, in one query per IN_QUERY_BATCH
+    cartridges.
+    """
+    supplies = {}
+    owned_copies = {}
+    owner_address = owner.lower() if owner else None
+    for i in range(0, len(cartridge_ids), IN_QUERY_BATCH):
+        ids = cartridge_ids[i:i + IN_QUERY_BATCH]
+        if owner_address is None:
+            counts = helpers.select((c.id, c.total_supply, 0) for c in Cartridge if c.id in ids)
+        else:
+            counts = helpers.select(
+                (c.id,
+                 c.total_supply,
+                 helpers.sum(u.copies for u in CartridgeUserCopies
+                             if u.cartridge == c and u.user_address == owner_address))
+                for c in Cartridge if c.id in ids
+            )
+        for cartridge_id, supply, owned in counts:
+            supplies[cartridge_id] = supply
+            owned_copies[cartridge_id] = owned
+    return supplies, owned_copies
+
+
+def _add_owner_copies(cartridge: Cartridge, user_address: str, quantity: int):
+    """
+    Update the supply and owner copy counters after cartridge_owners changed.
+    """
+    cartridge.total_supply += quantity
+    owner_copies = CartridgeUserCopies.get(cartridge=cartridge, user_address=user_address)
+    if owner_copies is None:
+        owner_copies = CartridgeUserCopies(cartridge=cartridge, user_address=user_address, copies=0)
+    owner_copies.copies += quantity
+    if owner_copies.copies == 0:
+        owner_copies.delete()
+
+
+def check_supply_counters(rebuild: bool = False) -> int:
+    """
+    Compare the supply and owner copy counters with the ownership rows,
+    returning how many counters are wrong. With `rebuild`, fix them.
+    """
+    supplies = dict(helpers.select(
+        (co.cartridge.id, helpers.count()) for co in CartridgeUser
+    ))
+    copies = {
+        (cartridge_id, user_address): count
+        for cartridge_id, user_address, count in helpers.select(
+            (co.cartridge.id, co.user_address, helpers.count()) for co in CartridgeUser
+        )
+    }
+
+    mismatches = 0
+    for cartridge in Cartridge.select():
+        supply = supplies.get(cartridge.id, 0)
+        if cartridge.total_supply != supply:
+            mismatches += 1
+            if rebuild:
+                cartridge.total_supply = supply
+
+    for owner_copies in CartridgeUserCopies.select():
+        count = copies.pop((owner_copies.cartridge.id, owner_copies.user_address), 0)
+        if owner_copies.copies != count:
+            mismatches += 1
+            if rebuild:
+                if count == 0:
+                    owner_copies.delete()
+                else:
+                    owner_copies.copies = count
+    # owners without a counter row
+    mismatches += len(copies)
+    if rebuild:
+        for (cartridge_id, user_address), count in copies.items():
+            CartridgeUserCopies(cartridge=cartridge_id, user_address=user_address, copies=count)
+
+    if mismatches:
+        LOGGER.warning(f"Found {mismatches} wrong supply counters{', rebuilt them' if rebuild else ''}")
+    return mismatches
+
+
+_search_index = None
+
+def get_search_index() -> SearchIndex:
+    """
+    Get the cartridge search index, built from the stored cartridges on
+    first use. It lives in memory like the rest of the machine state, so a
+    rejected input reverts it along with the database.
+    """
+    global _search_index
+    if _search_index is None:
+        _search_index = SearchIndex(SEARCH_FIELD_WEIGHTS)
+        for cartridge in Cartridge.select().prefetch(Cartridge.info):
+            add_search_document(cartridge, _search_index)
+        LOGGER.info(f"Indexed {len(_search_index)} cartridges for search")
+    return _search_index
+
+
+def add_search_document(cartridge: Cartridge, index: SearchIndex | None = None):
+    if index is None:
+        index = get_search_index()
+    info = cartridge.info or {}
+    index.add(
+        cartridge.id,
+        {
+            'name': cartridge.name,
+            'authors': ' '.join(a.get('name') or '' for a in info.get('authors') or []),
+            'tags': ' '.join(info.get('tags') or []),
+            'summary': info.get('summary') or '',
+            'description': info.get('description') or '',
+        },
+        sort_key=cartridge.name.lower()
+    )
+
+
+def get_cartridges_by_ids(cartridge_ids: list[str], prefetch_attrs: list) -> list[Cartridge]:
+    """
+    Load cartridges in the order of `cartridge_ids`, skipping missing ones.
+    """
+    by_id = {}
+    for i in range(0, len(cartridge_ids), IN_QUERY_BATCH):
+        ids = cartridge_ids[i:i + IN_QUERY_BATCH]
+        for cartridge in Cartridge.select(lambda c: c.id in ids).prefetch(*prefetch_attrs):
+            by_id[cartridge.id] = cartridge
+    return [by_id[cartridge_id] for cartridge_id in cartridge_ids if cartridge_id in by_id]
+
+
+_quote_cache = None
+
+def get_quote_cache() -> QuoteCache:
+    global _quote_cache
+    if _quote_cache is None:
+        _quote_cache = QuoteCache(maxsize=AppSettings.price_quote_cache_size)
+    return _quote_cache
+
+
+def get_price_ladder(cartridge: Cartridge, supplies: list[int]):
+    """
+    Get sell prices, buy prices and fees of the cartridge at each supply.
+
+    Uses the batched numpy path for float curves with several supplies when
+    numpy is available. Single supplies, as in one-copy trades, are priced
+    with the scalar engine through the quote cache.
+    """
+    if len(supplies) == 1:
+        sell, buy, fees, _ = get_prices_supply_for_cartridge(cartridge, supplies[0])
+        return [sell], [buy], [fees]
+
+    params = dict(
+        int_base_price=cartridge.base_price,
+        initial_supply=cartridge.initial_supply,
+        int_smoothing=cartridge.smoothing_factor,
+        int_exponent=cartridge.exponent,
+        int_decimals=AppSettings.token_decimals,
+        fees=[AppSettings.developer_fee, AppSettings.treasury_fee],
+    )
+    if cartridge.curve_engine == 'float' and HAS_NUMPY:
+        sell, buy, fees = get_prices_many(total_supply=supplies, **params)
+        return sell.tolist(), buy.tolist(), fees.tolist()
+
+    get_prices = get_prices_engine(cartridge.curve_engine)
+    prices = [get_prices(total_supply=supply, **params) for supply in supplies]
+    return [p[0] for p in prices], [p[1] for p in prices], [p[2] for p in prices]
+
+
+def get_upload_fee(cartridge_bytes: int, initial_supply: int) -> int:
+    upload_price = get_upload_price(
+        cartridge_bytes=cartridge_bytes,
+        initial_supply=initial_supply
+    )
+    return int(upload_price * 10**AppSettings.token_decimals)
+
+
 def _get_erc20_balance(wallet_addr: str, contract_addr: str) -> int:
     entry = (
         helpers
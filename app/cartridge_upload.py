@@ -0,0 +1,356 @@
+"""
+Chunked cartridge uploads
+
+Cartridges bigger than an input are uploaded in several inputs: a begin
+input declares the image size, hash and chunk hashes, append inputs send
+the chunks in any order, and a commit input validates and inserts the
+cartridge. Chunks are written straight to a staging file, and resending a
+chunk is harmless, so an interrupted upload resumes with the chunks the
+`cartridge_upload` query reports missing.
+"""
+from pydantic import BaseModel
+import logging
+import os
+from hashlib import sha256
+from typing import List
+
+from cartesi.abi import String, Bytes, Bytes32, UInt, UInt128
+
+from cartesapp.storage import Entity, helpers
+from cartesapp.context import get_metadata
+from cartesapp.input import mutation, query
+from cartesapp.output import event, output, add_output, emit_event
+from cartesapp.wallet import dapp_wallet
+
+from .settings import AppSettings
+from .riv import riv_get_cartridges_path
+from .cartridge import (
+    Cartridge, CartridgeInserted, add_cartridge, get_upload_fee, _get_erc20_balance
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+###
+# Model
+
+class CartridgeUpload(Entity):
+    id              = helpers.PrimaryKey(int, auto=True)
+    user_address    = helpers.Required(str, 42, index=True)
+    size            = helpers.Required(int)
+    data_hash       = helpers.Required(str, 64)
+    chunk_size      = helpers.Required(int)
+    chunk_hashes    = helpers.Required(helpers.Json) # sha256 of each chunk
+    received        = helpers.Required(bytes) # bitmap of the chunks received
+    base_price      = helpers.Required(int)
+    initial_supply  = helpers.Required(int)
+    smoothing_factor= helpers.Required(int)
+    exponent        = helpers.Required(int)
+    created_at      = helpers.Required(int)
+    updated_at      = helpers.Required(int, index=True)
+
+
+# Inputs
+
+class BeginCartridgeUploadPayload(BaseModel):
+    base_price:         UInt128
+    initial_supply:     UInt128
+    smoothing_factor:   UInt128
+    exponent:           UInt128
+    size:               UInt
+    data_hash:          Bytes32 # sha256 of the whole image, the cartridge id
+    chunk_size:         UInt
+    chunk_hashes:       Bytes # sha256 of each chunk, concatenated
+
+class AppendCartridgeChunkPayload(BaseModel):
+    upload_id:  UInt
+    index:      UInt
+    data:       Bytes
+
+class CommitCartridgeUploadPayload(BaseModel):
+    upload_id:  UInt
+
+class CartridgeUploadPayload(BaseModel):
+    id:         int
+
+
+# Outputs
+
+@event()
+class CartridgeUploadStarted(BaseModel):
+    upload_id:      UInt
+    cartridge_id:   String
+    user_address:   String
+    chunks:         UInt
+    timestamp:      UInt
+
+@output()
+class CartridgeUploadInfo(BaseModel):
+    id:             UInt
+    cartridge_id:   String
+    user_address:   String
+    size:           UInt
+    chunk_size:     UInt
+    chunks:         UInt
+    missing_chunks: List[int]
+    created_at:     UInt
+    updated_at:     UInt
+    expires_at:     UInt
+
+
+###
+# Mutations
+
+@mutation()
+def begin_cartridge_upload(payload: BeginCartridgeUploadPayload) -> bool:
+    metadata = get_metadata()
+    dev_addr = metadata.msg_sender.lower()
+
+    clean_stale_uploads(metadata.timestamp)
+
+    cartridge_id = payload.data_hash.hex()
+    chunk_hashes = payload.chunk_hashes
+    msg = None
+    if payload.size == 0 or payload.size > AppSettings.cartridge_upload_max_size:
+        msg = f"Invalid upload size {payload.size}, the maximum is {AppSettings.cartridge_upload_max_size}"
+    elif payload.chunk_size == 0 or payload.chunk_size > AppSettings.cartridge_upload_max_chunk_size:
+        msg = f"Invalid chunk size {payload.chunk_size}, the maximum is {AppSettings.cartridge_upload_max_chunk_size}"
+    elif len(chunk_hashes) != 32 * -(-payload.size // payload.chunk_size):
+        msg = f"Expected {-(-payload.size // payload.chunk_size)} chunk hashes"
+    elif helpers.count(c for c in Cartridge if c.id == cartridge_id) > 0:
+        msg = "Cartridge already exists"
+    elif helpers.count(u for u in CartridgeUpload if u.user_address == dev_addr) >= AppSettings.cartridge_upload_max_sessions:
+        msg = f"Too many uploads in progress, the maximum is {AppSettings.cartridge_upload_max_sessions}"
+    if msg is not None:
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    # refuse early, before any chunk is sent, the fee is charged on commit
+    upload_price = get_upload_fee(payload.size, payload.initial_supply)
+    balance = _get_erc20_balance(dev_addr, AppSettings.token_addr)
+    if upload_price > balance:
+        msg = (
+            f"Not enough funds for upload. {dev_addr=} cartridge_size={payload.size} "
+            f"{upload_price=}"
+        )
+        LOGGER.error(msg)
+        add_output(msg, tags=['error'])
+        return False
+
+    chunks = len(chunk_hashes) // 32
+    upload = CartridgeUpload(
+        user_address=dev_addr,
+        size=payload.size,
+        data_hash=cartridge_id,
+        chunk_size=payload.chunk_size,
+        chunk_hashes=[chunk_hashes[i:i + 32].hex() for i in range(0, len(chunk_hashes), 32)],
+        received=bytes(-(-chunks // 8)),
+        base_price=payload.base_price,
+        initial_supply=payload.initial_supply,
+        smoothing_factor=payload.smoothing_factor,
+        exponent=payload.exponent,
+        created_at=metadata.timestamp,
+        updated_at=metadata.timestamp
+    )
+    helpers.flush() # assign the id
+
+    staging_path = get_upload_path(upload.id)
+    os.makedirs(os.path.dirname(staging_path), exist_ok=True)
+    with open(staging_path, 'wb') as f:
+        f.truncate(payload.size)
+
+    upload_event = CartridgeUploadStarted(
+        upload_id=upload.id,
+        cartridge_id=cartridge_id,
+        user_address=dev_addr,
+        chunks=chunks,
+        timestamp=metadata.timestamp
+    )
+    emit_event(upload_event,tags=['cartridge','begin_cartridge_upload',cartridge_id])
+
+    LOGGER.info(f"Started upload {upload.id} of cartridge {cartridge_id} in {chunks} chunks")
+
+    return True
+
+
+@mutation()
+def append_cartridge_chunk(payload: AppendCartridgeChunkPayload) -> bool:
+    metadata = get_metadata()
+    upload = _get_user_upload(payload.upload_id, metadata.msg_sender.lower())
+    if upload is None:
+        return False
+
+    chunks = len(upload.chunk_hashes)
+    msg = None
+    if payload.index >= chunks:
+        msg = f"Invalid chunk index {payload.index}, the upload has {chunks} chunks"
+    else:
+        start = payload.index * upload.chunk_size
+        expected_size = min(upload.chunk_size, upload.size - start)
+        if len(payload.data) != expected_size:
+            msg = f"Chunk {payload.index} should have {expected_size} bytes"
+        elif sha256(payload.data).hexdigest() != upload.chunk_hashes[payload.index]:
+            msg = f"Chunk {payload.index} doesn't match its hash"
+    if msg is not None:
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    fd = os.open(get_upload_path(upload.id), os.O_WRONLY)
+    try:
+        os.pwrite(fd, payload.data, start)
+    finally:
+        os.close(fd)
+
+    received = bytearray(upload.received)
+    received[payload.index >> 3] |= 1 << (payload.index & 7)
+    upload.received = bytes(received)
+    upload.updated_at = metadata.timestamp
+
+    LOGGER.info(f"Received chunk {payload.index} of upload {upload.id}")
+
+    return True
+
+
+@mutation()
+def commit_cartridge_upload(payload: CommitCartridgeUploadPayload) -> bool:
+    metadata = get_metadata()
+    dev_addr = metadata.msg_sender.lower()
+    upload = _get_user_upload(payload.upload_id, dev_addr)
+    if upload is None:
+        return False
+
+    missing = get_missing_chunks(upload)
+    if missing:
+        msg = f"Upload {upload.id} is missing {len(missing)} chunks"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    staging_path = get_upload_path(upload.id)
+    data_hash = sha256()
+    with open(staging_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            data_hash.update(block)
+    cartridge_id = upload.data_hash
+    if data_hash.hexdigest() != cartridge_id:
+        msg = f"Upload {upload.id} doesn't match the cartridge hash"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    upload_price = get_upload_fee(upload.size, upload.initial_supply)
+    balance = _get_erc20_balance(dev_addr, AppSettings.token_addr)
+    if upload_price > balance:
+        msg = (
+            f"Not enough funds for upload. {dev_addr=} cartridge_size={upload.size} "
+            f"{upload_price=}"
+        )
+        LOGGER.error(msg)
+        add_output(msg, tags=['error'])
+        return False
+
+    LOGGER.info(f"Paying upload fee to treasury. {dev_addr=} {upload_price=}")
+    dapp_wallet.transfer_erc20(
+        token=AppSettings.token_addr,
+        sender=dev_addr,
+        receiver=AppSettings.treasury_addr,
+        amount=upload_price
+    )
+
+    LOGGER.info("Saving cartridge...")
+    try:
+        if helpers.count(c for c in Cartridge if c.id == cartridge_id) > 0:
+            raise Exception("Cartridge already exists")
+        os.replace(staging_path, f"{riv_get_cartridges_path()}/{cartridge_id}")
+        add_cartridge(cartridge_id, upload, **get_metadata().dict())
+    except Exception as e:
+        msg = f"Couldn't insert cartridge: {e}"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    upload.delete()
+
+    cartridge_event = CartridgeInserted(
+        cartridge_id = cartridge_id,
+        user_address = dev_addr,
+        timestamp = metadata.timestamp
+    )
+    emit_event(cartridge_event,tags=['cartridge','insert_cartridge',cartridge_id])
+
+    return True
+
+
+@mutation()
+def clean_cartridge_uploads() -> bool:
+    metadata = get_metadata()
+    removed = clean_stale_uploads(metadata.timestamp)
+    LOGGER.info(f"Removed {removed} stale cartridge uploads")
+    return True
+
+
+###
+# Queries
+
+@query()
+def cartridge_upload(payload: CartridgeUploadPayload) -> bool:
+    upload = CartridgeUpload.get(id=payload.id)
+    if upload is None:
+        add_output("null")
+        return True
+
+    out = CartridgeUploadInfo(
+        id=upload.id,
+        cartridge_id=upload.data_hash,
+        user_address=upload.user_address,
+        size=upload.size,
+        chunk_size=upload.chunk_size,
+        chunks=len(upload.chunk_hashes),
+        missing_chunks=get_missing_chunks(upload),
+        created_at=upload.created_at,
+        updated_at=upload.updated_at,
+        expires_at=upload.updated_at + AppSettings.cartridge_upload_ttl
+    )
+    add_output(out)
+
+    return True
+
+
+###
+# Helpers
+
+def get_upload_path(upload_id: int) -> str:
+    return f"{riv_get_cartridges_path()}/.uploads/{upload_id}"
+
+
+def get_missing_chunks(upload: CartridgeUpload) -> list[int]:
+    received = upload.received
+    return [i for i in range(len(upload.chunk_hashes)) if not received[i >> 3] & (1 << (i & 7))]
+
+
+def _get_user_upload(upload_id: int, user_address: str) -> CartridgeUpload | None:
+    upload = CartridgeUpload.get(id=upload_id)
+    if upload is None or upload.user_address != user_address:
+        msg = f"Upload {upload_id} doesn't exist"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return None
+    return upload
+
+
+def clean_stale_uploads(timestamp: int) -> int:
+    """
+    Delete the uploads that got no chunk for AppSettings.cartridge_upload_ttl
+    seconds, with their staging files. Returns how many were deleted.
+    """
+    stale_query = CartridgeUpload.select(lambda u: u.updated_at + AppSettings.cartridge_upload_ttl < timestamp)
+    stale_ids = list(helpers.select(u.id for u in stale_query))
+    for upload_id in stale_ids:
+        path = get_upload_path(upload_id)
+        if os.path.exists(path):
+            os.remove(path)
+    if stale_ids:
+        stale_query.delete(bulk=True)
+    return len(stale_ids)
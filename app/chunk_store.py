@@ -0,0 +1,72 @@
+"""
+Content defined chunking for cartridge images
+
+Splits data with FastCDC: a gear rolling hash is checked against a mask
+with more bits before the average chunk size and fewer bits after it, which
+keeps chunk sizes close to the average. Boundaries depend only on nearby
+bytes, so an edit only changes the chunks around it and images that share
+content (new versions of a game, games on the same engine) share chunks.
+"""
+from hashlib import sha256
+
+MIN_SIZE = 1024
+AVG_SIZE = 4096
+MAX_SIZE = 32768
+
+_MASK64 = (1 << 64) - 1
+
+# fixed, so chunk boundaries never change between versions
+GEAR = tuple(int.from_bytes(sha256(bytes([i])).digest()[:8], 'little') for i in range(256))
+
+
+def _masks(avg_size: int) -> tuple[int, int]:
+    bits = avg_size.bit_length() - 1
+    # the hash shifts left, so its high bits depend on the most bytes
+    mask_small = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+    mask_large = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+    return mask_small, mask_large
+
+
+def _cut_point(data, start: int, end: int, min_size: int, avg_size: int, max_size: int,
+               mask_small: int, mask_large: int) -> int:
+    if end - start <= min_size:
+        return end
+    normal = min(start + avg_size, end)
+    limit = min(start + max_size, end)
+    gear = GEAR
+    h = 0
+    i = start + min_size
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & _MASK64
+        if not h & mask_small:
+            return i + 1
+        i += 1
+    while i < limit:
+        h = ((h << 1) + gear[data[i]]) & _MASK64
+        if not h & mask_large:
+            return i + 1
+        i += 1
+    return limit
+
+
+def chunk_boundaries(data, min_size: int = MIN_SIZE, avg_size: int = AVG_SIZE,
+                     max_size: int = MAX_SIZE) -> list[tuple[int, int]]:
+    """
+    Return the (start, end) offsets of the chunks of data.
+    """
+    mask_small, mask_large = _masks(avg_size)
+    boundaries = []
+    start = 0
+    while start < len(data):
+        end = _cut_point(data, start, len(data), min_size, avg_size, max_size, mask_small, mask_large)
+        boundaries.append((start, end))
+        start = end
+    return boundaries
+
+
+def chunk_hashes(data, **kwargs) -> list[tuple[str, memoryview]]:
+    """
+    Split data into chunks, returning the sha256 and a view of each one.
+    """
+    view = memoryview(data)
+    return [(sha256(view[start:end]).hexdigest(), view[start:end]) for start, end in chunk_boundaries(data, **kwargs)]
@@ -0,0 +1,131 @@
+"""
+Streaming UnixFS CIDv0 computation
+
+Hashes the dag-pb/UnixFS framing around the data instead of building the
+protobuf messages, so the payload is never copied. Payloads larger than a
+chunk use the standard balanced DAG layout (256 KiB leaves, 174 links per
+node), matching what `ipfs add` produces for CIDv0.
+"""
+import os
+from hashlib import sha256
+
+import base58
+
+CHUNK_SIZE = 256 * 1024
+MAX_LINKS = 174
+READ_SIZE = 1 << 20
+
+SHA256_MULTIHASH_PREFIX = b'\x12\x20'
+UNIXFS_FILE = b'\x08\x02'
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field(tag: int, value: bytes) -> bytes:
+    return bytes([tag]) + _varint(len(value)) + value
+
+
+class _Node:
+    __slots__ = ('multihash', 'tsize', 'filesize')
+
+    def __init__(self, multihash: bytes, tsize: int, filesize: int):
+        self.multihash = multihash
+        self.tsize = tsize
+        self.filesize = filesize
+
+
+class CidBuilder:
+    """
+    Incrementally compute the CID of a file fed through `update`.
+
+    Only a partial chunk is ever buffered; whole chunks are hashed straight
+    from the caller's buffer.
+    """
+    def __init__(self, chunk_size: int = CHUNK_SIZE, max_links: int = MAX_LINKS):
+        self.chunk_size = chunk_size
+        self.max_links = max_links
+        self._buffer = bytearray()
+        self._leaves = []
+
+    def _add_leaf(self, data: memoryview):
+        n = len(data)
+        filesize = b'\x18' + _varint(n)
+        unixfs_size = len(UNIXFS_FILE) + 1 + len(_varint(n)) + n + len(filesize)
+        header = b'\x0a' + _varint(unixfs_size) + UNIXFS_FILE + b'\x12' + _varint(n)
+        h = sha256(header)
+        h.update(data)
+        h.update(filesize)
+        block_size = len(header) + n + len(filesize)
+        self._leaves.append(_Node(SHA256_MULTIHASH_PREFIX + h.digest(), block_size, n))
+
+    def update(self, data):
+        view = memoryview(data).cast('B')
+        if self._buffer:
+            take = min(len(view), self.chunk_size - len(self._buffer))
+            self._buffer += view[:take]
+            view = view[take:]
+            if len(self._buffer) == self.chunk_size:
+                self._add_leaf(memoryview(self._buffer))
+                self._buffer = bytearray()
+        while len(view) >= self.chunk_size:
+            self._add_leaf(view[:self.chunk_size])
+            view = view[self.chunk_size:]
+        if len(view):
+            self._buffer += view
+
+    def _add_parent(self, children: list) -> _Node:
+        filesize = sum(c.filesize for c in children)
+        unixfs = UNIXFS_FILE + b'\x18' + _varint(filesize)
+        unixfs += b''.join(b'\x20' + _varint(c.filesize) for c in children)
+        links = b''.join(
+            _field(0x12, _field(0x0a, c.multihash) + b'\x12\x00' + b'\x18' + _varint(c.tsize))
+            for c in children
+        )
+        block = links + _field(0x0a, unixfs)
+        multihash = SHA256_MULTIHASH_PREFIX + sha256(block).digest()
+        return _Node(multihash, len(block) + sum(c.tsize for c in children), filesize)
+
+    def digest(self) -> bytes:
+        """
+        Return the root multihash. The builder can't be updated afterwards.
+        """
+        if self._buffer or not self._leaves:
+            self._add_leaf(memoryview(self._buffer))
+            self._buffer = bytearray()
+        level = self._leaves
+        while len(level) > 1:
+            level = [
+                self._add_parent(level[i:i + self.max_links])
+                for i in range(0, len(level), self.max_links)
+            ]
+        return level[0].multihash
+
+    def cid(self) -> str:
+        return base58.b58encode(self.digest()).decode('utf-8')
+
+
+def get_cid(data) -> str:
+    """
+    Return the CIDv0 of bytes, a memoryview, a file path or a binary file.
+    """
+    builder = CidBuilder()
+    if isinstance(data, (str, os.PathLike)):
+        with open(data, 'rb') as f:
+            for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                builder.update(chunk)
+    elif hasattr(data, 'read'):
+        for chunk in iter(lambda: data.read(READ_SIZE), b''):
+            builder.update(chunk)
+    else:
+        builder.update(data)
+    return builder.cid()
@@ -1,14 +1,19 @@
 import os
 from enum import Enum
 from PIL import Image, ImageFont, ImageDraw
-from Crypto.Hash import SHA256
-import base58
-import tempfile
 import io
+import zlib
 import pickle
+import logging
+from collections import OrderedDict
 
-from .protobuf_models import unixfs_pb2, merkle_dag_pb2
-from .settings import STORAGE_PATH
+from cartesapp.storage import Entity, helpers
+
+from .settings import AppSettings, STORAGE_PATH
+from .bloom import ScalableBloomFilter
+from .cid import get_cid
+
+LOGGER = logging.getLogger(__name__)
 
 DEFAULT_HEIGHT = 512
 BG_EXTRA_WIDTH = 400
@@ -22,117 +27,278 @@ font2_initial_space = 60
 final_space = 10
 total_font_space = 80
 
+FONT_PATH = 'misc/font/Retro Gaming.ttf'
+LOGO_PATH = 'misc/Rives-Logo.png'
+TEXT_COLOR = '#b3b3b3'
+# logo colors in palette cards, leaving the rest of the palette to the screenshot
+LOGO_COLORS = 32
+
+SCORE_CARD_RESAMPLE = {
+    'nearest': Image.Resampling.NEAREST,
+    'bicubic': Image.Resampling.BICUBIC, # previous default, blends colors
+}
+PNG_COMPRESS_TYPES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman_only': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
 class ScoreType(Enum):
     default = 0
     scoreboard = 1
     tournament = 2
 
 
+class SubmittedGameplay(Entity):
+    id              = helpers.PrimaryKey(int, auto=True)
+    cartridge_id    = helpers.Required(str, 64)
+    gameplay_hash   = helpers.Required(str, 64)
+    helpers.composite_key(cartridge_id, gameplay_hash)
+
+
 class GameplayHash:
-    cartridge_replays = {}
     cartridge_replays_filename = f"{STORAGE_PATH}/cartridge_replays.pkl"
+    filters_path = f"{STORAGE_PATH}/gameplay_filters"
+    filters = {}
+    stats = {'checks': 0, 'possible_hits': 0, 'duplicates': 0}
+    migrated = False
     def __new__(cls):
         return cls
-    
+
     @classmethod
-    def get_cartridge_replays(cls):
-        cartridge_replays = {}
-        if STORAGE_PATH is not None:
-            if os.path.exists(cls.cartridge_replays_filename):
-                f = open(cls.cartridge_replays_filename, 'rb')
-                cartridge_replays = pickle.load(f)
-                f.close()
-        else:
-            cartridge_replays = cls.cartridge_replays
-        return cartridge_replays
+    def migrate_pickle(cls):
+        """
+        Import hashes from the old pickle store, then move it aside.
+        """
+        cls.migrated = True
+        if STORAGE_PATH is None or not os.path.exists(cls.cartridge_replays_filename):
+            return
+        with open(cls.cartridge_replays_filename, 'rb') as f:
+            cartridge_replays = pickle.load(f)
+        total = 0
+        for cartridge_id, replays in cartridge_replays.items():
+            for replay_hash, submitted in replays.items():
+                if submitted and not SubmittedGameplay.exists(cartridge_id=cartridge_id, gameplay_hash=replay_hash):
+                    SubmittedGameplay(cartridge_id=cartridge_id, gameplay_hash=replay_hash)
+                    total += 1
+        helpers.flush()
+        os.rename(cls.cartridge_replays_filename, f"{cls.cartridge_replays_filename}.migrated")
+        LOGGER.info(f"Migrated {total} gameplay hashes from {cls.cartridge_replays_filename}")
 
     @classmethod
-    def store_cartridge_replays(cls,cartridge_replays):
+    def get_filter(cls, cartridge_id):
+        """
+        Return the bloom filter of a cartridge, loading or rebuilding it.
+        """
+        gameplay_filter = cls.filters.get(cartridge_id)
+        if gameplay_filter is not None:
+            return gameplay_filter
+
+        path = None
         if STORAGE_PATH is not None:
-            with open(cls.cartridge_replays_filename, 'wb') as f:
-                pickle.dump(cartridge_replays, f)
-        else:
-            cls.cartridge_replays = cartridge_replays
+            os.makedirs(cls.filters_path, exist_ok=True)
+            path = f"{cls.filters_path}/{cartridge_id}.bloom"
+        kwargs = {
+            'initial_capacity': AppSettings.gameplay_filter_capacity,
+            'error_rate': AppSettings.gameplay_filter_error_rate,
+        }
+        total = helpers.count(g for g in SubmittedGameplay if g.cartridge_id == cartridge_id)
+        if path is not None and os.path.exists(path):
+            gameplay_filter = ScalableBloomFilter.load(path, **kwargs)
+            # a filter that missed some adds could give false negatives
+            if len(gameplay_filter) < total:
+                LOGGER.warning(f"Gameplay filter for {cartridge_id} is stale, rebuilding")
+                os.remove(path)
+                gameplay_filter = None
+        if gameplay_filter is None:
+            gameplay_filter = ScalableBloomFilter(path=path, **kwargs)
+            hashes = helpers.select(g.gameplay_hash for g in SubmittedGameplay if g.cartridge_id == cartridge_id)
+            for replay_hash in hashes:
+                gameplay_filter.add(replay_hash)
+        cls.filters[cartridge_id] = gameplay_filter
+        return gameplay_filter
 
     @classmethod
     def add(cls, cartridge_id, replay_hash):
-        cartridge_replays = cls.get_cartridge_replays()
-        if cartridge_replays.get(cartridge_id) is None: cartridge_replays[cartridge_id] = {}
-        cartridge_replays[cartridge_id][replay_hash] = True
-        cls.store_cartridge_replays(cartridge_replays)
+        if not cls.migrated: cls.migrate_pickle()
+        # the filter is updated first so it never lags behind the table
+        cls.get_filter(cartridge_id).add(replay_hash)
+        SubmittedGameplay(cartridge_id=cartridge_id, gameplay_hash=replay_hash)
 
     @classmethod
     def check(cls, cartridge_id, replay_hash):
-        cartridge_replays = cls.get_cartridge_replays()
-        return cartridge_replays.get(cartridge_id) is None \
-            or cartridge_replays[cartridge_id].get(replay_hash) is None \
-            or cartridge_replays[cartridge_id][replay_hash] == False
+        if not cls.migrated: cls.migrate_pickle()
+        cls.stats['checks'] += 1
+        if replay_hash not in cls.get_filter(cartridge_id):
+            return True
+        cls.stats['possible_hits'] += 1
+        exists = SubmittedGameplay.exists(cartridge_id=cartridge_id, gameplay_hash=replay_hash)
+        if exists:
+            cls.stats['duplicates'] += 1
+        return not exists
 
-def get_cid(data: bytes) -> str:
+    @classmethod
+    def get_stats(cls):
+        """
+        Return filter hit counters, observed false positive rate and memory.
+        """
+        false_positives = cls.stats['possible_hits'] - cls.stats['duplicates']
+        negatives = cls.stats['checks'] - cls.stats['duplicates']
+        return {
+            **cls.stats,
+            'false_positives': false_positives,
+            'false_positive_rate': false_positives / negatives if negatives else 0.0,
+            'filters': len(cls.filters),
+            'entries': sum(len(f) for f in cls.filters.values()),
+            'memory_bytes': sum(f.nbytes for f in cls.filters.values()),
+        }
 
-    unixf = unixfs_pb2.Data()
-    unixf.Type = 2 # file
-    unixf.Data = data
-    unixf.filesize = len(unixf.Data)
+class ScoreCardRenderer:
+    """
+    Render score cards with fonts and logo loaded once.
 
-    mdag = merkle_dag_pb2.MerkleNode()
-    mdag.Data = unixf.SerializeToString()
+    The background with the static labels, the game name and the logo is
+    cached per (game, screenshot size), so each render only pastes the
+    screenshot and draws the score and user.
+    """
+    def __init__(
+            self,
+            font_path: str = FONT_PATH,
+            logo_path: str = LOGO_PATH,
+            max_templates: int = 64,
+            image_format: str | None = None,
+            resample: str | None = None,
+            palette: bool | None = None,
+            compress_level: int | None = None,
+            compress_type: str | None = None):
+        self.image_format = (image_format or AppSettings.score_card_format).upper()
+        if self.image_format not in ('PNG', 'WEBP'):
+            raise Exception(f"Unsupported score card format {self.image_format}")
+        self.resample = SCORE_CARD_RESAMPLE[resample or AppSettings.score_card_resample]
+        self.palette = AppSettings.score_card_palette if palette is None else palette
+        self.compress_level = AppSettings.score_card_compress_level if compress_level is None else compress_level
+        self.compress_type = PNG_COMPRESS_TYPES[compress_type or AppSettings.score_card_compress_type]
+        self.aux_font = ImageFont.truetype(font_path, size=AUX_FONT_SIZE)
+        self.main_font = ImageFont.truetype(font_path, size=MAIN_FONT_SIZE)
+        self.logo = Image.open(logo_path)
+        self.logo.load()
+        if self.palette and self.image_format == 'PNG':
+            self.logo = self.logo.convert('RGBA').quantize(
+                colors=LOGO_COLORS,
+                method=Image.Quantize.FASTOCTREE,
+                dither=Image.Dither.NONE
+            ).convert('RGBA')
+        self.logo_mask = self.logo.convert('RGBA')
+        self.max_templates = max_templates
+        self.templates = OrderedDict()
 
-    mdag_data = mdag.SerializeToString()
+    @staticmethod
+    def get_layout(screenshot_size):
+        height = int((DEFAULT_HEIGHT // screenshot_size[1]) * screenshot_size[1])
+        width = int(height / screenshot_size[1] * screenshot_size[0])
+        space_between = (height - initial_space - final_space - 3 * total_font_space) // 2
+        return width, height, space_between
 
-    h = SHA256.new()
-    h.update(mdag_data)
-    sha256_code = "12"
-    size = hex(h.digest_size)[2:]
-    digest = h.hexdigest()
-    combined = f"{sha256_code}{size}{digest}"
-    multihash = base58.b58encode(bytes.fromhex(combined))
-    cid = multihash.decode('utf-8')
+    def get_template(self, game: str, screenshot_size) -> Image.Image:
+        key = (game, tuple(screenshot_size))
+        template = self.templates.get(key)
+        if template is not None:
+            self.templates.move_to_end(key)
+            return template
 
-    return cid
+        width, height, space_between = self.get_layout(screenshot_size)
+        bg_img = Image.new('RGB', ( width + BG_EXTRA_WIDTH, height), color='#202020')
 
+        draw = ImageDraw.Draw(bg_img)
+        draw.text((width + 10, initial_space), f"game",fill=TEXT_COLOR,font=self.aux_font)
+        draw.text((width + 10, font2_initial_space), f"{game}",fill=TEXT_COLOR,font=self.main_font)
+        draw.text((width + 10, initial_space + total_font_space + space_between), f"score",fill=TEXT_COLOR,font=self.aux_font) # 170
+        draw.text((width + 10, initial_space + 2*(total_font_space + space_between)), f"user",fill=TEXT_COLOR,font=self.aux_font) # 300
 
-def screenshot_add_score(screenshot_data: bytes, game: str, score: int, user: str) -> bytes:
-    screenshot_temp = tempfile.NamedTemporaryFile()
-    screenshot_file = screenshot_temp.file
-    screenshot_file.write(screenshot_data)
-    screenshot_file.flush()
+        template = bg_img.convert('RGBA')
+        template.paste(self.logo,(width + BG_EXTRA_WIDTH - 100,10),self.logo_mask)
 
-    img = Image.open(screenshot_temp.name)
-    
-    screenshot_temp.close()
+        self.templates[key] = template
+        if len(self.templates) > self.max_templates:
+            self.templates.popitem(last=False)
+        return template
 
-    height = int((DEFAULT_HEIGHT // img.size[1]) * img.size[1])
-    width = int(height / img.size[1] * img.size[0])
- 
-    space_between = (height - initial_space - final_space - 3 * total_font_space) // 2
+    def render(self, screenshot_data: bytes, game: str, score: int, user: str) -> bytes:
+        img = Image.open(io.BytesIO(screenshot_data))
+        width, height, space_between = self.get_layout(img.size)
 
-    resized_img = img.resize((width,height))
+        bgc = self.get_template(game, img.size).copy()
 
-    bg_img = Image.new('RGB', ( width + BG_EXTRA_WIDTH, height), color='#202020') 
+        draw = ImageDraw.Draw(bgc)
+        draw.text((width + 10, font2_initial_space + total_font_space + space_between), f"{score}",fill=TEXT_COLOR,font=self.main_font) # 200
+        draw.text((width + 10, font2_initial_space + 2*(total_font_space + space_between)), f"{user}",fill=TEXT_COLOR,font=self.main_font) # 330
 
-    draw = ImageDraw.Draw(bg_img)
+        bgc.paste(img.resize((width,height),resample=self.resample),(0,0))
 
-    font28 = ImageFont.truetype('misc/font/Retro Gaming.ttf',size=28)
-    font42 = ImageFont.truetype('misc/font/Retro Gaming.ttf',size=42)
+        return self.encode(bgc)
 
-    draw.text((width + 10, initial_space), f"game",fill='#b3b3b3',font=font28)
-    draw.text((width + 10, font2_initial_space), f"{game}",fill='#b3b3b3',font=font42)
+    def encode(self, img: Image.Image) -> bytes:
+        """
+        Encode a score card deterministically with the configured settings.
+        """
+        img_byte_arr = io.BytesIO()
+        if self.image_format == 'WEBP':
+            img.convert('RGB').save(img_byte_arr, format='WEBP', lossless=True, quality=75, method=4, exact=True)
+            return img_byte_arr.getvalue()
 
-    draw.text((width + 10, initial_space + total_font_space + space_between), f"score",fill='#b3b3b3',font=font28) # 170
-    draw.text((width + 10, font2_initial_space + total_font_space + space_between), f"{score}",fill='#b3b3b3',font=font42) # 200
+        if self.palette:
+            img = to_palette(img)
+        img.save(
+            img_byte_arr,
+            format='PNG',
+            compress_level=self.compress_level,
+            compress_type=self.compress_type
+        )
+        return img_byte_arr.getvalue()
 
-    draw.text((width + 10, initial_space + 2*(total_font_space + space_between)), f"user",fill='#b3b3b3',font=font28) # 300
-    draw.text((width + 10, font2_initial_space + 2*(total_font_space + space_between)), f"{user}",fill='#b3b3b3',font=font42) # 330
-    logo = Image.open('misc/Rives-Logo.png')
 
-    bgc = bg_img.convert('RGBA')
-    bgc.paste(logo,(width + BG_EXTRA_WIDTH - 100,10),logo.convert('RGBA'))
+_score_card_renderer = None
 
-    bgc.paste(resized_img,(0,0))
+def get_score_card_renderer() -> ScoreCardRenderer:
+    global _score_card_renderer
+    if _score_card_renderer is None:
+        _score_card_renderer = ScoreCardRenderer()
+    return _score_card_renderer
 
-    img_byte_arr = io.BytesIO()
-    bgc.save(img_byte_arr, format='PNG')
 
-    return img_byte_arr.getvalue()
+def screenshot_add_score(screenshot_data: bytes, game: str, score: int, user: str) -> bytes:
+    return get_score_card_renderer().render(screenshot_data, game, score, user)
+
+
+def to_palette(img: Image.Image) -> Image.Image:
+    """
+    Convert to a palette image deterministically, without losing colors.
 
+    Images with 256 colors or fewer get an exact palette, others are kept
+    as RGB, a palette can't hold them.
+    """
+    img = img.convert('RGB')
+    colors = img.getcolors(256)
+    if colors is None:
+        return img
+    return img.quantize(
+        colors=len(colors),
+        method=Image.Quantize.MEDIANCUT,
+        dither=Image.Dither.NONE
+    )
+
+
+def make_thumbnail(image_data: bytes, size: int) -> bytes:
+    """
+    Return a palette PNG that fits in size x size, keeping the aspect ratio.
+
+    Pixel art covers are scaled with nearest neighbour so they stay sharp,
+    and images are never scaled up.
+    """
+    img = Image.open(io.BytesIO(image_data)).convert('RGB')
+    img.thumbnail((size, size), Image.Resampling.NEAREST)
+    img_byte_arr = io.BytesIO()
+    to_palette(img).save(img_byte_arr, format='PNG', compress_level=9)
+    return img_byte_arr.getvalue()
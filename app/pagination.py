@@ -0,0 +1,70 @@
+"""
+Keyset pagination
+
+A cursor holds the sort key and id of the last row of a page, encoded as an
+opaque string. The next page starts right after that row with an index
+seek, so a deep page costs the same as the first one, unlike OFFSET which
+reads and discards every earlier row.
+"""
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 10
+
+
+def encode_cursor(*values) -> str:
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, *types) -> list:
+    """
+    Decode a cursor made by `encode_cursor`, checking its values have the
+    given types.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise Exception("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types) or \
+            not all(type(v) is t for v, t in zip(values, types)):
+        raise Exception("Invalid cursor")
+    return values
+
+
+def check_page(page: int | None, page_size: int | None):
+    """
+    Check the page and page size of a query, when given, are at least 1.
+    """
+    if page is not None and page < 1:
+        raise Exception("Invalid page")
+    if page_size is not None and page_size < 1:
+        raise Exception("Invalid page size")
+
+
+def fetch_page(rows_query, page_size: int | None, cursor_values) -> tuple[list, str | None]:
+    """
+    Fetch a page of an ordered query, already filtered to start after the
+    cursor, and the cursor of the next page, or None on the last page.
+    `cursor_values` returns the cursor values of a row.
+    """
+    check_page(None, page_size)
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    rows = list(rows_query[:page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, encode_cursor(*cursor_values(rows[-1]))
+
+
+def page_cursor(rows: list, page: int, page_size: int | None, total: int, cursor_values) -> str | None:
+    """
+    The cursor to continue after the rows of an OFFSET `page`, or None on
+    the last page, so clients can switch to cursors from any page.
+    """
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    if not rows or (page - 1) * page_size + len(rows) >= total:
+        return None
+    return encode_cursor(*cursor_values(rows[-1]))
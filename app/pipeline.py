@@ -0,0 +1,61 @@
+"""
+Concurrent pipeline stages
+
+Runs independent stages on a thread pool and fails fast: the first stage
+that raises sets the cancel event every stage gets, drops the stages that
+haven't started, waits for the running ones to stop and re-raises its
+exception. No stage is left running when `run_stages` returns, so callers
+can clean up what the stages use. Stages that run subprocesses should check
+the event and kill them.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from typing import Any, Callable
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StageCancelled(Exception):
+    """
+    A stage stopped because another stage of its pipeline failed.
+    """
+
+
+def run_stages(stages: dict[str, Callable[[threading.Event], Any]],
+               max_workers: int | None = None) -> tuple[dict, dict]:
+    """
+    Run each stage with a shared cancel event, returning the results and
+    the seconds each finished stage took, both by stage name.
+    """
+    cancel = threading.Event()
+    timings = {}
+
+    def timed(name, stage):
+        if cancel.is_set():
+            raise StageCancelled(f"Stage {name} cancelled")
+        start = time.perf_counter()
+        try:
+            return stage(cancel)
+        finally:
+            timings[name] = time.perf_counter() - start
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1)
+    try:
+        futures = {executor.submit(timed, name, stage): name for name, stage in stages.items()}
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                cancel.set()
+                LOGGER.warning(
+                    f"Stage {futures[future]} failed, cancelling the other stages: {format_timings(timings)}"
+                )
+                raise future.exception()
+        return {name: future.result() for future, name in futures.items()}, timings
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def format_timings(timings: dict) -> str:
+    return ' '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items())
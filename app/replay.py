@@ -10,14 +10,15 @@ from cartesi.abi import String, Bytes, Bytes32, Int, UInt, Address
 
 from cartesapp.storage import helpers
 from cartesapp.context import get_metadata
-from cartesapp.input import mutation
-from cartesapp.output import add_output, event, emit_event, contract_call
+from cartesapp.input import mutation, query
+from cartesapp.output import add_output, output, event, emit_event, contract_call
 from cartesapp.utils import bytes2str
 
 from .settings import AppSettings
 from .riv import replay_log
-from .common import ScoreType, GameplayHash, screenshot_add_score, get_cid
-from .cartridge import Cartridge
+from .common import ScoreType, GameplayHash
+from .score_card import submit_score_card, render_pending_score_cards
+from .cartridge import Cartridge, cartridge_image
 
 LOGGER = logging.getLogger(__name__)
 
@@ -53,6 +54,17 @@ class ReplayScore(BaseModel):
     screenshot_cid: String = ''
     gameplay_hash:  Bytes32
 
+@output()
+class GameplayFilterStats(BaseModel):
+    checks:                 UInt
+    possible_hits:          UInt
+    duplicates:             UInt
+    false_positives:        UInt
+    false_positive_rate:    float
+    filters:                UInt
+    entries:                UInt
+    memory_bytes:           UInt
+
 
 ###
 # Mutations
@@ -80,7 +92,8 @@ def replay(replay: Replay) -> bool:
     # process replay
     LOGGER.info("Replaying cartridge...")
     try:
-        outcard_raw, outhash, screenshot = replay_log(replay.cartridge_id.hex(),replay.log,replay.args,replay.in_card)
+        with cartridge_image(replay.cartridge_id.hex()):
+            outcard_raw, outhash, screenshot = replay_log(replay.cartridge_id.hex(),replay.log,replay.args,replay.in_card)
     except Exception as e:
         msg = f"Couldn't replay log: {e}"
         LOGGER.error(msg)
@@ -122,9 +135,14 @@ def replay(replay: Replay) -> bool:
 
     user_alias = replay.user_alias if len(replay.user_alias) else f"{metadata.msg_sender[:6]}...{metadata.msg_sender[-4:]}"
 
-    final_screenshot = screenshot_add_score(screenshot,cartridge.name,score,user_alias)
+    add_output(replay.log,tags=['replay',replay.cartridge_id.hex()])
 
-    cid = get_cid(final_screenshot)
+    cid = submit_score_card(
+        screenshot,cartridge.name,score,user_alias,
+        cartridge_id=replay.cartridge_id.hex(),
+        gameplay_hash=gameplay_hash.hexdigest(),
+        tags=['screenshot',replay.cartridge_id.hex()]
+    )
 
     replay_score = ReplayScore(
         cartridge_id = replay.cartridge_id,
@@ -136,10 +154,21 @@ def replay(replay: Replay) -> bool:
         gameplay_hash = gameplay_hash.digest()
     )
 
-    add_output(replay.log,tags=['replay',replay.cartridge_id.hex()])
-    add_output(final_screenshot,tags=['screenshot',replay.cartridge_id.hex()])
     emit_event(replay_score,tags=['score','general',replay.cartridge_id.hex()])
 
     GameplayHash.add(replay.cartridge_id.hex(),gameplay_hash.hexdigest())
 
+    render_pending_score_cards(AppSettings.score_card_render_budget)
+
+    return True
+
+
+###
+# Queries
+
+@query()
+def gameplay_filter_stats() -> bool:
+    out = GameplayFilterStats.parse_obj(GameplayHash.get_stats())
+    add_output(out)
+
     return True
@@ -1,9 +1,20 @@
 import subprocess
 import os
+import mmap
+import struct
+import zlib
+import lzma
+from hashlib import sha256
 from pathlib import Path
 import tempfile
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from .settings import AppSettings, STORAGE_PATH
+from .riv_pool import get_worker_pool, RivWorkerUnavailable, CANCEL_POLL_INTERVAL
+
+LOGGER = logging.getLogger(__name__)
 
 def riv_get_cartridges_path():
     if AppSettings.rivemu_path is None: # use riv os
@@ -11,241 +22,487 @@ def riv_get_cartridges_path():
     return f"{STORAGE_PATH or '.'}/{AppSettings.cartridges_path}"
 
 
-def riv_get_cartridge_info(cartridge_id):
-    args = ["sqfscat","-st"]
+SQUASHFS_MAGIC = 0x73717368
+SQUASHFS_METADATA_SIZE = 8192
+SQUASHFS_INVALID_FRAGMENT = 0xffffffff
+SQUASHFS_COMPRESSED_BIT = 1 << 24
+SQUASHFS_METADATA_UNCOMPRESSED = 0x8000
+SQUASHFS_BLOCK_SIZES = tuple(1 << i for i in range(12, 21)) # 4KiB to 1MiB
+SQUASHFS_MAX_FILE_SIZE = 16 << 20 # sparse blocks let a small image declare huge files
+
+SQUASHFS_DIR_TYPES = (1, 8)
+SQUASHFS_FILE_TYPES = (2, 9)
+
+class SquashFsImage:
+    """
+    Read-only SquashFS 4.0 reader over a memory-mapped image.
+
+    Metadata blocks are decompressed once and cached, so reading several
+    files from the same image only parses the shared tables once.
+    """
+    def __init__(self, path):
+        with open(path,'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < 96:
+            self.close()
+            raise Exception("Not a squashfs 4.0 image")
+        (magic, self.inode_count, _, self.block_size, self.fragment_count,
+         self.compressor, _, self.flags, _, major, _,
+         self.root_inode, _, _, _, self.inode_table_start,
+         self.directory_table_start, self.fragment_table_start,
+         _) = struct.unpack_from('<IIIIIHHHHHHQQQQQQQQ', self.mm, 0)
+        if magic != SQUASHFS_MAGIC or major != 4:
+            self.close()
+            raise Exception("Not a squashfs 4.0 image")
+        if self.block_size not in SQUASHFS_BLOCK_SIZES:
+            self.close()
+            raise ValueError(f"Invalid squashfs block size {self.block_size}")
+        self._decompress = self._get_decompressor(self.compressor)
+        self._metadata_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+
+    def _get_decompressor(self, compressor):
+        """
+        Return a function that decompresses a block of at most max_size
+        bytes, raising ValueError for blocks that inflate to more.
+        """
+        if compressor == 1: # gzip
+            new_decompressor = zlib.decompressobj
+        elif compressor == 2: # lzma
+            new_decompressor = lambda: lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+        elif compressor == 4: # xz
+            new_decompressor = lambda: lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        elif compressor == 6: # zstd
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("zstd squashfs images require the zstandard package")
+            decompressor = zstandard.ZstdDecompressor()
+            def decompress(data, max_size):
+                try:
+                    out = decompressor.decompress(data, max_output_size=max_size + 1)
+                except zstandard.ZstdError as e:
+                    raise ValueError(f"Invalid zstd block: {e}")
+                if len(out) > max_size:
+                    raise ValueError(f"Block inflates to more than {max_size} bytes")
+                return out
+            return decompress
+        else:
+            raise Exception(f"Unsupported squashfs compressor {compressor}")
+
+        def decompress(data, max_size):
+            # ask for one byte more than allowed, so oversize blocks are
+            # detected without inflating them any further
+            out = new_decompressor().decompress(data, max_length=max_size + 1)
+            if len(out) > max_size:
+                raise ValueError(f"Block inflates to more than {max_size} bytes")
+            return out
+        return decompress
+
+    def _metadata_block(self, pos):
+        block = self._metadata_cache.get(pos)
+        if block is None:
+            header, = struct.unpack_from('<H', self.mm, pos)
+            size = header & ~SQUASHFS_METADATA_UNCOMPRESSED
+            data = self.mm[pos + 2:pos + 2 + size]
+            if not header & SQUASHFS_METADATA_UNCOMPRESSED:
+                data = self._decompress(data, SQUASHFS_METADATA_SIZE)
+            block = (data, pos + 2 + size)
+            self._metadata_cache[pos] = block
+        return block
+
+    def _read_metadata(self, pos, offset, size):
+        out = bytearray()
+        while size > 0:
+            data, next_pos = self._metadata_block(pos)
+            chunk = data[offset:offset + size]
+            out += chunk
+            size -= len(chunk)
+            offset += len(chunk)
+            if offset >= len(data):
+                pos, offset = next_pos, 0
+        return bytes(out), pos, offset
+
+    def _read_inode(self, block, offset):
+        pos = self.inode_table_start + block
+        header, pos, offset = self._read_metadata(pos, offset, 16)
+        inode_type, = struct.unpack_from('<H', header, 0)
+        inode = {'type': inode_type}
+        if inode_type == 1:
+            data, pos, offset = self._read_metadata(pos, offset, 16)
+            start, _, size, dir_offset, _ = struct.unpack('<IIHHI', data)
+            inode.update(dir_start=start, dir_offset=dir_offset, dir_size=size)
+        elif inode_type == 8:
+            data, pos, offset = self._read_metadata(pos, offset, 24)
+            _, size, start, _, _, dir_offset, _ = struct.unpack('<IIIIHHI', data)
+            inode.update(dir_start=start, dir_offset=dir_offset, dir_size=size)
+        elif inode_type in SQUASHFS_FILE_TYPES:
+            if inode_type == 2:
+                data, pos, offset = self._read_metadata(pos, offset, 16)
+                blocks_start, fragment, frag_offset, file_size = struct.unpack('<IIII', data)
+            else:
+                data, pos, offset = self._read_metadata(pos, offset, 40)
+                blocks_start, file_size, _, _, fragment, frag_offset, _ = struct.unpack('<QQQIIII', data)
+            if file_size > SQUASHFS_MAX_FILE_SIZE:
+                raise ValueError(f"File of {file_size} bytes is too big to read")
+            if fragment == SQUASHFS_INVALID_FRAGMENT:
+                n_blocks = (file_size + self.block_size - 1) // self.block_size
+            else:
+                n_blocks = file_size // self.block_size
+            data, pos, offset = self._read_metadata(pos, offset, 4 * n_blocks)
+            inode.update(
+                blocks_start=blocks_start,
+                fragment=fragment,
+                frag_offset=frag_offset,
+                file_size=file_size,
+                block_sizes=struct.unpack(f'<{n_blocks}I', data)
+            )
+        return inode
+
+    def _list_dir(self, inode):
+        entries = {}
+        # directory sizes include 3 bytes for the implicit . and .. entries
+        remaining = inode['dir_size'] - 3
+        pos = self.directory_table_start + inode['dir_start']
+        offset = inode['dir_offset']
+        while remaining > 0:
+            data, pos, offset = self._read_metadata(pos, offset, 12)
+            count, start, _ = struct.unpack('<III', data)
+            remaining -= 12
+            for _ in range(count + 1):
+                data, pos, offset = self._read_metadata(pos, offset, 8)
+                entry_offset, _, _, name_size = struct.unpack('<HhHH', data)
+                name, pos, offset = self._read_metadata(pos, offset, name_size + 1)
+                remaining -= 8 + name_size + 1
+                entries[name.decode('utf-8')] = (start, entry_offset)
+        return entries
+
+    def _read_block(self, start, size_field, expected):
+        size = size_field & ~SQUASHFS_COMPRESSED_BIT
+        if size == 0: # sparse block
+            return bytes(expected)
+        data = self.mm[start:start + size]
+        if not size_field & SQUASHFS_COMPRESSED_BIT:
+            data = self._decompress(data, self.block_size)
+        return data
+
+    def _read_fragment(self, index):
+        lookup_pos = self.fragment_table_start + (index // 512) * 8
+        block_pos, = struct.unpack_from('<Q', self.mm, lookup_pos)
+        data, _, _ = self._read_metadata(block_pos, (index % 512) * 16, 16)
+        start, size_field, _ = struct.unpack('<QII', data)
+        return self._read_block(start, size_field, self.block_size)
+
+    def _read_file(self, inode):
+        out = bytearray()
+        pos = inode['blocks_start']
+        remaining = inode['file_size']
+        for size_field in inode['block_sizes']:
+            out += self._read_block(pos, size_field, min(self.block_size, remaining))
+            pos += size_field & ~SQUASHFS_COMPRESSED_BIT
+            remaining -= self.block_size
+        if inode['fragment'] != SQUASHFS_INVALID_FRAGMENT:
+            fragment = self._read_fragment(inode['fragment'])
+            tail = inode['file_size'] - len(out)
+            out += fragment[inode['frag_offset']:inode['frag_offset'] + tail]
+        return bytes(out[:inode['file_size']])
+
+    def _lookup(self, path):
+        ref = self.root_inode
+        dir_cache = {}
+        for part in [p for p in path.split('/') if p]:
+            inode = self._read_inode(ref >> 16, ref & 0xffff)
+            if inode['type'] not in SQUASHFS_DIR_TYPES:
+                return None
+            key = (inode['dir_start'], inode['dir_offset'])
+            if key not in dir_cache:
+                dir_cache[key] = self._list_dir(inode)
+            entry = dir_cache[key].get(part)
+            if entry is None:
+                return None
+            ref = (entry[0] << 16) | entry[1]
+        return self._read_inode(ref >> 16, ref & 0xffff)
+
+    def read_files(self, paths):
+        """
+        Return a dict of path -> contents, with None for missing files.
+        """
+        files = {}
+        for path in paths:
+            inode = self._lookup(path)
+            if inode is None or inode['type'] not in SQUASHFS_FILE_TYPES:
+                files[path] = None
+            else:
+                files[path] = self._read_file(inode)
+        return files
+
+
+def _riv_cartridge_image_path(cartridge_id):
     if AppSettings.rivemu_path is None: # use riv os
-        args.append(f"/rivos/{AppSettings.cartridges_path}/{cartridge_id}")
-    else:
-        args.append(f"{AppSettings.cartridges_path}/{cartridge_id}")
-    args.append("/info.json")
-        
-    result = subprocess.run(args, capture_output=True, text=True)
-    if result.returncode > 0:
-        raise Exception(f"Error getting info: {str(result.stderr)}")
+        return f"/rivos/{AppSettings.cartridges_path}/{cartridge_id}"
+    return f"{AppSettings.cartridges_path}/{cartridge_id}"
 
-    return result.stdout
-
-def riv_get_cover(cartridge_id):
-    args = ["sqfscat","-no-exit"]
-    if AppSettings.rivemu_path is None: # use riv os
-        args.append(f"/rivos/{AppSettings.cartridges_path}/{cartridge_id}")
-    else:
-        args.append(f"{AppSettings.cartridges_path}/{cartridge_id}")
-    args.append("/cover.png")
-        
+def _sqfscat(cartridge_id,path):
+    args = ["sqfscat","-no-exit",_riv_cartridge_image_path(cartridge_id),path]
     result = subprocess.run(args, capture_output=True)
     if result.returncode > 0:
-        raise Exception(f"Error getting cover: {str(result.stderr)}")
+        raise Exception(f"Error reading {path}: {str(result.stderr)}")
+    return result.stdout or None
+
+def riv_get_cartridge_files(cartridge_id,paths):
+    """
+    Read several files from a cartridge image in a single pass.
+
+    Falls back to sqfscat for images the in-process reader can't handle.
+    Missing files are returned as None.
+    """
+    try:
+        with SquashFsImage(_riv_cartridge_image_path(cartridge_id)) as image:
+            return image.read_files(paths)
+    except (struct.error, lzma.LZMAError, zlib.error, ValueError) as e:
+        raise Exception(f"Corrupt cartridge image: {e}")
+    except Exception as e:
+        if not os.path.exists(_riv_cartridge_image_path(cartridge_id)):
+            raise
+        LOGGER.warning(f"Reading cartridge with sqfscat: {e}")
+    return {path: _sqfscat(cartridge_id,path) for path in paths}
 
-    return result.stdout
-
-def riv_get_cartridge_screenshot(cartridge_id,frame):
-    args = []
-    if AppSettings.rivemu_path is None: # use riv os
-        screenshot_path = "/run/screenshot"
-        if os.path.exists(screenshot_path): os.remove(screenshot_path)
-        args.append("riv-chroot")
-        args.append("/rivos")
-        args.extend(["--setenv", "RIV_CARTRIDGE", f"/{AppSettings.cartridges_path}/{cartridge_id}"])
-        args.extend(["--setenv", "RIV_SAVE_SCREENSHOT", screenshot_path])
-        args.extend(["--setenv", "RIV_STOP_FRAME", f"{frame}"])
-        args.extend(["--setenv", "RIV_NO_YIELD", "y"])
-        args.append("riv-run")
-        result = subprocess.run(args)
-        
-        if result.returncode != 0:
-            raise Exception("Error getting screenshot: {str(result.stderr)}")
+def riv_get_cartridge_info(cartridge_id):
+    info = riv_get_cartridge_files(cartridge_id,["/info.json"])["/info.json"]
+    if info is None:
+        raise Exception("Error getting info: /info.json not found")
+    return info.decode('utf-8')
 
-        cartridge_screenshot = open(screenshot_path,'rb').read()
-        os.remove(screenshot_path)
+def riv_get_cover(cartridge_id):
+    return riv_get_cartridge_files(cartridge_id,["/cover.png"])["/cover.png"] or b''
+
+_emulator_version_cache = {}
+
+def riv_get_emulator_version():
+    """
+    Return a digest of the emulator files, used to invalidate cached runs.
+
+    The digest is recomputed only when a file's size or mtime changes.
+    """
+    paths = AppSettings.riv_emulator_files
+    if paths is None:
+        paths = [AppSettings.rivemu_path] if AppSettings.rivemu_path is not None else []
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats.append((path, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            stats.append((path, None, None))
+    key = tuple(stats)
+    version = _emulator_version_cache.get(key)
+    if version is None:
+        h = sha256()
+        for path, size, _ in stats:
+            h.update(path.encode('utf-8'))
+            if size is not None:
+                with open(path,'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 16), b''):
+                        h.update(chunk)
+        version = h.hexdigest()
+        _emulator_version_cache.clear()
+        _emulator_version_cache[key] = version
+    return version
 
-        return cartridge_screenshot
-            
-    # use rivemu
-    screenshot_temp = tempfile.NamedTemporaryFile()
+def riv_get_cartridge_screenshot(cartridge_id,frame):
+    pool = get_worker_pool()
+    if pool is not None:
+        try:
+            return pool.run('screenshot',cartridge_id=cartridge_id,frame=frame)
+        except RivWorkerUnavailable as e:
+            LOGGER.warning(f"Worker pool unavailable, running one-shot: {e}")
+    return _riv_get_cartridge_screenshot(cartridge_id,frame)
+
+def replay_log(cartridge_id,log,riv_args,in_card,cancel=None):
+    """
+    Verify a replay. Setting the `cancel` event kills the emulator run.
+    """
+    pool = get_worker_pool()
+    if pool is not None:
+        try:
+            return pool.run('replay_log',cancel=cancel,cartridge_id=cartridge_id,log=log,riv_args=riv_args,in_card=in_card)
+        except RivWorkerUnavailable as e:
+            LOGGER.warning(f"Worker pool unavailable, running one-shot: {e}")
+    return _replay_log(cartridge_id,log,riv_args,in_card,cancel)
 
-    cwd=str(Path(AppSettings.rivemu_path).parent.parent.absolute())
+def riv_get_cartridge_outcard(cartridge_id,frame,riv_args,in_card):
+    pool = get_worker_pool()
+    if pool is not None:
+        try:
+            return pool.run('outcard',cartridge_id=cartridge_id,frame=frame,riv_args=riv_args,in_card=in_card)
+        except RivWorkerUnavailable as e:
+            LOGGER.warning(f"Worker pool unavailable, running one-shot: {e}")
+    return _riv_get_cartridge_outcard(cartridge_id,frame,riv_args,in_card)
+
+def riv_get_run_path():
+    if AppSettings.riv_run_path is not None:
+        return AppSettings.riv_run_path
+    if AppSettings.rivemu_path is None: # use riv os
+        return "/run"
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return None
+
+@contextmanager
+def riv_run_dir():
+    # each run gets its own (tmpfs backed when possible) working directory,
+    # so several emulator runs can happen at the same time
+    with tempfile.TemporaryDirectory(prefix="riv-",dir=riv_get_run_path()) as run_dir:
+        yield run_dir
+
+def _riv_base_args(cartridge_id):
+    if AppSettings.rivemu_path is None: # use riv os
+        return ["riv-chroot","/rivos","--setenv","RIV_CARTRIDGE",f"/{AppSettings.cartridges_path}/{cartridge_id}"]
     absolute_cartridge_path = os.path.abspath(f"{AppSettings.cartridges_path}/{cartridge_id}")
-    args.append(AppSettings.rivemu_path)
-    args.append(f"-cartridge={absolute_cartridge_path}")
-    args.append(f"-save-screenshot={screenshot_temp.name}")
-    args.append(f"-stop-frame={frame}")
-    # args.append(f"-no-yield=y")
-    result = subprocess.run(args, cwd=cwd)
-
-    if result.returncode != 0:
-        raise Exception(f"Error getting screenshot: {str(result.stderr)}")
+    return [AppSettings.rivemu_path,f"-cartridge={absolute_cartridge_path}"]
 
-    cartridge_screenshot = open(screenshot_temp.name,'rb').read()
-    screenshot_temp.close()
-
-    return cartridge_screenshot
-
-def replay_log(cartridge_id,log,riv_args,in_card):
+def _riv_option(name,value):
+    # riv os options are env vars for riv-run, rivemu options are flags
     if AppSettings.rivemu_path is None: # use riv os
-        replay_path = "/run/replaylog"
-        outcard_path = "/run/outcard"
-        incard_path = "/run/incard"
-        outhash_path = "/run/outhash"
-        screenshot_path = "/run/screenshot"
-        
-        replay_file = open(replay_path,'wb')
-        replay_file.write(log)
-        replay_file.close()
-
-        if os.path.exists(outcard_path): os.remove(outcard_path)
-        if os.path.exists(outhash_path): os.remove(outhash_path)
-        if os.path.exists(screenshot_path): os.remove(screenshot_path)
+        return ["--setenv", f"RIV_{name.upper().replace('-','_')}", value]
+    return [f"-{name}={value}"]
 
-        if in_card is not None and len(in_card) > 0:
-            incard_file = open(incard_path,'wb')
-            incard_file.write(in_card)
-            incard_file.close()
-
-        run_args = []
-        run_args.append("riv-chroot")
-        run_args.append("/rivos")
-        run_args.extend(["--setenv", "RIV_CARTRIDGE", f"/{AppSettings.cartridges_path}/{cartridge_id}"])
-        run_args.extend(["--setenv", "RIV_REPLAYLOG", replay_path])
-        run_args.extend(["--setenv", "RIV_OUTCARD", outcard_path])
-        run_args.extend(["--setenv", "RIV_OUTHASH", outhash_path])
-        run_args.extend(["--setenv", "RIV_SAVE_SCREENSHOT", screenshot_path])
-        if in_card is not None and len(in_card) > 0:
-            run_args.extend(["--setenv", "RIV_INCARD", incard_path])
+def _riv_run(run_args,riv_args,cancel=None):
+    cwd = None
+    if AppSettings.rivemu_path is None: # use riv os
         run_args.extend(["--setenv", "RIV_NO_YIELD", "y"])
         run_args.append("riv-run")
-        if riv_args is not None and len(riv_args) > 0:
-            run_args.extend(riv_args.split())
-        result = subprocess.run(run_args)
-        if result.returncode != 0:
-            raise Exception(f"Error processing replay: {str(result.stderr)}")
-
-        outcard_raw = open(outcard_path, 'rb').read()
-        os.remove(outcard_path)
-
-        outhash = bytes.fromhex(open(outhash_path, 'r').read())
-        os.remove(outhash_path)
-
-        screenshot = open(screenshot_path,'rb').read()
-        os.remove(screenshot_path)
-
-        return outcard_raw, outhash, screenshot
-
-    # use rivemu
-    replay_temp = tempfile.NamedTemporaryFile()
-    replay_file = replay_temp.file
-    incard_temp = tempfile.NamedTemporaryFile()
-    incard_file = incard_temp.file
-    outcard_temp = tempfile.NamedTemporaryFile()
-    outhash_temp = tempfile.NamedTemporaryFile(mode='w+')
-    screenshot_temp = tempfile.NamedTemporaryFile()
-
-    replay_file.write(log)
-    replay_file.flush()
-    
-    if in_card is not None and len(in_card) > 0:
-        incard_file.write(in_card)
-        incard_file.flush()
-
-    incard_path = len(in_card) > 0 and incard_temp.name or None
-
-    absolute_cartridge_path = os.path.abspath(f"{AppSettings.cartridges_path}/{cartridge_id}")
-    cwd = str(Path(AppSettings.rivemu_path).parent.parent.absolute())
-    run_args = []
-    run_args.append(AppSettings.rivemu_path)
-    run_args.append(f"-cartridge={absolute_cartridge_path}")
-    run_args.append(f"-verify={replay_temp.name}")
-    run_args.append(f"-save-outcard={outcard_temp.name}")
-    run_args.append(f"-save-outhash={outhash_temp.name}")
-    run_args.append(f"-speed=1000000")
-    run_args.append(f"-save-screenshot={screenshot_temp.name}")
-    if in_card is not None and len(in_card):
-        run_args.append(f"-load-incard={incard_temp.name}")
+    else:
+        cwd = str(Path(AppSettings.rivemu_path).parent.parent.absolute())
     if riv_args is not None and len(riv_args) > 0:
         run_args.extend(riv_args.split())
+    if cancel is None:
+        return subprocess.run(run_args, cwd=cwd)
+    process = subprocess.Popen(run_args, cwd=cwd)
+    while True:
+        try:
+            process.wait(timeout=CANCEL_POLL_INTERVAL)
+            return subprocess.CompletedProcess(run_args, process.returncode)
+        except subprocess.TimeoutExpired:
+            if cancel.is_set():
+                process.kill()
+                process.wait()
+                raise Exception("Emulator run cancelled")
+
+def _riv_get_cartridge_screenshot(cartridge_id,frame):
+    with riv_run_dir() as run_dir:
+        screenshot_path = f"{run_dir}/screenshot"
+
+        run_args = _riv_base_args(cartridge_id)
+        run_args.extend(_riv_option("save-screenshot",screenshot_path))
+        run_args.extend(_riv_option("stop-frame",f"{frame}"))
+        result = _riv_run(run_args,None)
+        if result.returncode != 0:
+            raise Exception(f"Error getting screenshot: {str(result.stderr)}")
+
+        with open(screenshot_path,'rb') as f:
+            return f.read()
+
+def _replay_log(cartridge_id,log,riv_args,in_card,cancel=None):
+    with riv_run_dir() as run_dir:
+        replay_path = f"{run_dir}/replaylog"
+        outcard_path = f"{run_dir}/outcard"
+        incard_path = f"{run_dir}/incard"
+        outhash_path = f"{run_dir}/outhash"
+        screenshot_path = f"{run_dir}/screenshot"
+
+        with open(replay_path,'wb') as f:
+            f.write(log)
+
+        run_args = _riv_base_args(cartridge_id)
+        if AppSettings.rivemu_path is None: # use riv os
+            run_args.extend(["--setenv", "RIV_REPLAYLOG", replay_path])
+            run_args.extend(["--setenv", "RIV_OUTCARD", outcard_path])
+            run_args.extend(["--setenv", "RIV_OUTHASH", outhash_path])
+            run_args.extend(["--setenv", "RIV_SAVE_SCREENSHOT", screenshot_path])
+            if in_card is not None and len(in_card) > 0:
+                run_args.extend(["--setenv", "RIV_INCARD", incard_path])
+        else:
+            run_args.append(f"-verify={replay_path}")
+            run_args.append(f"-save-outcard={outcard_path}")
+            run_args.append(f"-save-outhash={outhash_path}")
+            run_args.append(f"-speed=1000000")
+            run_args.append(f"-save-screenshot={screenshot_path}")
+            if in_card is not None and len(in_card) > 0:
+                run_args.append(f"-load-incard={incard_path}")
 
-    result = subprocess.run(run_args, cwd=cwd)
-    if result.returncode != 0:
-        raise Exception(f"Error processing replay: {str(result.stderr)}")
+        if in_card is not None and len(in_card) > 0:
+            with open(incard_path,'wb') as f:
+                f.write(in_card)
 
-    outcard_raw = outcard_temp.file.read()
-    outhash = bytes.fromhex(outhash_temp.file.read())
-    screenshot = screenshot_temp.file.read()
+        result = _riv_run(run_args,riv_args,cancel)
+        if result.returncode != 0:
+            raise Exception(f"Error processing replay: {str(result.stderr)}")
 
-    replay_temp.close()
-    outcard_temp.close()
-    incard_temp.close()
-    outhash_temp.close()
-    screenshot_temp.close()
+        with open(outcard_path,'rb') as f:
+            outcard_raw = f.read()
+        with open(outhash_path,'r') as f:
+            outhash = bytes.fromhex(f.read())
+        with open(screenshot_path,'rb') as f:
+            screenshot = f.read()
 
-    return outcard_raw, outhash, screenshot
+        return outcard_raw, outhash, screenshot
 
-def riv_get_cartridge_outcard(cartridge_id,frame,riv_args,in_card):
-    if AppSettings.rivemu_path is None: # use riv os
-        
-        outcard_path = "/run/outcard"
-        incard_path = "/run/incard"
-        
-        if os.path.exists(outcard_path): os.remove(outcard_path)
+def _riv_get_cartridge_outcard(cartridge_id,frame,riv_args,in_card):
+    with riv_run_dir() as run_dir:
+        outcard_path = f"{run_dir}/outcard"
+        incard_path = f"{run_dir}/incard"
+
+        run_args = _riv_base_args(cartridge_id)
+        run_args.extend(_riv_option("stop-frame",f"{frame}"))
+        if AppSettings.rivemu_path is None: # use riv os
+            run_args.extend(["--setenv", "RIV_OUTCARD", outcard_path])
+            if in_card is not None and len(in_card) > 0:
+                run_args.extend(["--setenv", "RIV_INCARD", incard_path])
+        else:
+            run_args.append(f"-save-outcard={outcard_path}")
+            if in_card is not None and len(in_card) > 0:
+                run_args.append(f"-load-incard={incard_path}")
 
         if in_card is not None and len(in_card) > 0:
-            incard_file = open(incard_path,'wb')
-            incard_file.write(in_card)
-            incard_file.close()
-
-        run_args = []
-        run_args.append("riv-chroot")
-        run_args.append("/rivos")
-        run_args.extend(["--setenv", "RIV_CARTRIDGE", f"/{AppSettings.cartridges_path}/{cartridge_id}"])
-        run_args.extend(["--setenv", "RIV_NO_YIELD", "y"])
-        run_args.extend(["--setenv", "RIV_STOP_FRAME", f"{frame}"])
-        run_args.extend(["--setenv", "RIV_OUTCARD", outcard_path])
-        if in_card is not None and len(in_card) > 0:
-            run_args.extend(["--setenv", "RIV_INCARD", incard_path])
-        run_args.append("riv-run")
-        if riv_args is not None and len(riv_args) > 0:
-            run_args.extend(riv_args.split())
-        result = subprocess.run(run_args)
-        
+            with open(incard_path,'wb') as f:
+                f.write(in_card)
+
+        result = _riv_run(run_args,riv_args)
         if result.returncode != 0:
             raise Exception(f"Error running cartridge: {str(result.stderr)}")
 
-        outcard_file = open(outcard_path, 'rb')
-        outcard_raw = outcard_file.read()
-
-        return outcard_raw
-            
-    # use rivemu
-    incard_temp = tempfile.NamedTemporaryFile()
-    incard_file = incard_temp.file
-    outcard_temp = tempfile.NamedTemporaryFile()
-    outcard_file = outcard_temp.file
-
-    if in_card is not None and len(in_card) > 0:
-        incard_file.write(in_card)
-        incard_file.flush()
-
-    incard_path = in_card is not None and len(in_card) > 0 and incard_temp.name or None
-
-    absolute_cartridge_path = os.path.abspath(f"{AppSettings.cartridges_path}/{cartridge_id}")
-    cwd = str(Path(AppSettings.rivemu_path).parent.parent.absolute())
-    run_args = []
-    run_args.append(AppSettings.rivemu_path)
-    run_args.append(f"-cartridge={absolute_cartridge_path}")
-    run_args.append(f"-save-outcard={outcard_temp.name}")
-    if in_card is not None and len(in_card):
-        run_args.append(f"-load-incard={incard_temp.name}")
-    run_args.append(f"-stop-frame={frame}")
-    if riv_args is not None and len(riv_args) > 0:
-        run_args.extend(riv_args.split())
-
-    result = subprocess.run(run_args, cwd=cwd)
-    if result.returncode != 0:
-        raise Exception(f"Error running cartridge: {str(result.stderr)}")
-
-    outcard_raw = outcard_file.read()
-
-    outcard_temp.close()
-    incard_temp.close()
-
-    return outcard_raw
+        with open(outcard_path,'rb') as f:
+            return f.read()
+
+def replay_log_many(jobs,max_workers=None,return_exceptions=False):
+    """
+    Verify a batch of replays concurrently.
+
+    Each job is a (cartridge_id, log, riv_args, in_card) tuple. Results are
+    returned in job order. With return_exceptions the exception of a failed
+    job is returned in its place instead of being raised.
+    """
+    jobs = list(jobs)
+    if max_workers is None:
+        max_workers = AppSettings.riv_max_parallel or os.cpu_count() or 1
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1,min(max_workers,len(jobs) or 1))) as executor:
+        futures = [executor.submit(replay_log,*job) for job in jobs]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                if not return_exceptions:
+                    for f in futures: f.cancel()
+                    raise
+                results.append(e)
+    return results
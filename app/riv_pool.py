@@ -0,0 +1,276 @@
+"""
+Pool of resident emulator workers
+
+Each worker is a long-lived process that takes jobs as JSON lines on its
+stdin and answers one JSON line per job on its stdout. New workers are
+health checked once, dead ones are replaced before a job, and workers are
+recycled after a failed job or a configurable number of jobs. When the pool
+can't serve a job the callers fall back to the one-shot path.
+
+The bundled `app.riv_worker` still starts one emulator per job, as riv-run
+has no resident mode, so it saves no emulator startup: `python -m
+benchmarks.riv_pool` shows it adds the protocol round trip to each job.
+The pool is off by default, and pays off with a worker command
+(`AppSettings.riv_worker_command`) for an emulator build that keeps
+running between jobs.
+"""
+import atexit
+import base64
+import json
+import logging
+import subprocess
+import sys
+import threading
+
+from .settings import AppSettings
+
+LOGGER = logging.getLogger(__name__)
+
+CANCEL_POLL_INTERVAL = 0.05 # seconds between checks of a cancel event
+
+
+class RivWorkerUnavailable(Exception):
+    """
+    The pool couldn't get a healthy worker to run the job.
+    """
+
+
+def encode_message(message: dict) -> bytes:
+    """
+    Encode a protocol message as a JSON line, with bytes as base64.
+    """
+    encoded = {}
+    for k, v in message.items():
+        if isinstance(v, (bytes, bytearray, memoryview)):
+            v = {'b64': base64.b64encode(v).decode('ascii')}
+        elif isinstance(v, (list, tuple)):
+            v = [
+                {'b64': base64.b64encode(x).decode('ascii')}
+                if isinstance(x, (bytes, bytearray, memoryview)) else x
+                for x in v
+            ]
+        encoded[k] = v
+    return json.dumps(encoded).encode('utf-8') + b'\n'
+
+
+def decode_message(line: bytes) -> dict:
+    """
+    Decode a protocol message encoded with `encode_message`.
+    """
+    def _decode(v):
+        if isinstance(v, dict) and 'b64' in v:
+            return base64.b64decode(v['b64'])
+        if isinstance(v, list):
+            return [_decode(x) for x in v]
+        return v
+    return {k: _decode(v) for k, v in json.loads(line).items()}
+
+
+class RivWorker:
+    def __init__(self, command: list[str]):
+        self.command = command
+        self.jobs = 0
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def request(self, op: str, **params) -> dict:
+        if not self.alive():
+            raise RivWorkerUnavailable(f"Worker {self.process.pid} is not running")
+        try:
+            self.process.stdin.write(encode_message({'op': op, **params}))
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (BrokenPipeError, OSError) as e:
+            raise RivWorkerUnavailable(f"Worker {self.process.pid} pipe error: {e}")
+        if not line:
+            raise RivWorkerUnavailable(f"Worker {self.process.pid} closed its pipe")
+        return decode_message(line)
+
+    def ping(self) -> bool:
+        try:
+            return self.request('ping').get('result') == 'pong'
+        except RivWorkerUnavailable:
+            return False
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self):
+        if self.alive():
+            try:
+                self.process.stdin.write(encode_message({'op': 'exit'}))
+                self.process.stdin.flush()
+                self.process.wait(timeout=1)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+
+def _kill_on_cancel(worker: RivWorker, cancel: threading.Event, finished: threading.Event):
+    while not finished.is_set():
+        if cancel.wait(CANCEL_POLL_INTERVAL):
+            if not finished.is_set():
+                worker.process.kill()
+            return
+
+
+class RivWorkerPool:
+    def __init__(self, size: int, max_jobs: int, command: list[str]):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.command = command
+        self._workers = []
+        self._idle = []
+        self._lock = threading.Condition()
+        self._closed = False
+
+    def _spawn(self) -> RivWorker:
+        try:
+            worker = RivWorker(self.command)
+        except OSError as e:
+            raise RivWorkerUnavailable(f"Couldn't start worker: {e}")
+        if not worker.ping():
+            worker.close()
+            raise RivWorkerUnavailable("New worker failed its health check")
+        LOGGER.info(f"Started emulator worker {worker.process.pid}")
+        return worker
+
+    def _acquire(self) -> RivWorker:
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise RivWorkerUnavailable("Worker pool is closed")
+                if self._idle:
+                    worker = self._idle.pop()
+                    break
+                if len(self._workers) < self.size:
+                    # reserve the slot while spawning outside the lock
+                    worker = None
+                    self._workers.append(worker)
+                    break
+                self._lock.wait()
+
+        # a dead worker shows up here; one that hangs fails its job and is recycled
+        if worker is not None and worker.alive():
+            return worker
+
+        if worker is not None:
+            LOGGER.warning(f"Emulator worker {worker.process.pid} exited, replacing it")
+            worker.close()
+        try:
+            new_worker = self._spawn()
+        except RivWorkerUnavailable:
+            with self._lock:
+                self._workers.remove(worker)
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._workers[self._workers.index(worker)] = new_worker
+        return new_worker
+
+    def _release(self, worker: RivWorker, healthy: bool = True):
+        recycle = not healthy or not worker.alive() or self.max_jobs > 0 and worker.jobs >= self.max_jobs
+        with self._lock:
+            if recycle or self._closed:
+                if worker in self._workers:
+                    self._workers.remove(worker)
+            else:
+                self._idle.append(worker)
+            self._lock.notify()
+        if recycle or self._closed:
+            LOGGER.info(f"Recycling emulator worker {worker.process.pid} after {worker.jobs} jobs")
+            worker.close()
+
+    def run(self, op: str, cancel: threading.Event | None = None, **params):
+        """
+        Run a job on an idle worker and return its result.
+
+        Errors raised by the job itself are re-raised as `Exception` with the
+        worker's message, like the one-shot path does. Setting the `cancel`
+        event kills the worker running the job.
+        """
+        worker = self._acquire()
+        healthy = True
+        watcher = None
+        if cancel is not None:
+            finished = threading.Event()
+            watcher = threading.Thread(target=_kill_on_cancel, args=(worker, cancel, finished), daemon=True)
+            watcher.start()
+        try:
+            if cancel is not None and cancel.is_set():
+                raise Exception("Emulator run cancelled")
+            response = worker.request(op, **params)
+        except RivWorkerUnavailable:
+            healthy = False
+            if cancel is not None and cancel.is_set():
+                raise Exception("Emulator run cancelled")
+            raise
+        finally:
+            if watcher is not None:
+                finished.set()
+                watcher.join()
+            worker.jobs += 1
+            self._release(worker, healthy)
+
+        if response.get('error') is not None:
+            raise Exception(response['error'])
+        result = response.get('result')
+        if isinstance(result, list):
+            return tuple(result)
+        return result
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            workers = [w for w in self._workers if w is not None]
+            self._workers = []
+            self._idle = []
+            self._lock.notify_all()
+        for worker in workers:
+            worker.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_worker_settings() -> dict:
+    """
+    The AppSettings values, so workers run jobs with the dapp's settings.
+    """
+    return {
+        k: v for k, v in vars(AppSettings).items()
+        if not k.startswith('_') and isinstance(v, (str, int, float, bool, list, tuple, type(None)))
+    }
+
+
+def get_worker_command() -> list[str]:
+    if AppSettings.riv_worker_command is not None:
+        return AppSettings.riv_worker_command.split()
+    return [sys.executable, '-m', 'app.riv_worker', '--settings', json.dumps(get_worker_settings())]
+
+
+def get_worker_pool() -> RivWorkerPool | None:
+    """
+    Return the shared worker pool, or None if worker mode is disabled.
+    """
+    global _pool
+    if AppSettings.riv_worker_pool_size <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = RivWorkerPool(
+                size=AppSettings.riv_worker_pool_size,
+                max_jobs=AppSettings.riv_worker_max_jobs,
+                command=get_worker_command()
+            )
+            atexit.register(_pool.close)
+    return _pool
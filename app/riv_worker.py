@@ -0,0 +1,86 @@
+"""
+Resident emulator worker
+
+Serves the `riv_pool` protocol: one JSON line per job on stdin, one JSON
+line per result on stdout. riv-run has no resident job mode, so this
+reference worker still runs one emulator invocation per job, but it keeps
+the process and its imports warm. An emulator build with a resident mode
+can be plugged in through `AppSettings.riv_worker_command`.
+
+Run with `python -m app.riv_worker [--settings JSON] [--rivemu-path PATH] [--cartridges-path PATH]`,
+where --settings holds AppSettings values, as `riv_pool.get_worker_command` passes them.
+"""
+import argparse
+import json
+import os
+import sys
+
+from .settings import AppSettings
+from .riv_pool import encode_message, decode_message
+from . import riv
+
+
+def handle(message: dict) -> dict:
+    op = message.get('op')
+    if op == 'ping':
+        return {'result': 'pong'}
+    if op == 'replay_log':
+        result = riv._replay_log(
+            message['cartridge_id'],
+            message['log'],
+            message.get('riv_args'),
+            message.get('in_card') or b''
+        )
+        return {'result': list(result)}
+    if op == 'outcard':
+        result = riv._riv_get_cartridge_outcard(
+            message['cartridge_id'],
+            message['frame'],
+            message.get('riv_args'),
+            message.get('in_card') or b''
+        )
+        return {'result': result}
+    if op == 'screenshot':
+        result = riv._riv_get_cartridge_screenshot(
+            message['cartridge_id'],
+            message['frame']
+        )
+        return {'result': result}
+    return {'error': f"Unknown operation {op}"}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--settings', default='{}')
+    parser.add_argument('--rivemu-path', default=None)
+    parser.add_argument('--cartridges-path', default=None)
+    args = parser.parse_args()
+
+    for name, value in json.loads(args.settings).items():
+        setattr(AppSettings, name, value)
+    if args.rivemu_path is not None:
+        AppSettings.rivemu_path = args.rivemu_path
+    if args.cartridges_path is not None:
+        AppSettings.cartridges_path = args.cartridges_path
+    # worker mode must never recurse into the pool
+    AppSettings.riv_worker_pool_size = 0
+
+    # keep the protocol on a private fd so emulator output can't corrupt it
+    protocol_in = sys.stdin.buffer
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    for line in protocol_in:
+        message = decode_message(line)
+        if message.get('op') == 'exit':
+            break
+        try:
+            response = handle(message)
+        except Exception as e:
+            response = {'error': str(e)}
+        protocol_out.write(encode_message(response))
+        protocol_out.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+from pydantic import BaseModel
+import logging
+from typing import Optional, List
+
+from cartesi.abi import String, Bytes32, UInt, Address
+
+from cartesapp.storage import Entity, helpers
+from cartesapp.context import get_metadata
+from cartesapp.input import mutation, query
+from cartesapp.output import output, add_output, event, emit_event
+from cartesapp.utils import hex2bytes
+
+from .settings import AppSettings
+from .common import screenshot_add_score, get_cid
+
+LOGGER = logging.getLogger(__name__)
+
+
+###
+# Model
+
+class PendingScoreCard(Entity):
+    id              = helpers.PrimaryKey(int, auto=True)
+    cartridge_id    = helpers.Required(str, 64, index=True)
+    gameplay_hash   = helpers.Required(str, 64)
+    user_address    = helpers.Required(str, 42)
+    user_alias      = helpers.Required(str)
+    game            = helpers.Required(str)
+    score           = helpers.Required(int)
+    screenshot      = helpers.Required(bytes, lazy=True)
+    tags            = helpers.Required(helpers.Json)
+    created_at      = helpers.Required(int)
+
+
+# Inputs
+
+class RenderScoreCardsPayload(BaseModel):
+    max_renders:    UInt
+
+class PendingScoreCardsPayload(BaseModel):
+    cartridge_id:   Optional[str]
+    page:           Optional[int]
+    page_size:      Optional[int]
+
+
+# Outputs
+
+@event()
+class ScoreCardRendered(BaseModel):
+    cartridge_id:   Bytes32
+    user_address:   Address
+    gameplay_hash:  Bytes32
+    timestamp:      UInt
+    screenshot_cid: String
+
+class PendingScoreCardInfo(BaseModel):
+    id: UInt
+    cartridge_id: String
+    gameplay_hash: String
+    user_address: String
+    score: int
+    created_at: UInt
+
+@output()
+class PendingScoreCardsOutput(BaseModel):
+    data:   List[PendingScoreCardInfo]
+    total:  UInt
+    page:   UInt
+
+
+###
+# Mutations
+
+@mutation()
+def render_score_cards(payload: RenderScoreCardsPayload) -> bool:
+    rendered = render_pending_score_cards(payload.max_renders)
+    LOGGER.info(f"Rendered {rendered} pending score cards")
+    return True
+
+
+###
+# Queries
+
+@query()
+def pending_score_cards(payload: PendingScoreCardsPayload) -> bool:
+    pending_query = PendingScoreCard.select()
+
+    if payload.cartridge_id is not None:
+        pending_query = pending_query.filter(lambda r: r.cartridge_id == payload.cartridge_id)
+
+    pending_query = pending_query.order_by(PendingScoreCard.id)
+
+    total = pending_query.count()
+
+    page = 1
+    if payload.page is not None:
+        page = payload.page
+        if payload.page_size is not None:
+            pending = pending_query.page(payload.page,payload.page_size)
+        else:
+            pending = pending_query.page(payload.page)
+    else:
+        pending = pending_query.fetch()
+
+    dict_list_result = [r.to_dict() for r in pending]
+
+    LOGGER.info(f"Returning {len(dict_list_result)} of {total} pending score cards")
+
+    out = PendingScoreCardsOutput.parse_obj({'data':dict_list_result,'total':total,'page':page})
+
+    add_output(out)
+
+    return True
+
+
+###
+# Helpers
+
+def submit_score_card(screenshot: bytes, game: str, score: int, user_alias: str,
+                      cartridge_id: str, gameplay_hash: str, tags: list) -> str:
+    """
+    Render and output the score card now, or queue it in deferred mode.
+
+    Returns the screenshot CID, or an empty string if the render was
+    deferred. Deferred renders emit ScoreCardRendered with the CID later.
+    """
+    if AppSettings.score_card_render_mode != 'deferred' or \
+            PendingScoreCard.select().count() >= AppSettings.score_card_max_pending:
+        # a full queue falls back to rendering now, so it can't grow unbounded
+        final_screenshot = screenshot_add_score(screenshot,game,score,user_alias)
+        cid = get_cid(final_screenshot)
+        add_output(final_screenshot,tags=tags)
+        return cid
+
+    metadata = get_metadata()
+    PendingScoreCard(
+        cartridge_id = cartridge_id,
+        gameplay_hash = gameplay_hash,
+        user_address = metadata.msg_sender.lower(),
+        user_alias = user_alias,
+        game = game,
+        score = score,
+        screenshot = screenshot,
+        tags = tags,
+        created_at = metadata.timestamp
+    )
+    return ''
+
+
+def render_pending_score_cards(max_renders: int) -> int:
+    """
+    Render up to max_renders queued score cards, oldest first.
+
+    Cards that fail to render are logged and dropped, so a bad card can't
+    reject the input that renders it and stay at the head of the queue.
+    Returns how many cards were rendered.
+    """
+    if max_renders <= 0:
+        return 0
+    metadata = get_metadata()
+    pending = PendingScoreCard.select().order_by(PendingScoreCard.id)[:max_renders]
+    rendered = 0
+    for r in pending:
+        try:
+            final_screenshot = screenshot_add_score(r.screenshot,r.game,r.score,r.user_alias)
+            cid = get_cid(final_screenshot)
+        except Exception as e:
+            LOGGER.error(f"Dropping score card {r.id} of gameplay {r.gameplay_hash}: {e}")
+            r.delete()
+            continue
+        add_output(final_screenshot,tags=r.tags)
+        rendered_event = ScoreCardRendered(
+            cartridge_id = hex2bytes(r.cartridge_id),
+            user_address = r.user_address,
+            gameplay_hash = hex2bytes(r.gameplay_hash),
+            timestamp = metadata.timestamp,
+            screenshot_cid = cid
+        )
+        emit_event(rendered_event,tags=['score_card',r.cartridge_id,r.gameplay_hash])
+        r.delete()
+        rendered += 1
+    return rendered
@@ -17,8 +17,10 @@ from cartesapp.utils import hex2bytes, str2bytes, bytes2str
 
 from .settings import AppSettings
 from .riv import replay_log, riv_get_cartridge_outcard
-from .cartridge import Cartridge
-from .common import ScoreType, GameplayHash, screenshot_add_score, get_cid
+from .cartridge import Cartridge, cartridge_image
+from .common import ScoreType, GameplayHash
+from .score_card import submit_score_card, render_pending_score_cards
+from .pagination import check_page, decode_cursor, fetch_page, page_cursor
 from .cartridge import Cartridge
 
 LOGGER = logging.getLogger(__name__)
@@ -39,6 +41,7 @@ class Scoreboard(Entity):
     score_function  = helpers.Required(str)
     # config          = helpers.Optional(helpers.Json) # TODO: e.g. max scores...
     scores          = helpers.Set("Score")
+    helpers.composite_index(cartridge_id, created_at, id)
 
 class Score(Entity):
     id              = helpers.PrimaryKey(int, auto=True)
@@ -47,6 +50,7 @@ class Score(Entity):
     timestamp       = helpers.Required(int)
     score           = helpers.Required(int)
     scoreboard      = helpers.Required(Scoreboard, index=True)
+    helpers.composite_index(scoreboard, score) # scores listing order, ties are ordered by the query
 
 # @seed()
 # def initialize_data():
@@ -94,11 +98,15 @@ class ScoreboardsPayload(BaseModel):
     name:           Optional[str]
     page:           Optional[int]
     page_size:      Optional[int]
+    cursor:         Optional[str] # next_cursor of the previous page, empty for the first page
+    with_total:     Optional[bool] # also count the total when paging by cursor
 
 class ScoresPayload(BaseModel):
     scoreboard_id:  str
     page:           Optional[int]
     page_size:      Optional[int]
+    cursor:         Optional[str] # next_cursor of the previous page, empty for the first page
+    with_total:     Optional[bool] # also count the total when paging by cursor
 
 # Outputs
 
@@ -144,14 +152,16 @@ class ScoreInfo(BaseModel):
 @output()
 class ScoreboardsOutput(BaseModel):
     data:   List[ScoreboardInfo]
-    total:  UInt
+    total:  Optional[UInt]
     page:   UInt
+    next_cursor: Optional[str]
 
 @output()
 class ScoresOutput(BaseModel):
     data:   List[ScoreInfo]
-    total:  UInt
+    total:  Optional[UInt]
     page:   UInt
+    next_cursor: Optional[str]
 
 ###
 # Mutations
@@ -177,7 +187,8 @@ def create_scoreboard(payload: CreateScoreboardPayload) -> bool:
     # run cartridge to test args, incard and get outcard
     LOGGER.info(f"Running cartridge test")
     try:
-        outcard_raw = riv_get_cartridge_outcard(payload.cartridge_id.hex(),0,payload.args,payload.in_card)
+        with cartridge_image(payload.cartridge_id.hex()):
+            outcard_raw = riv_get_cartridge_outcard(payload.cartridge_id.hex(),0,payload.args,payload.in_card)
     except Exception as e:
         msg = f"Couldn't run cartridge test: {e}"
         LOGGER.error(msg)
@@ -286,7 +297,8 @@ def scoreboard_replay(replay: ScoreboardReplayPayload) -> bool:
     # process replay
     LOGGER.info(f"Processing scoreboard replay...")
     try:
-        outcard_raw, outhash, screenshot = replay_log(scoreboard.cartridge_id,replay.log,scoreboard.args,scoreboard.in_card)
+        with cartridge_image(scoreboard.cartridge_id):
+            outcard_raw, outhash, screenshot = replay_log(scoreboard.cartridge_id,replay.log,scoreboard.args,scoreboard.in_card)
     except Exception as e:
         msg = f"Couldn't replay log: {e}"
         LOGGER.error(msg)
@@ -342,8 +354,14 @@ def scoreboard_replay(replay: ScoreboardReplayPayload) -> bool:
         scoreboard = scoreboard
     )
 
-    final_screenshot = screenshot_add_score(screenshot,cartridge.name,score,user_alias)
-    cid = get_cid(final_screenshot)
+    add_output(replay.log,tags=['replay',scoreboard.cartridge_id,replay.scoreboard_id.hex()])
+
+    cid = submit_score_card(
+        screenshot,cartridge.name,score,user_alias,
+        cartridge_id=scoreboard.cartridge_id,
+        gameplay_hash=gameplay_hash.hexdigest(),
+        tags=['screenshot',scoreboard.cartridge_id]
+    )
 
     replay_score = ScoreboardReplayScore(
         cartridge_id = hex2bytes(scoreboard.cartridge_id),
@@ -353,15 +371,16 @@ def scoreboard_replay(replay: ScoreboardReplayPayload) -> bool:
         score = default_score,
         extra_score = score,
         scoreboard_id = replay.scoreboard_id.hex(),
+        screenshot_cid = cid,
         gameplay_hash = gameplay_hash.digest()
     )
 
-    add_output(replay.log,tags=['replay',scoreboard.cartridge_id,replay.scoreboard_id.hex()])
-    add_output(final_screenshot,tags=['screenshot',replay.cartridge_id.hex()])
     emit_event(replay_score,tags=['score',scoreboard.cartridge_id,replay.scoreboard_id.hex()])
 
     GameplayHash.add(scoreboard.cartridge_id,gameplay_hash.hexdigest())
 
+    render_pending_score_cards(AppSettings.score_card_render_budget)
+
     return True
 
 ###
@@ -374,15 +393,37 @@ def scoreboards(payload: ScoreboardsPayload) -> bool:
     if payload.name is not None:
         scoreboards_query = scoreboards_query.filter(lambda r: payload.name in r.name)
 
-    total = scoreboards_query.count()
+    scoreboards_query = scoreboards_query.order_by(Scoreboard.created_at, Scoreboard.id)
+
+    try:
+        check_page(payload.page, payload.page_size)
+        cursor_values = decode_cursor(payload.cursor, int, str) if payload.cursor else None
+    except Exception as e:
+        msg = f"Couldn't list scoreboards: {e}"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
+
+    total = None
+    if payload.cursor is None or payload.with_total:
+        total = scoreboards_query.count()
 
     page = 1
-    if payload.page is not None:
+    next_cursor = None
+    if payload.cursor is not None:
+        if cursor_values is not None:
+            last_created_at, last_id = cursor_values
+            scoreboards_query = scoreboards_query.filter(
+                lambda r: r.created_at >= last_created_at and (r.created_at > last_created_at or r.id > last_id)
+            )
+        scoreboards, next_cursor = fetch_page(scoreboards_query, payload.page_size, lambda r: (r.created_at, r.id))
+    elif payload.page is not None:
         page = payload.page
         if payload.page_size is not None:
             scoreboards = scoreboards_query.page(payload.page,payload.page_size)
         else:
             scoreboards = scoreboards_query.page(payload.page)
+        next_cursor = page_cursor(scoreboards, page, payload.page_size, total, lambda r: (r.created_at, r.id))
     else:
         scoreboards = scoreboards_query.fetch()
     
@@ -391,7 +432,7 @@ def scoreboards(payload: ScoreboardsPayload) -> bool:
 
     LOGGER.info(f"Returning {len(dict_list_result)} of {total} scoreboards")
     
-    out = ScoreboardsOutput.parse_obj({'data':dict_list_result,'total':total,'page':page})
+    out = ScoreboardsOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
     
     add_output(out)
 
@@ -407,19 +448,40 @@ def scores(payload: ScoresPayload) -> bool:
         add_output(msg,tags=['error'])
         return False
 
+    # ties go to the earliest score
     scores_query = Score. \
         select(lambda r: r.scoreboard == scoreboard). \
-        order_by(helpers.desc(Score.score))
+        order_by(helpers.desc(Score.score), Score.id)
+
+    try:
+        check_page(payload.page, payload.page_size)
+        cursor_values = decode_cursor(payload.cursor, int, int) if payload.cursor else None
+    except Exception as e:
+        msg = f"Couldn't list scores: {e}"
+        LOGGER.error(msg)
+        add_output(msg,tags=['error'])
+        return False
 
-    total = scores_query.count()
+    total = None
+    if payload.cursor is None or payload.with_total:
+        total = scores_query.count()
 
     page = 1
-    if payload.page is not None:
+    next_cursor = None
+    if payload.cursor is not None:
+        if cursor_values is not None:
+            last_score, last_id = cursor_values
+            scores_query = scores_query.filter(
+                lambda r: r.score <= last_score and (r.score < last_score or r.id > last_id)
+            )
+        scores, next_cursor = fetch_page(scores_query, payload.page_size, lambda r: (r.score, r.id))
+    elif payload.page is not None:
         page = payload.page
         if payload.page_size is not None:
             scores = scores_query.page(payload.page,payload.page_size)
         else:
             scores = scores_query.page(payload.page)
+        next_cursor = page_cursor(scores, page, payload.page_size, total, lambda r: (r.score, r.id))
     else:
         scores = scores_query.fetch()
     
@@ -428,7 +490,7 @@ def scores(payload: ScoresPayload) -> bool:
     
     LOGGER.info(f"Returning {len(dict_list_result)} of {total} scores")
     
-    out = ScoresOutput.parse_obj({'data':dict_list_result,'total':total,'page':page})
+    out = ScoresOutput.parse_obj({'data':dict_list_result,'total':total,'page':page,'next_cursor':next_cursor})
     
     add_output(out)
 
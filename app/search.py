@@ -0,0 +1,319 @@
+"""
+In-memory ranked search over cartridge text
+
+Documents are split into lowercase word tokens. Each token keeps the
+documents it appears in, grouped by the summed weight of the fields it
+appears in. A trigram index over the token vocabulary finds the tokens that
+contain a query term, so partial words match without scanning every
+document.
+
+A query matches the documents that contain every one of its terms, as a
+whole word, a word prefix or a word substring, and ranks them by the field
+weights of the matched words and the rarity of the terms. Field weights
+and match kinds only take a few values, so matches are scored and ranked
+as sets of documents sharing a score instead of one document at a time.
+The matches of recent terms and queries are cached until the index
+changes, so paging through results or refining a query doesn't match its
+terms again.
+
+Terms are combined starting from the rarest one. A term matching many times
+more documents is looked up in the tokens of the remaining documents
+instead of listing all of its own. Listing a single term stops once the
+page is full when the caller doesn't need the total. Counting every match
+of a broad term, or combining several broad terms, still goes through
+tens of thousands of documents at 100k cartridges, tens of milliseconds,
+see `benchmarks/search.py`.
+"""
+import math
+import re
+from collections import OrderedDict
+from bisect import bisect_left, insort
+
+TOKEN_RE = re.compile(r'\w+')
+
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.75
+SUBSTRING_MATCH = 0.5
+
+TERM_CACHE_SIZE = 256
+# look a term up in the candidate documents when it matches this many times more
+PROBE_RATIO = 16
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def _trigrams(token: str) -> set[str]:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class SearchIndex:
+    def __init__(self, field_weights: dict[str, float]):
+        self.field_weights = field_weights
+        self._postings = {} # token -> {weight: set of doc_ids}
+        self._trigrams = {} # trigram -> set of tokens
+        self._vocabulary = [] # sorted tokens, for short prefixes
+        self._docs = {} # doc_id -> (sort key, ((token, weight), ...))
+        self._order = [] # sorted (sort key, doc_id), for ranking ties
+        self._term_cache = OrderedDict() # term -> matches, several terms -> buckets
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._docs
+
+    def add(self, doc_id, fields: dict[str, str], sort_key: str = ''):
+        """
+        Index a document, replacing it if it was already indexed.
+        """
+        if doc_id in self._docs:
+            self.remove(doc_id)
+        self._term_cache.clear()
+        weights = {}
+        for field, text in fields.items():
+            field_weight = self.field_weights.get(field, 0)
+            if not text or not field_weight:
+                continue
+            for token in tokenize(text):
+                weights[token] = weights.get(token, 0) + field_weight
+        for token, weight in weights.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                insort(self._vocabulary, token)
+                for trigram in _trigrams(token):
+                    self._trigrams.setdefault(trigram, set()).add(token)
+            postings.setdefault(weight, set()).add(doc_id)
+        self._docs[doc_id] = (sort_key, tuple(weights.items()))
+        insort(self._order, (sort_key, doc_id))
+
+    def remove(self, doc_id):
+        entry = self._docs.pop(doc_id, None)
+        if entry is None:
+            return
+        self._term_cache.clear()
+        sort_key, weights = entry
+        del self._order[bisect_left(self._order, (sort_key, doc_id))]
+        for token, weight in weights:
+            postings = self._postings[token]
+            postings[weight].discard(doc_id)
+            if not postings[weight]:
+                del postings[weight]
+            if postings:
+                continue
+            del self._postings[token]
+            del self._vocabulary[bisect_left(self._vocabulary, token)]
+            for trigram in _trigrams(token):
+                tokens = self._trigrams[trigram]
+                tokens.discard(token)
+                if not tokens:
+                    del self._trigrams[trigram]
+
+    def _match_tokens(self, term: str) -> list[tuple[str, float]]:
+        """
+        Return the indexed tokens that match a query term, with the weight
+        of the kind of match.
+        """
+        matches = []
+        if term in self._postings:
+            matches.append((term, EXACT_MATCH))
+        if len(term) < 3:
+            # too short for trigrams, match word prefixes only
+            i = bisect_left(self._vocabulary, term)
+            while i < len(self._vocabulary) and self._vocabulary[i].startswith(term):
+                if self._vocabulary[i] != term:
+                    matches.append((self._vocabulary[i], PREFIX_MATCH))
+                i += 1
+            return matches
+        trigram_tokens = sorted(
+            (self._trigrams.get(trigram, set()) for trigram in _trigrams(term)),
+            key=len
+        )
+        for token in set.intersection(*trigram_tokens):
+            if token == term or term not in token:
+                continue
+            matches.append((token, PREFIX_MATCH if token.startswith(term) else SUBSTRING_MATCH))
+        return matches
+
+    def _term_matches(self, term: str) -> '_TermMatches':
+        """
+        Return the postings matching a term, grouped by score. Grouping
+        only looks at the posting lists, not at the documents in them, so
+        it stays cheap for terms matching most documents. The matches are
+        shared with the cache and must not be modified.
+        """
+        matches = self._term_cache.get(term)
+        if matches is not None:
+            self._term_cache.move_to_end(term)
+            return matches
+        token_weights = dict(self._match_tokens(term))
+        by_score = {}
+        size = 0
+        for token, match_weight in token_weights.items():
+            for weight, doc_ids in self._postings[token].items():
+                by_score.setdefault(match_weight * weight, []).append(doc_ids)
+                size += len(doc_ids)
+        # a document can match with several tokens, so this is an upper
+        # bound, good enough to tell rare terms from common ones
+        size = min(size, len(self._docs))
+        # terms matching fewer documents weigh more
+        idf = math.log(1 + len(self._docs) / size) if size else 0
+        matches = _TermMatches(
+            size,
+            [(score * idf, postings) for score, postings in sorted(by_score.items(), reverse=True)],
+            token_weights,
+            idf,
+        )
+        self._cache(term, matches)
+        return matches
+
+    def _iter_term_buckets(self, matches: '_TermMatches'):
+        """
+        Yield the documents matching a term as disjoint (score, documents)
+        buckets, best first. A document takes the score of its best
+        matching token.
+        """
+        if matches.buckets is not None:
+            yield from matches.buckets
+            return
+        seen = set()
+        for score, postings in matches.groups:
+            docs = set().union(*postings)
+            if seen:
+                docs -= seen
+            if docs:
+                yield score, docs
+                seen |= docs
+
+    def _term_buckets(self, matches: '_TermMatches') -> list[tuple[float, set]]:
+        if matches.buckets is None:
+            matches.buckets = list(self._iter_term_buckets(matches))
+        return matches.buckets
+
+    def _doc_score(self, doc_id, matches: '_TermMatches') -> float:
+        token_weights = matches.token_weights
+        score = max(
+            (token_weights[token] * weight for token, weight in self._docs[doc_id][1] if token in token_weights),
+            default=0
+        )
+        return score * matches.idf
+
+    def _cache(self, key, value):
+        self._term_cache[key] = value
+        if len(self._term_cache) > TERM_CACHE_SIZE:
+            self._term_cache.popitem(last=False)
+
+    def _buckets(self, terms: list[str], within: set | None) -> list[tuple[float, set]]:
+        """
+        Return the documents matching every term as disjoint (score,
+        documents) buckets, best first.
+        """
+        key = tuple(terms)
+        if within is None and key in self._term_cache:
+            self._term_cache.move_to_end(key)
+            return self._term_cache[key]
+        terms = sorted((self._term_matches(term) for term in terms), key=lambda matches: matches.size)
+        buckets = self._term_buckets(terms[0])
+        if within is not None:
+            # scores don't depend on the other documents, so filtering
+            # before combining them doesn't change the ranking
+            buckets = [(score, docs & within) for score, docs in buckets]
+        for other in terms[1:]:
+            candidates = sum(len(docs) for _, docs in buckets)
+            # round so equal sums land in the same bucket
+            by_score = {}
+            if other.buckets is None and other.size > PROBE_RATIO * candidates:
+                # look the rarer matches up in their documents instead of
+                # listing every document of a common term
+                for score, docs in buckets:
+                    for doc_id in docs:
+                        other_score = self._doc_score(doc_id, other)
+                        if other_score:
+                            by_score.setdefault(round(score + other_score, 9), set()).add(doc_id)
+            else:
+                for score, docs in buckets:
+                    for other_score, other_docs in self._term_buckets(other):
+                        both = docs & other_docs
+                        if both:
+                            by_score.setdefault(round(score + other_score, 9), set()).update(both)
+            buckets = list(by_score.items())
+            if not buckets:
+                break
+        buckets = sorted(buckets, key=lambda bucket: bucket[0], reverse=True)
+        if within is None and len(key) > 1:
+            self._cache(key, buckets)
+        return buckets
+
+    def _first_in_order(self, doc_ids: set, n: int) -> list:
+        """
+        Return the first n documents by sort key.
+        """
+        if len(doc_ids) ** 2 > n * len(self._order):
+            # dense enough that walking the global order finds them sooner
+            found = []
+            for _, doc_id in self._order:
+                if doc_id in doc_ids:
+                    found.append(doc_id)
+                    if len(found) == n:
+                        break
+            return found
+        return sorted(doc_ids, key=lambda doc_id: (self._docs[doc_id][0], doc_id))[:n]
+
+    def search(self, query: str, offset: int = 0, limit: int | None = None,
+               within: set | None = None, count: bool = True) -> tuple[int | None, list]:
+        """
+        Return the number of documents matching every query term, and the
+        ids of `limit` of them after the first `offset`, best ranked first.
+        Ties are ordered by the documents' sort keys. `within` restricts
+        the search to a set of document ids.
+
+        Without `count` the number is None, and a single term query stops
+        listing its matches once the page is full. Counting still goes
+        through every match, so a term found in most documents costs tens
+        of milliseconds at 100k documents.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return (0 if count else None), []
+        if len(terms) == 1 and (not count and limit is not None):
+            buckets = self._iter_term_buckets(self._term_matches(terms[0]))
+            if within is not None:
+                buckets = ((score, docs & within) for score, docs in buckets)
+        else:
+            buckets = self._buckets(terms, within)
+        if limit is None:
+            limit = sum(len(docs) for _, docs in buckets)
+        total = 0
+        ranked = []
+        for _, docs in buckets:
+            if len(ranked) >= limit and not count:
+                break
+            total += len(docs)
+            if len(ranked) >= limit:
+                continue
+            if offset >= len(docs):
+                offset -= len(docs)
+                continue
+            ranked.extend(self._first_in_order(docs, offset + limit - len(ranked))[offset:])
+            offset = 0
+        return (total if count else None), ranked
+
+
+class _TermMatches:
+    """
+    The postings matching a query term: an upper bound of the number of
+    documents it matches, the postings grouped by score, best first, the
+    weight of the kind of match of each matching token, the weight of the
+    term's rarity, and the documents by score once they have been listed.
+    """
+    __slots__ = ('size', 'groups', 'token_weights', 'idf', 'buckets')
+
+    def __init__(self, size: int, groups: list[tuple[float, list[set]]],
+                 token_weights: dict[str, float], idf: float):
+        self.size = size
+        self.groups = groups
+        self.token_weights = token_weights
+        self.idf = idf
+        self.buckets = None
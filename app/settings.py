@@ -1,7 +1,7 @@
 # App Framework settings
 
 # Files with definitions to import
-FILES = ['setup','cartridge','replay','scoreboard'] # * Required
+FILES = ['setup','cartridge','cartridge_upload','replay','scoreboard','score_card'] # * Required
 
 # Index outputs in inspect indexer queries
 INDEX_OUTPUTS = True # Defaul: False
@@ -22,3 +22,35 @@ class AppSettings:
     developer_fee = 0.1
     treasury_fee = 0.025
     token_decimals = 6
+    riv_worker_pool_size = 0 # 0 disables the resident worker pool
+    riv_worker_max_jobs = 100 # recycle workers after this many jobs (0 never)
+    riv_worker_command = None # default: python -m app.riv_worker
+    riv_run_path = None # parent of per-run dirs (default: /run on riv os, /dev/shm on rivemu)
+    riv_max_parallel = None # replay_log_many concurrency (default: cpu count)
+    riv_emulator_files = None # files that version the emulator (default: rivemu binary)
+    test_replay_path = 'misc/test.rivlog'
+    gameplay_filter_capacity = 1024 # first slice of the per cartridge gameplay filters
+    gameplay_filter_error_rate = 0.01
+    score_card_format = 'png' # png or webp (lossless)
+    score_card_resample = 'nearest' # nearest or bicubic
+    score_card_palette = True # palette png
+    score_card_compress_level = 9 # zlib level
+    score_card_compress_type = 'default' # zlib strategy: default, filtered, huffman_only, rle, fixed
+    score_card_render_mode = 'inline' # inline or deferred
+    score_card_render_budget = 0 # pending score cards rendered at the end of each replay input
+    score_card_max_pending = 1000 # deferred cards queued before falling back to inline renders
+    bonding_curve_engine = 'float' # engine of new cartridges: float or fixed
+    cover_thumbnail_sizes = (64, 128, 256)
+    cover_batch_max = 100 # covers per cartridge_covers query
+    price_quote_cache_size = 4096 # cached (curve, supply) price quotes
+    cartridge_trade_max_copies = 100 # copies bought or sold in a single input
+    price_ladder_default_points = 100
+    price_ladder_max_points = 1000
+    cartridge_chunk_size = 256 * 1024 # bytes per cartridge_chunks output
+    cartridge_store = 'file' # file, or chunks to deduplicate images with content defined chunks
+    cartridge_materialized_max = 16 # chunk store images kept reassembled for the emulator
+    cartridge_validation_max = 256 # cached validation results, kept after their cartridge is removed
+    cartridge_upload_max_size = 32 * 1024 * 1024
+    cartridge_upload_max_chunk_size = 1024 * 1024
+    cartridge_upload_max_sessions = 4 # uploads in progress per user
+    cartridge_upload_ttl = 86400 # seconds an upload is kept without receiving chunks
@@ -3,10 +3,24 @@ from cartesapp.setup import setup
 from .settings import AppSettings
 
 DEFAULT_TOKEN_ADDR = '0x1c7D4B196Cb0C7B01d743Fbc6116a902379C7238'
+RIVOS_EMULATOR_FILES = ['/rivos/usr/sbin/riv-run', '/rivos/usr/lib/libriv.so']
 
 
 @setup()
 def setup_rivemu():
     AppSettings.rivemu_path = os.getenv('RIVEMU_PATH')
+    if AppSettings.rivemu_path is None: # use riv os
+        AppSettings.riv_emulator_files = RIVOS_EMULATOR_FILES
     AppSettings.token_addr = os.getenv('TOKEN_ADDR', DEFAULT_TOKEN_ADDR)
     AppSettings.token_decimals = int(os.getenv('TOKEN_DECIMALS', '6'))
+    AppSettings.riv_worker_pool_size = int(os.getenv('RIV_WORKER_POOL_SIZE', '0'))
+    AppSettings.riv_worker_max_jobs = int(os.getenv('RIV_WORKER_MAX_JOBS', '100'))
+    AppSettings.riv_worker_command = os.getenv('RIV_WORKER_COMMAND')
+    AppSettings.riv_run_path = os.getenv('RIV_RUN_PATH')
+    AppSettings.score_card_render_mode = os.getenv('SCORE_CARD_RENDER_MODE', 'inline')
+    AppSettings.score_card_render_budget = int(os.getenv('SCORE_CARD_RENDER_BUDGET', '0'))
+    AppSettings.score_card_max_pending = int(os.getenv('SCORE_CARD_MAX_PENDING', '1000'))
+    AppSettings.bonding_curve_engine = os.getenv('BONDING_CURVE_ENGINE', 'float')
+    AppSettings.cartridge_store = os.getenv('CARTRIDGE_STORE', 'file')
+    if os.getenv('RIV_MAX_PARALLEL') is not None:
+        AppSettings.riv_max_parallel = int(os.getenv('RIV_MAX_PARALLEL'))
@@ -0,0 +1,42 @@
+"""
+Bonding curve per call cost
+
+Run from the repository root with `python -m benchmarks.bonding_curve`
+"""
+import timeit
+
+from app import bonding_curve
+
+FEES = [0.1, 0.025]
+CURVES = [
+    ('linear', dict(int_exponent=1000)),
+    ('square', dict(int_exponent=2000)),
+    ('x^1.5', dict(int_exponent=1500)),
+    ('x^1.234', dict(int_exponent=1234)),
+]
+
+
+def bench_engines(number: int = 2000):
+    for name, curve in CURVES:
+        params = dict(
+            int_base_price=10 * 10**6,
+            initial_supply=100,
+            int_smoothing=5000,
+            fees=FEES,
+            **curve
+        )
+        for engine in bonding_curve.PRICE_ENGINES:
+            get_prices = bonding_curve.get_prices_engine(engine)
+
+            def run():
+                # distinct supplies, so the fixed engine's root cache is cold
+                bonding_curve._scaled_root.cache_clear()
+                for supply in range(number):
+                    get_prices(total_supply=supply, **params)
+
+            seconds = min(timeit.repeat(run, number=1, repeat=3)) / number
+            print(f"{name:>8} {engine:>6}: {seconds * 1e6:.1f} us/call")
+
+
+if __name__ == '__main__':
+    bench_engines()
@@ -0,0 +1,80 @@
+"""
+Cartridge listing owner counts: counting rows per cartridge vs the stored
+supply counters read for the whole page
+
+Fills an in-memory sqlite database with 10k cartridges and 1M copies, and
+times the supply and owned copies lookups of one listing page.
+
+Run from the repository root with `python -m benchmarks.cartridge_listing`
+"""
+import json
+import random
+import timeit
+
+from app.cartridge import (
+    Cartridge, CartridgeUser, check_supply_counters, get_owner_counts, get_prices_supply_for_cartridge
+)
+from cartesapp.storage import helpers
+
+CARTRIDGES = 10_000
+COPIES = 1_000_000
+USERS = 1_000
+OWNER = '0x%040x' % 7
+
+
+def populate(db):
+    rng = random.Random(0)
+    ids = ['%064x' % i for i in range(CARTRIDGES)]
+    connection = db.get_connection()
+    connection.executemany(
+        f'INSERT INTO "{Cartridge._table_}" '
+        '(id, name, user_address, info, cover, created_at, base_price, initial_supply, smoothing_factor, exponent, curve_engine, total_supply) '
+        "VALUES (?, ?, ?, ?, x'', 0, 10000000, 10, 5000, 2000, 'float', 0)",
+        [(cartridge_id, f'Cartridge {i}', OWNER, json.dumps({'name': f'Cartridge {i}', 'tags': []}))
+         for i, cartridge_id in enumerate(ids)]
+    )
+    # skewed like real listings: a few cartridges hold most copies
+    weights = [1 / (i + 1) for i in range(CARTRIDGES)]
+    connection.executemany(
+        f'INSERT INTO "{CartridgeUser._table_}" (cartridge, user_address) VALUES (?, ?)',
+        zip(rng.choices(ids, weights=weights, k=COPIES),
+            ('0x%040x' % rng.randrange(USERS) for _ in range(COPIES)))
+    )
+    helpers.commit()
+    check_supply_counters(rebuild=True)
+    helpers.commit()
+
+
+def counted(cartridges):
+    for cartridge in cartridges:
+        get_prices_supply_for_cartridge(cartridge, total_supply=cartridge.cartridge_owners.count())
+        cartridge.cartridge_owners.select(lambda co: co.user_address == OWNER).count()
+
+
+def counters(cartridges):
+    supplies, owned_copies = get_owner_counts([c.id for c in cartridges], OWNER)
+    for cartridge in cartridges:
+        get_prices_supply_for_cartridge(cartridge, total_supply=supplies[cartridge.id])
+        owned_copies[cartridge.id]
+
+
+def main(page_size: int = 100, number: int = 5):
+    db = Cartridge._database_
+    if db.provider is None:
+        db.bind(provider='sqlite', filename=':memory:')
+        db.generate_mapping(create_tables=True)
+
+    with helpers.db_session:
+        populate(db)
+
+    for page in (1, CARTRIDGES // page_size // 2):
+        for name, fn in (('counted', counted), ('counters', counters)):
+            def run():
+                with helpers.db_session:
+                    fn(Cartridge.select().order_by(Cartridge.id).page(page, page_size))
+            seconds = min(timeit.repeat(run, number=number, repeat=3)) / number
+            print(f"page {page:>3} {name:>14}: {seconds * 1000:.1f} ms/page")
+
+
+if __name__ == '__main__':
+    main()
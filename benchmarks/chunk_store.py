@@ -0,0 +1,62 @@
+"""
+Cartridge image deduplication with content defined chunks
+
+Reports the bytes the chunk store keeps for the bundled `misc/*.sqfs`
+images, alone and together with a rebuilt version of each image (same
+files, new superblock timestamp), and the chunking throughput.
+
+Run from the repository root with `python -m benchmarks.chunk_store`
+"""
+import glob
+import random
+import struct
+import time
+
+from app.chunk_store import chunk_hashes, chunk_boundaries, MIN_SIZE, AVG_SIZE, MAX_SIZE
+
+CHUNK_SIZES = [
+    (256, 1024, 8192),
+    (MIN_SIZE, AVG_SIZE, MAX_SIZE),
+    (4096, 16384, 65536),
+]
+
+
+def rebuilt(image: bytes) -> bytes:
+    """
+    The image mksquashfs would make from the same files at a later time.
+    """
+    data = bytearray(image)
+    mtime, = struct.unpack_from('<I', data, 8)
+    struct.pack_into('<I', data, 8, mtime + 86400)
+    return bytes(data)
+
+
+def stored_bytes(images: list[bytes], min_size: int, avg_size: int, max_size: int) -> tuple[int, int]:
+    chunks = {}
+    for image in images:
+        for chunk_id, chunk in chunk_hashes(image, min_size=min_size, avg_size=avg_size, max_size=max_size):
+            chunks[chunk_id] = len(chunk)
+    return sum(chunks.values()), len(chunks)
+
+
+def main():
+    images = [open(path, 'rb').read() for path in sorted(glob.glob('misc/*.sqfs'))]
+    sets = [
+        ('bundled', images),
+        ('bundled + rebuilt', images + [rebuilt(image) for image in images]),
+    ]
+    for min_size, avg_size, max_size in CHUNK_SIZES:
+        for name, image_set in sets:
+            raw = sum(len(image) for image in image_set)
+            stored, count = stored_bytes(image_set, min_size, avg_size, max_size)
+            print(f"chunks {min_size}/{avg_size}/{max_size} {name:>18}: {len(image_set)} images, "
+                  f"{raw} bytes in {stored} bytes ({count} chunks), saved {100 * (1 - stored / raw):.1f}%")
+
+    data = random.Random(0).randbytes(8 << 20)
+    start = time.perf_counter()
+    chunk_boundaries(data)
+    print(f"chunking throughput: {8 / (time.perf_counter() - start):.1f} MiB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Scores listing pages: OFFSET pagination vs keyset cursors
+
+Fills an in-memory sqlite database with a scoreboard of 1M scores, and
+times fetching the first and a deep page of the `scores` query both ways.
+
+Run from the repository root with `python -m benchmarks.pagination`
+"""
+import random
+import timeit
+
+from cartesapp.storage import helpers
+
+from app.scoreboard import Scoreboard, Score, ScoresPayload, scores
+from app.pagination import encode_cursor
+
+SCORES = 1_000_000
+PAGE_SIZE = 100
+SCOREBOARD_ID = '%064x' % 1
+
+
+def populate(db):
+    rng = random.Random(0)
+    Scoreboard(
+        id=SCOREBOARD_ID, name='bench', cartridge_id='%064x' % 2, created_by='0x%040x' % 3,
+        created_at=0, args='', in_card=b'', score_function='score'
+    )
+    helpers.commit()
+    connection = db.get_connection()
+    connection.executemany(
+        f'INSERT INTO "{Score._table_}" (user_address, user_alias, timestamp, score, scoreboard) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (('0x%040x' % rng.randrange(10_000), 'player', i, rng.randrange(100_000), SCOREBOARD_ID)
+         for i in range(SCORES))
+    )
+    helpers.commit()
+
+
+def deep_cursor(page: int) -> str:
+    """
+    The cursor a client walking the pages would hold before `page`.
+    """
+    last = Score.select(lambda r: r.scoreboard.id == SCOREBOARD_ID). \
+        order_by(helpers.desc(Score.score), Score.id)[(page - 1) * PAGE_SIZE - 1:(page - 1) * PAGE_SIZE][0]
+    return encode_cursor(last.score, last.id)
+
+
+def main(number: int = 5):
+    db = Score._database_
+    if db.provider is None:
+        db.bind(provider='sqlite', filename=':memory:')
+        db.generate_mapping(create_tables=True)
+
+    with helpers.db_session:
+        populate(db)
+
+    deep_page = SCORES // PAGE_SIZE // 10
+    with helpers.db_session:
+        cursors = {1: '', deep_page: deep_cursor(deep_page)}
+
+    for page in (1, deep_page):
+        payloads = (
+            ('offset', ScoresPayload(scoreboard_id=SCOREBOARD_ID, page=page, page_size=PAGE_SIZE)),
+            ('cursor', ScoresPayload(scoreboard_id=SCOREBOARD_ID, cursor=cursors[page], page_size=PAGE_SIZE)),
+            ('cursor + total', ScoresPayload(scoreboard_id=SCOREBOARD_ID, cursor=cursors[page], page_size=PAGE_SIZE, with_total=True)),
+        )
+        for name, payload in payloads:
+            def run():
+                with helpers.db_session:
+                    scores(payload)
+            seconds = min(timeit.repeat(run, number=number, repeat=3)) / number
+            print(f"page {page:>5} {name:>14}: {seconds * 1000:.1f} ms/page")
+
+
+if __name__ == '__main__':
+    main()
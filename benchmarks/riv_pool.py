@@ -0,0 +1,67 @@
+"""
+Replay jobs: one-shot emulator runs vs the resident worker pool
+
+Runs replay_log against a stub emulator, a shell script that writes the
+outcard, outhash and screenshot files, so the numbers are the per-job
+overhead around the emulator: the one-shot path, and the pool with the
+bundled worker, which also starts one emulator per job.
+
+Run from the repository root with `python -m benchmarks.riv_pool`
+"""
+import os
+import random
+import stat
+import tempfile
+import time
+
+from app import riv
+from app.riv_pool import RivWorkerPool, get_worker_command
+from app.settings import AppSettings
+
+JOBS = 200
+LOG_SIZE = 64 * 1024
+
+STUB_EMULATOR = """#!/bin/sh
+for arg in "$@"; do
+    case "$arg" in
+        -save-outcard=*) printf 'JSON{"score": 1}' > "${arg#*=}" ;;
+        -save-outhash=*) printf '%064d' 0 > "${arg#*=}" ;;
+        -save-screenshot=*) : > "${arg#*=}" ;;
+    esac
+done
+"""
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        emulator = os.path.join(tmp, 'bin', 'rivemu')
+        os.makedirs(os.path.dirname(emulator))
+        with open(emulator, 'w') as f:
+            f.write(STUB_EMULATOR)
+        os.chmod(emulator, os.stat(emulator).st_mode | stat.S_IEXEC)
+        AppSettings.rivemu_path = emulator
+        AppSettings.riv_run_path = tmp
+
+        log = random.Random(0).randbytes(LOG_SIZE)
+        start = time.perf_counter()
+        for _ in range(JOBS):
+            riv._replay_log('cartridge', log, '', b'')
+        one_shot = (time.perf_counter() - start) / JOBS
+        print(f"one-shot:           {one_shot * 1000:.2f} ms/job")
+
+        pool = RivWorkerPool(size=1, max_jobs=0, command=get_worker_command())
+        try:
+            start = time.perf_counter()
+            pool.run('ping')
+            print(f"worker startup:     {(time.perf_counter() - start) * 1000:.2f} ms")
+            start = time.perf_counter()
+            for _ in range(JOBS):
+                pool.run('replay_log', cartridge_id='cartridge', log=log, riv_args='', in_card=b'')
+            pooled = (time.perf_counter() - start) / JOBS
+        finally:
+            pool.close()
+        print(f"pool (1 worker):    {pooled * 1000:.2f} ms/job ({(pooled - one_shot) * 1000:+.2f} ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Score card rendering microbenchmark
+
+Run from the repository root with `python -m benchmarks.score_card`
+"""
+import io
+import random
+import timeit
+
+from PIL import Image
+
+from app.common import ScoreCardRenderer
+
+ENCODINGS = [
+    ('previous (bicubic, rgba, level 6)', dict(resample='bicubic', palette=False, compress_level=6)),
+    ('nearest, rgba, level 9', dict(palette=False)),
+    ('nearest, palette, level 9', dict()),
+    ('nearest, palette, filtered', dict(compress_type='filtered')),
+    ('nearest, palette, rle', dict(compress_type='rle')),
+    ('webp lossless', dict(image_format='webp')),
+]
+
+
+SCREENSHOTS = [
+    ('16 color tiles', dict()),
+    ('128 color tiles', dict(colors=128)),
+    ('noise', dict(noise=True)),
+]
+
+
+def make_screenshot(size=(256, 256), noise=False, colors=16) -> bytes:
+    """
+    Make a screenshot: random noise, or 8x8 tiles from a palette like a
+    typical riv game screen.
+    """
+    rng = random.Random(0)
+    img = Image.new('RGB', size)
+    if noise:
+        img.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(size[0] * size[1])])
+    else:
+        palette = [tuple(rng.randrange(256) for _ in range(3)) for _ in range(colors)]
+        for y in range(0, size[1], 8):
+            for x in range(0, size[0], 8):
+                color = palette[rng.randrange(colors)] if rng.random() < 0.3 else (0, 0, 0)
+                img.paste(color, (x, y, x + 8, y + 8))
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+
+def bench_templates(number: int = 50):
+    screenshot = make_screenshot()
+    renderer = ScoreCardRenderer()
+
+    def uncached():
+        # what every replay paid before: fonts, logo and background each time
+        ScoreCardRenderer().render(screenshot, 'Snake', 12345, '0xf39F...2266')
+
+    def cached():
+        renderer.render(screenshot, 'Snake', 12345, '0xf39F...2266')
+
+    cached() # build the template
+    for name, fn in (('uncached', uncached), ('cached', cached)):
+        seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        print(f"{name:>10}: {seconds * 1000:.2f} ms/render")
+
+
+def bench_encodings(number: int = 10):
+    for screenshot_name, screenshot_kwargs in SCREENSHOTS:
+        print(screenshot_name)
+        screenshot = make_screenshot(**screenshot_kwargs)
+        for name, kwargs in ENCODINGS:
+            renderer = ScoreCardRenderer(**kwargs)
+            card = renderer.render(screenshot, 'Snake', 12345, '0xf39F...2266')
+            seconds = min(timeit.repeat(
+                lambda: renderer.render(screenshot, 'Snake', 12345, '0xf39F...2266'),
+                number=number, repeat=3)) / number
+            mode = Image.open(io.BytesIO(card)).mode
+            print(f"{name:>34}: {len(card):>7} bytes {mode:>4} {seconds * 1000:>7.2f} ms/render")
+
+
+if __name__ == '__main__':
+    bench_templates()
+    bench_encodings()
@@ -0,0 +1,100 @@
+"""
+Cartridge search latency at 100k cartridges
+
+Indexes synthetic cartridges with names, summaries, descriptions and
+authors drawn from a Zipf-like vocabulary, then times queries of different
+selectivity, for the first page and the pages after it, and for the first
+cursor page without a total.
+
+Run from the repository root with `python -m benchmarks.search`
+"""
+import itertools
+import random
+import statistics
+import time
+
+from app.search import SearchIndex
+
+FIELD_WEIGHTS = {'name': 4.0, 'authors': 2.0, 'tags': 1.5, 'summary': 1.5, 'description': 1.0}
+PAGE_SIZE = 10
+
+
+def make_vocabulary(rng: random.Random, size: int) -> list[str]:
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    return sorted(words)
+
+
+def make_documents(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng, 50000)
+    # Zipf-like word frequencies, so a few words are in most documents
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocabulary))))
+    authors = [' '.join(rng.sample(vocabulary, 2)) for _ in range(n // 20)]
+    tags = ['action', 'puzzle', 'platformer', 'arcade', 'shooter', 'racing', 'rpg', 'strategy']
+
+    def words(k):
+        return ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=k))
+
+    for i in range(n):
+        name = f"{words(2)} {i}"
+        yield f"{i:064x}", {
+            'name': name,
+            'authors': rng.choice(authors),
+            'tags': ' '.join(rng.sample(tags, 2)),
+            'summary': words(8),
+            'description': words(40),
+        }, name.lower(), vocabulary
+
+
+def bench_search(n: int = 100000, repeat: int = 20):
+    index = SearchIndex(FIELD_WEIGHTS)
+    start = time.perf_counter()
+    for doc_id, fields, sort_key, vocabulary in make_documents(n):
+        index.add(doc_id, fields, sort_key=sort_key)
+    print(f"indexed {n} cartridges in {time.perf_counter() - start:.1f} s")
+
+    rng = random.Random(1)
+    queries = [
+        ('rare word', vocabulary[-1]),
+        ('mid word', vocabulary[5000]),
+        ('common word', vocabulary[10]),
+        ('very common word', vocabulary[0]),
+        ('rare prefix', vocabulary[-2][:4]),
+        ('2 letter prefix', vocabulary[100][:2]),
+        ('substring', vocabulary[2000][1:5]),
+        ('two words', f"{vocabulary[50]} {vocabulary[3000]}"),
+        ('tag and word', f"puzzle {vocabulary[500]}"),
+        ('name', f"{n // 2}"),
+        ('random mid words', None),
+    ]
+    for label, text in queries:
+        cold = []
+        warm = []
+        uncounted = []
+        total = 0
+        for i in range(repeat):
+            q = text if text is not None else rng.choice(vocabulary[1000:20000])
+            # the first query of a term matches it, the next pages hit the cache
+            for page in range(3):
+                start = time.perf_counter()
+                total, _ = index.search(q, page * PAGE_SIZE, PAGE_SIZE)
+                (warm if page else cold).append(time.perf_counter() - start)
+            # a cartridge insert or removal clears the cache
+            index._term_cache.clear()
+            # cursor pages without a total
+            start = time.perf_counter()
+            index.search(q, 0, PAGE_SIZE + 1, count=False)
+            uncounted.append(time.perf_counter() - start)
+            index._term_cache.clear()
+        print(f"{label:>18}: {total:>6} matches, "
+              f"first page p50 {statistics.median(cold) * 1e3:6.2f} ms, "
+              f"max {max(cold) * 1e3:6.2f} ms, "
+              f"next pages p50 {statistics.median(warm) * 1e3:6.2f} ms, "
+              f"uncounted p50 {statistics.median(uncounted) * 1e3:6.2f} ms, "
+              f"max {max(uncounted) * 1e3:6.2f} ms")
+
+if __name__ == '__main__':
+    bench_search()
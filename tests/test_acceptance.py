@@ -1,11 +1,17 @@
 """
 Acceptance tests for the application requirements.
 """
+import base64
+import io
 import json
+import os
+from hashlib import sha256
 
 import pytest
+from PIL import Image
 
 from cartesapp.manager import Manager
+from cartesapp.storage import helpers
 from cartesapp.wallet.dapp_wallet import DepositErc20Payload
 
 from cartesi.testclient import TestClient
@@ -13,7 +19,20 @@ from cartesi.abi import encode_model
 from cartesi.models import ABIFunctionSelectorHeader
 
 from app.cartridge import (
-    InsertCartridgePayload, BuyCartridgePayload, SellCartridgePayload
+    InsertCartridgePayload, BuyCartridgePayload, SellCartridgePayload,
+    TradeCartridgeCopiesPayload, RemoveCartridgePayload, Cartridge,
+    CartridgeUserCopies, CartridgeThumbnail, CoverThumbnail,
+    SetCartridgeCurveEnginePayload, CartridgeValidation, check_supply_counters, validate_cartridge,
+    cartridge_image, materialize_cartridge, store_cartridge_image
+)
+import app.cartridge
+from app.settings import AppSettings
+from app.common import GameplayHash
+from app.pagination import encode_cursor
+from app.score_card import PendingScoreCard, RenderScoreCardsPayload
+from app.cartridge_upload import (
+    BeginCartridgeUploadPayload, AppendCartridgeChunkPayload,
+    CommitCartridgeUploadPayload
 )
 
 import logging
@@ -57,6 +76,14 @@ def insert_cartridge_payload() -> bytes:
     return encode_model(model, packed=False)
 
 
+def _inspect(dapp_client: TestClient, path: str) -> dict:
+    dapp_client.send_inspect(hex_payload='0x' + path.encode('ascii').hex())
+    assert dapp_client.rollup.status
+
+    report = dapp_client.rollup.reports[-1]['data']['payload']
+    return json.loads(bytes.fromhex(report[2:]).decode('utf-8'))
+
+
 def test_should_fail_insert_cartridge_without_funds(
         dapp_client: TestClient,
         insert_cartridge_payload: bytes):
@@ -137,6 +164,46 @@ def test_should_list_new_cartridge(dapp_client: TestClient):
 
 
 @pytest.mark.order(after="test_should_insert_cartridge")
+def test_should_filter_cartridges_by_every_tag(dapp_client: TestClient):
+    """
+    GIVEN The seeded cartridges
+    WHEN The cartridges are listed with several tags
+    THEN Only the cartridges with all the tags are returned
+    """
+    report = _inspect(dapp_client, 'app/cartridges?tags=platform&tags=action')
+    assert {c['name'] for c in report['data']} == {'Antcopter', 'Monky'}
+    assert report['total'] == 2
+    for cartridge in report['data']:
+        assert {'platform', 'action'} <= set(cartridge['info']['tags'])
+
+    report = _inspect(dapp_client, 'app/cartridges?tags=platform&tags=puzzle')
+    assert report['data'] == []
+    assert report['total'] == 0
+
+
+def test_should_list_compact_cartridges(dapp_client: TestClient):
+    """
+    GIVEN The seeded cartridges
+    WHEN The cartridges are listed in compact mode, or with a cover size
+    THEN Covers are left out, or replaced by thumbnails that fit the size
+    """
+    full = _inspect(dapp_client, 'app/cartridges')
+    compact = _inspect(dapp_client, 'app/cartridges?compact=true')
+    assert [c['id'] for c in compact['data']] == [c['id'] for c in full['data']]
+    for full_cartridge, cartridge in zip(full['data'], compact['data']):
+        assert cartridge['cover'] is None
+        assert cartridge['cover_cid'] == full_cartridge['cover_cid']
+        assert cartridge['info'] == full_cartridge['info']
+
+    size = min(AppSettings.cover_thumbnail_sizes)
+    thumbnails = _inspect(dapp_client, f'app/cartridges?cover_size={size}')
+    for cartridge in thumbnails['data']:
+        if cartridge['cover'] is None:
+            continue
+        thumbnail = Image.open(io.BytesIO(base64.b64decode(cartridge['cover'])))
+        assert max(thumbnail.size) <= size
+
+
 def test_should_retrieve_cartridge_metadata(dapp_client: TestClient):
 
     path = f'app/cartridge_info?id={BREAKOUT_ID}'
@@ -159,6 +226,82 @@ def test_should_retrieve_cartridge_metadata(dapp_client: TestClient):
     assert isinstance(report['total_supply'], int)
 
 
+def test_should_download_cartridge_chunks(dapp_client: TestClient):
+    with open('misc/breakout.sqfs', 'rb') as fin:
+        cartridge_data = fin.read()
+
+    path = f'app/cartridge_chunks?id={BREAKOUT_ID}&offset=1000&length=10'
+    inspect_payload = '0x' + path.encode('ascii').hex()
+    first_report = len(dapp_client.rollup.reports)
+    dapp_client.send_inspect(hex_payload=inspect_payload)
+
+    assert dapp_client.rollup.status
+
+    reports = [
+        bytes.fromhex(r['data']['payload'][2:])
+        for r in dapp_client.rollup.reports[first_report:]
+    ]
+    manifest = json.loads(reports[0].decode('utf-8'))
+    assert manifest['size'] == len(cartridge_data)
+    # the range is widened to the whole first chunk
+    assert manifest['offset'] == 0
+    assert manifest['length'] == min(manifest['chunk_size'], len(cartridge_data))
+    assert len(manifest['chunk_hashes']) == 1
+
+    chunk = b''.join(reports[1:])
+    assert chunk == cartridge_data[:manifest['length']]
+    assert sha256(chunk).hexdigest() == manifest['chunk_hashes'][0]
+
+
+@pytest.mark.order(after="test_should_download_cartridge_chunks")
+def test_materialized_image_in_use_should_not_be_evicted(dapp_client: TestClient, monkeypatch):
+    """
+    GIVEN Breakout and another cartridge stored in chunks, with a single
+        image kept materialized
+    WHEN The other image is materialized while Breakout's is in use
+    THEN Breakout's image is kept until it's released
+    """
+    monkeypatch.setattr(AppSettings, 'cartridge_materialized_max', 1)
+    with helpers.db_session:
+        other_id = helpers.select(c.id for c in Cartridge if c.id != BREAKOUT_ID).first()
+        for cartridge_id in (BREAKOUT_ID, other_id):
+            cartridge = Cartridge[cartridge_id]
+            if not cartridge.image_chunks:
+                with open(materialize_cartridge(cartridge_id), 'rb') as f:
+                    store_cartridge_image(cartridge, f.read())
+
+        with cartridge_image(BREAKOUT_ID) as breakout_path:
+            other_path = materialize_cartridge(other_id)
+            assert os.path.exists(breakout_path)
+            assert os.path.exists(other_path)
+
+        # released, the least recently used image goes
+        assert not os.path.exists(breakout_path)
+        assert os.path.exists(other_path)
+
+        # the next tests read the image directly
+        monkeypatch.undo()
+        materialize_cartridge(BREAKOUT_ID)
+
+
+@pytest.mark.order(after="test_materialized_image_in_use_should_not_be_evicted")
+def test_materialized_image_should_be_written_in_batches(dapp_client: TestClient, monkeypatch):
+    """
+    GIVEN Images stored in chunks
+    WHEN The largest is materialized a chunk at a time
+    THEN The image matches its cartridge id
+    """
+    monkeypatch.setattr(app.cartridge, 'IN_QUERY_BATCH', 1)
+    with helpers.db_session:
+        cartridge = max(
+            Cartridge.select(lambda c: c.image_chunks is not None),
+            key=lambda c: len(c.image_chunks)
+        )
+        os.remove(materialize_cartridge(cartridge.id))
+        with open(materialize_cartridge(cartridge.id), 'rb') as f:
+            assert sha256(f.read()).hexdigest() == cartridge.id
+
+
 @pytest.mark.order(after="test_should_insert_cartridge")
 def test_should_deposit_to_wallet(dapp_client: TestClient):
     # generate erc20 portal payload
@@ -410,3 +553,517 @@ def test_user_should_sell_cartridge_below_supply(
     )
 
     assert not dapp_client.rollup.status
+
+
+def _trade_breakout_copies_payload(function: str, quantity: int) -> str:
+    model = TradeCartridgeCopiesPayload(id=bytes.fromhex(BREAKOUT_ID), quantity=quantity)
+    model_bytes = encode_model(model, packed=False)
+
+    header = ABIFunctionSelectorHeader(
+        function=function,
+        argument_types=['bytes32', 'uint128']
+    ).to_bytes()
+
+    return '0x' + (header + model_bytes).hex()
+
+
+def _breakout_supply_and_copies(dapp_client: TestClient, owner: str) -> tuple:
+    report = _inspect(dapp_client, f'app/cartridge_info?id={BREAKOUT_ID}&owner={owner}')
+    return report['total_supply'], report['owned_copies']
+
+
+def _owned_breakout_copies(dapp_client: TestClient) -> int:
+    path = f'app/cartridge_info?id={BREAKOUT_ID}&owner={USER_ADDRESS}'
+    inspect_payload = '0x' + path.encode('ascii').hex()
+
+    dapp_client.send_inspect(hex_payload=inspect_payload)
+
+    report = dapp_client.rollup.reports[-1]['data']['payload']
+    report = bytes.fromhex(report[2:])
+    return json.loads(report.decode('utf-8'))['owned_copies']
+
+
+@pytest.mark.order(after="test_user_should_sell_cartridge_below_supply")
+def test_user_should_buy_many_copies(dapp_client: TestClient):
+    """
+    GIVEN The user has enough funds in his wallet
+    WHEN The user buys 3 copies of Breakout in one input
+    THEN The order succeeds and he owns 3 more copies
+    """
+    owned = _owned_breakout_copies(dapp_client)
+
+    dapp_client.send_advance(
+        hex_payload=_trade_breakout_copies_payload('app.buy_cartridge_copies', 3),
+        msg_sender=USER_ADDRESS,
+    )
+
+    assert dapp_client.rollup.status
+    assert _owned_breakout_copies(dapp_client) == owned + 3
+
+
+@pytest.mark.order(after="test_user_should_buy_many_copies")
+def test_user_should_not_sell_more_copies_than_owned(dapp_client: TestClient):
+    """
+    GIVEN The user owns 4 copies of Breakout
+    WHEN The user tries to sell 5 copies in one input
+    THEN The transaction is rejected
+    """
+    dapp_client.send_advance(
+        hex_payload=_trade_breakout_copies_payload('app.sell_cartridge_copies', 5),
+        msg_sender=USER_ADDRESS,
+    )
+
+    assert not dapp_client.rollup.status
+
+
+@pytest.mark.order(after="test_user_should_not_sell_more_copies_than_owned")
+def test_user_should_sell_many_copies(dapp_client: TestClient):
+    """
+    GIVEN The user owns 4 copies of Breakout
+    AND The total supply stays above the initial supply
+    WHEN The user sells 3 copies in one input
+    THEN The transaction succeeds
+    """
+    dapp_client.send_advance(
+        hex_payload=_trade_breakout_copies_payload('app.sell_cartridge_copies', 3),
+        msg_sender=USER_ADDRESS,
+    )
+
+    assert dapp_client.rollup.status
+    assert _owned_breakout_copies(dapp_client) == 1
+
+
+@pytest.mark.order(after="test_user_should_sell_many_copies")
+def test_supply_counters_should_follow_trades(dapp_client: TestClient):
+    """
+    GIVEN A second user with funds
+    WHEN The user buys 2 copies of Breakout in one input, sells one copy
+      and then sells their last copy
+    THEN The supply and their copies follow each trade, and no counter drifts
+    """
+    deposit = DepositErc20Payload(
+        result=True,
+        token=ERC20_USDC_ADDRESS,
+        sender=USER2_ADDRESS,
+        amount=1000 * TOKEN_DECIMALS,
+        execLayerData=b'',
+    )
+    dapp_client.send_advance(
+        hex_payload='0x' + encode_model(deposit, packed=True).hex(),
+        msg_sender=ERC20_PORTAL_ADDRESS,
+    )
+    assert dapp_client.rollup.status
+
+    supply, copies = _breakout_supply_and_copies(dapp_client, USER2_ADDRESS)
+    assert copies == 0
+
+    dapp_client.send_advance(
+        hex_payload=_trade_breakout_copies_payload('app.buy_cartridge_copies', 2),
+        msg_sender=USER2_ADDRESS,
+    )
+    assert dapp_client.rollup.status
+    assert _breakout_supply_and_copies(dapp_client, USER2_ADDRESS) == (supply + 2, 2)
+
+    sell_payload = SellCartridgePayload(id=bytes.fromhex(BREAKOUT_ID))
+    for left in (1, 0):
+        dapp_client.send_advance(
+            hex_payload=_function_call_payload('app.sell_cartridge', ['bytes32'], sell_payload),
+            msg_sender=USER2_ADDRESS,
+        )
+        assert dapp_client.rollup.status
+        assert _breakout_supply_and_copies(dapp_client, USER2_ADDRESS) == (supply + left, left)
+
+    # selling the last copy drops the counter row
+    with helpers.db_session:
+        assert CartridgeUserCopies.get(
+            cartridge=Cartridge[BREAKOUT_ID], user_address=USER2_ADDRESS.lower()
+        ) is None
+
+    assert _inspect(dapp_client, 'app/supply_counters_check')['mismatches'] == 0
+
+
+@pytest.mark.order(after="test_supply_counters_should_follow_trades")
+def test_supply_counters_check_should_detect_and_rebuild_drift(dapp_client: TestClient):
+    """
+    GIVEN The supply and the user copies counters of Breakout drifted
+    WHEN The counters are checked and then rebuilt
+    THEN Both drifts are reported and the counters match the owners again
+    """
+    supply, copies = _breakout_supply_and_copies(dapp_client, USER_ADDRESS)
+    with helpers.db_session:
+        cartridge = Cartridge[BREAKOUT_ID]
+        cartridge.total_supply += 5
+        CartridgeUserCopies.get(cartridge=cartridge, user_address=USER_ADDRESS.lower()).copies += 1
+
+    assert _inspect(dapp_client, 'app/supply_counters_check')['mismatches'] == 2
+
+    with helpers.db_session:
+        assert check_supply_counters(rebuild=True) == 2
+
+    assert _inspect(dapp_client, 'app/supply_counters_check')['mismatches'] == 0
+    assert _breakout_supply_and_copies(dapp_client, USER_ADDRESS) == (supply, copies)
+
+
+UPLOAD_CHUNK_SIZE = 2048
+
+
+@pytest.fixture()
+def upload_cartridge_data() -> bytes:
+    """
+    Breakout with a changed byte in the padding after the squashfs image,
+    a valid cartridge with a new id.
+    """
+    with open('misc/breakout.sqfs', 'rb') as fin:
+        cartridge_data = bytearray(fin.read())
+    cartridge_data[-1] = 1
+    return bytes(cartridge_data)
+
+
+def _function_call_payload(function: str, argument_types: list[str], model) -> str:
+    header = ABIFunctionSelectorHeader(
+        function=function,
+        argument_types=argument_types
+    ).to_bytes()
+    return '0x' + (header + encode_model(model, packed=False)).hex()
+
+
+def _missing_upload_chunks(dapp_client: TestClient, upload_id: int) -> list:
+    path = f'app/cartridge_upload?id={upload_id}'
+    dapp_client.send_inspect(hex_payload='0x' + path.encode('ascii').hex())
+    assert dapp_client.rollup.status
+
+    report = dapp_client.rollup.reports[-1]['data']['payload']
+    report = json.loads(bytes.fromhex(report[2:]).decode('utf-8'))
+    return report['missing_chunks']
+
+
+def test_should_upload_cartridge_in_chunks(
+        dapp_client: TestClient,
+        upload_cartridge_data: bytes):
+    """
+    GIVEN A developer with funds for the upload fee
+    WHEN The developer sends a cartridge in chunks, out of order
+    THEN The commit inserts the cartridge
+    """
+    deposit = DepositErc20Payload(
+        result=True,
+        token=ERC20_USDC_ADDRESS,
+        sender=USER2_ADDRESS,
+        amount=10 * TOKEN_DECIMALS,
+        execLayerData=b'',
+    )
+    dapp_client.send_advance(
+        hex_payload='0x' + encode_model(deposit, packed=True).hex(),
+        msg_sender=ERC20_PORTAL_ADDRESS,
+    )
+    assert dapp_client.rollup.status
+
+    chunks = [
+        upload_cartridge_data[i:i + UPLOAD_CHUNK_SIZE]
+        for i in range(0, len(upload_cartridge_data), UPLOAD_CHUNK_SIZE)
+    ]
+    begin = BeginCartridgeUploadPayload(
+        base_price=50 * TOKEN_DECIMALS,
+        initial_supply=1,
+        smoothing_factor=30,
+        exponent=2000,
+        size=len(upload_cartridge_data),
+        data_hash=sha256(upload_cartridge_data).digest(),
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        chunk_hashes=b''.join(sha256(c).digest() for c in chunks)
+    )
+    dapp_client.send_advance(
+        hex_payload=_function_call_payload(
+            'app.begin_cartridge_upload',
+            ['uint128', 'uint128', 'uint128', 'uint128', 'uint256', 'bytes32', 'uint256', 'bytes'],
+            begin
+        ),
+        msg_sender=USER2_ADDRESS
+    )
+    assert dapp_client.rollup.status
+
+    upload_id = 1
+    for index in reversed(range(len(chunks))):
+        # committing before every chunk arrived is rejected
+        dapp_client.send_advance(
+            hex_payload=_function_call_payload(
+                'app.commit_cartridge_upload', ['uint256'],
+                CommitCartridgeUploadPayload(upload_id=upload_id)
+            ),
+            msg_sender=USER2_ADDRESS
+        )
+        assert not dapp_client.rollup.status
+        assert _missing_upload_chunks(dapp_client, upload_id) == list(range(index + 1))
+
+        dapp_client.send_advance(
+            hex_payload=_function_call_payload(
+                'app.append_cartridge_chunk', ['uint256', 'uint256', 'bytes'],
+                AppendCartridgeChunkPayload(upload_id=upload_id, index=index, data=chunks[index])
+            ),
+            msg_sender=USER2_ADDRESS
+        )
+        assert dapp_client.rollup.status
+
+    dapp_client.send_advance(
+        hex_payload=_function_call_payload(
+            'app.commit_cartridge_upload', ['uint256'],
+            CommitCartridgeUploadPayload(upload_id=upload_id)
+        ),
+        msg_sender=USER2_ADDRESS
+    )
+    assert dapp_client.rollup.status
+
+    cartridge_id = sha256(upload_cartridge_data).hexdigest()
+    path = f'app/cartridge_info?id={cartridge_id}'
+    dapp_client.send_inspect(hex_payload='0x' + path.encode('ascii').hex())
+    assert dapp_client.rollup.status
+
+    report = dapp_client.rollup.reports[-1]['data']['payload']
+    report = json.loads(bytes.fromhex(report[2:]).decode('utf-8'))
+    assert report['id'] == cartridge_id
+
+
+def _set_curve_engine(dapp_client: TestClient, cartridge_id: str, curve_engine: str, msg_sender: str):
+    dapp_client.send_advance(
+        hex_payload=_function_call_payload(
+            'app.set_cartridge_curve_engine', ['bytes32', 'string'],
+            SetCartridgeCurveEnginePayload(id=bytes.fromhex(cartridge_id), curve_engine=curve_engine)
+        ),
+        msg_sender=msg_sender
+    )
+
+
+@pytest.mark.order(after="test_should_upload_cartridge_in_chunks", before="test_should_store_and_remove_cover_thumbnails")
+def test_owner_should_set_curve_engine_before_trades(
+        dapp_client: TestClient,
+        upload_cartridge_data: bytes):
+    """
+    GIVEN A cartridge without copies, with the node default curve engine
+    WHEN The owner and another user set its engine
+    THEN Only the owner can, and only to a known engine
+    """
+    cartridge_id = sha256(upload_cartridge_data).hexdigest()
+
+    _set_curve_engine(dapp_client, cartridge_id, 'fixed', USER_ADDRESS)
+    assert not dapp_client.rollup.status
+    _set_curve_engine(dapp_client, cartridge_id, 'bogus', USER2_ADDRESS)
+    assert not dapp_client.rollup.status
+    assert _inspect(dapp_client, f'app/cartridge_info?id={cartridge_id}')['curve_engine'] == AppSettings.bonding_curve_engine
+
+    _set_curve_engine(dapp_client, cartridge_id, 'fixed', USER2_ADDRESS)
+    assert dapp_client.rollup.status
+    assert _inspect(dapp_client, f'app/cartridge_info?id={cartridge_id}')['curve_engine'] == 'fixed'
+
+
+@pytest.mark.order(after="test_should_buy_cartridge")
+def test_owner_should_not_set_curve_engine_after_trades(dapp_client: TestClient):
+    with helpers.db_session:
+        owner = Cartridge[BREAKOUT_ID].user_address
+        engine = Cartridge[BREAKOUT_ID].curve_engine
+    other_engine = 'fixed' if engine == 'float' else 'float'
+
+    _set_curve_engine(dapp_client, BREAKOUT_ID, other_engine, owner)
+    assert not dapp_client.rollup.status
+    assert _inspect(dapp_client, f'app/cartridge_info?id={BREAKOUT_ID}')['curve_engine'] == engine
+
+
+def _pending_score_cards_total(dapp_client: TestClient) -> int:
+    path = f'app/pending_score_cards?cartridge_id={BREAKOUT_ID}'
+    dapp_client.send_inspect(hex_payload='0x' + path.encode('ascii').hex())
+    assert dapp_client.rollup.status
+
+    report = dapp_client.rollup.reports[-1]['data']['payload']
+    report = json.loads(bytes.fromhex(report[2:]).decode('utf-8'))
+    return report['total']
+
+
+def test_should_render_score_cards_within_budget_and_drop_bad_ones(dapp_client: TestClient):
+    """
+    GIVEN Three queued score cards, the second with a corrupt screenshot
+    WHEN A render input with a budget of two is sent
+    THEN The input succeeds, the bad card is dropped and one card is left
+    """
+    screenshot = io.BytesIO()
+    Image.new('RGB', (256, 256), '#336699').save(screenshot, format='PNG')
+    with helpers.db_session:
+        for i, data in enumerate([screenshot.getvalue(), b'not a png', screenshot.getvalue()]):
+            PendingScoreCard(
+                cartridge_id=BREAKOUT_ID,
+                gameplay_hash='%064x' % i,
+                user_address=USER_ADDRESS.lower(),
+                user_alias='user',
+                game='Breakout',
+                score=i,
+                screenshot=data,
+                tags=['score', BREAKOUT_ID],
+                created_at=0
+            )
+    assert _pending_score_cards_total(dapp_client) == 3
+
+    dapp_client.send_advance(
+        hex_payload=_function_call_payload(
+            'app.render_score_cards', ['uint256'],
+            RenderScoreCardsPayload(max_renders=2)
+        ),
+        msg_sender=USER_ADDRESS
+    )
+    assert dapp_client.rollup.status
+    assert _pending_score_cards_total(dapp_client) == 1
+
+
+@pytest.mark.order(after="test_should_upload_cartridge_in_chunks")
+def test_should_store_and_remove_cover_thumbnails(
+        dapp_client: TestClient,
+        upload_cartridge_data: bytes):
+    """
+    GIVEN The cartridge uploaded in chunks, with the same cover as Breakout
+    WHEN It is removed
+    THEN Its thumbnails go away, and the thumbnails Breakout shares stay
+    """
+    cartridge_id = sha256(upload_cartridge_data).hexdigest()
+    with helpers.db_session:
+        sizes = {t.size for t in CartridgeThumbnail.select(lambda t: t.cartridge.id == cartridge_id)}
+        assert sizes == set(AppSettings.cover_thumbnail_sizes)
+
+    dapp_client.send_advance(
+        hex_payload=_function_call_payload(
+            'app.remove_cartridge', ['bytes32'],
+            RemoveCartridgePayload(id=bytes.fromhex(cartridge_id))
+        ),
+        msg_sender=USER2_ADDRESS
+    )
+    assert dapp_client.rollup.status
+
+    with helpers.db_session:
+        assert CartridgeThumbnail.select(lambda t: t.cartridge.id == cartridge_id).count() == 0
+        # no thumbnail is left without a cartridge
+        assert CoverThumbnail.select(lambda t: t.cartridges.is_empty()).count() == 0
+        breakout_sizes = {t.size for t in Cartridge[BREAKOUT_ID].thumbnails}
+        assert breakout_sizes == set(AppSettings.cover_thumbnail_sizes)
+
+
+@pytest.mark.order(after="test_should_insert_cartridge_with_funds")
+def test_validation_cache_should_skip_runs_until_the_emulator_changes(
+        dapp_client: TestClient,
+        monkeypatch):
+    """
+    GIVEN Breakout was validated when it was inserted
+    WHEN It is validated again, then with another emulator version
+    THEN The first validation is cached, the second runs the replay once
+      and is cached again
+    """
+    replays = []
+    replay_log = app.cartridge.replay_log
+
+    def counting_replay_log(*args, **kwargs):
+        replays.append(args[0])
+        return replay_log(*args, **kwargs)
+
+    monkeypatch.setattr(app.cartridge, 'replay_log', counting_replay_log)
+    with helpers.db_session:
+        version = CartridgeValidation[BREAKOUT_ID].version
+        info, _, _ = validate_cartridge(BREAKOUT_ID)
+        assert info['name'] == 'Breakout'
+        assert replays == []
+
+        monkeypatch.setattr(app.cartridge, 'riv_get_emulator_version', lambda: '00' * 32)
+        validate_cartridge(BREAKOUT_ID)
+        assert replays == [BREAKOUT_ID]
+        assert CartridgeValidation[BREAKOUT_ID].version != version
+
+        validate_cartridge(BREAKOUT_ID)
+        assert replays == [BREAKOUT_ID]
+
+
+@pytest.mark.order(after="test_should_store_and_remove_cover_thumbnails")
+def test_removed_cartridge_should_keep_its_validation(
+        dapp_client: TestClient,
+        upload_cartridge_data: bytes,
+        monkeypatch):
+    """
+    GIVEN The cartridge uploaded in chunks was removed
+    WHEN It is validated again, as when it is inserted again
+    THEN Its validation is a cache hit and runs no replay
+    """
+    replays = []
+    monkeypatch.setattr(app.cartridge, 'replay_log', lambda *args, **kwargs: replays.append(args[0]))
+    cartridge_id = sha256(upload_cartridge_data).hexdigest()
+    with helpers.db_session:
+        assert CartridgeValidation.get(id=cartridge_id) is not None
+        info, _, _ = validate_cartridge(cartridge_id)
+        assert info['name'] == 'Breakout'
+        assert replays == []
+
+
+@pytest.mark.order(after="test_removed_cartridge_should_keep_its_validation")
+def test_validation_cache_should_evict_the_least_recently_used(
+        dapp_client: TestClient,
+        upload_cartridge_data: bytes,
+        monkeypatch):
+    """
+    GIVEN Validations of Breakout and of the removed uploaded cartridge
+    WHEN Breakout is validated with room for a single validation
+    THEN Only the validation of Breakout is kept
+    """
+    monkeypatch.setattr(AppSettings, 'cartridge_validation_max', 1)
+    with helpers.db_session:
+        validate_cartridge(BREAKOUT_ID)
+        assert CartridgeValidation.get(id=sha256(upload_cartridge_data).hexdigest()) is None
+        assert CartridgeValidation.get(id=BREAKOUT_ID) is not None
+
+
+def test_gameplay_hash_should_reject_duplicates_after_restart(dapp_client: TestClient):
+    """
+    GIVEN A gameplay submitted for Breakout
+    WHEN The same gameplay is checked, before and after the in memory
+      filters are lost in a restart
+    THEN It is a duplicate both times, and other gameplays are not
+    """
+    gameplay_hash = sha256(b'acceptance gameplay').hexdigest()
+    other_hash = sha256(b'another gameplay').hexdigest()
+    with helpers.db_session:
+        assert GameplayHash.check(BREAKOUT_ID, gameplay_hash)
+        GameplayHash.add(BREAKOUT_ID, gameplay_hash)
+        assert not GameplayHash.check(BREAKOUT_ID, gameplay_hash)
+
+    GameplayHash.filters.clear()
+    with helpers.db_session:
+        assert not GameplayHash.check(BREAKOUT_ID, gameplay_hash)
+        assert GameplayHash.check(BREAKOUT_ID, other_hash)
+        # the same gameplay of another cartridge isn't a duplicate
+        assert GameplayHash.check('00' * 32, gameplay_hash)
+
+
+@pytest.mark.order(after="test_user_should_sell_many_copies")
+def test_listing_should_count_owners_for_the_whole_page(dapp_client: TestClient):
+    """
+    GIVEN The user owns copies of Breakout only
+    WHEN The cartridges are listed, with and without the owner
+    THEN Every cartridge has the supply and owned copies of its details,
+      and the copies are left out without an owner
+    """
+    listing = _inspect(dapp_client, f'app/cartridges?owner={USER_ADDRESS}&page=1&page_size=100')
+    assert len(listing['data']) == listing['total']
+    for cartridge in listing['data']:
+        details = _inspect(dapp_client, f"app/cartridge_info?id={cartridge['id']}&owner={USER_ADDRESS}")
+        assert cartridge['total_supply'] == details['total_supply']
+        assert cartridge['owned_copies'] == details['owned_copies']
+        if cartridge['id'] != BREAKOUT_ID:
+            assert cartridge['owned_copies'] == 0
+    breakout = [c for c in listing['data'] if c['id'] == BREAKOUT_ID][0]
+    assert breakout['owned_copies'] == _owned_breakout_copies(dapp_client) > 0
+
+    listing = _inspect(dapp_client, 'app/cartridges?page=1&page_size=100')
+    assert all(c['owned_copies'] is None for c in listing['data'])
+
+
+@pytest.mark.parametrize('path', [
+    'app/cartridges?cursor=&page_size=0',
+    'app/cartridges?page=1&page_size=-1',
+    'app/cartridges?cursor=garbage!',
+    f"app/cartridges?search=breakout&cursor={encode_cursor(-1)}",
+    f"app/scoreboards?cartridge_id={BREAKOUT_ID}&cursor=garbage!",
+])
+def test_listing_should_refuse_invalid_pages(dapp_client: TestClient, path: str):
+    dapp_client.send_inspect(hex_payload='0x' + path.encode('ascii').hex())
+    assert not dapp_client.rollup.status
@@ -0,0 +1,44 @@
+from hashlib import sha256
+
+from app import bloom
+
+
+def _keys(start, end):
+    return [sha256(str(i).encode()).hexdigest() for i in range(start, end)]
+
+
+def test_should_not_have_false_negatives():
+    f = bloom.ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+    keys = _keys(0, 5000)
+    for key in keys:
+        f.add(key)
+    assert len(f.slices) > 1
+    assert len(f) == 5000
+    assert all(key in f for key in keys)
+
+
+def test_should_keep_false_positive_rate_bounded():
+    f = bloom.ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+    for key in _keys(0, 5000):
+        f.add(key)
+    false_positives = sum(key in f for key in _keys(5000, 25000))
+    assert false_positives / 20000 < 0.01
+
+
+def test_file_backed_filter_should_persist_incremental_adds(tmp_path):
+    path = str(tmp_path / 'filter.bloom')
+    f = bloom.ScalableBloomFilter(initial_capacity=100, error_rate=0.01, path=path)
+    keys = _keys(0, 500)
+    for key in keys:
+        f.add(key)
+
+    loaded = bloom.ScalableBloomFilter.load(path, initial_capacity=100, error_rate=0.01)
+    assert len(loaded) == 500
+    assert [s.bits for s in loaded.slices] == [s.bits for s in f.slices]
+    assert all(key in loaded for key in keys)
+
+    # the loaded filter stays attached to its file
+    loaded.add('extra')
+    reloaded = bloom.ScalableBloomFilter.load(path, initial_capacity=100, error_rate=0.01)
+    assert 'extra' in reloaded
+    assert len(reloaded) == 501
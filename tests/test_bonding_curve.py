@@ -1,3 +1,8 @@
+import random
+from decimal import Decimal, localcontext, ROUND_HALF_EVEN
+
+import pytest
+
 from app import bonding_curve
 
 TOKEN_DECIMALS = 10**6
@@ -73,3 +78,242 @@ def test_usdc_prices_above_initial_supply():
     assert isinstance(fees, list)
     assert buy > base_price
     assert sell < buy
+
+
+def test_prices_many_should_match_scalar_prices():
+    np = pytest.importorskip('numpy')
+    rng = random.Random(0)
+    supplies = np.arange(0, 2500)
+
+    for _ in range(50):
+        params = dict(
+            int_base_price=rng.randrange(1, 100 * TOKEN_DECIMALS),
+            initial_supply=rng.randrange(0, 1000),
+            int_smoothing=rng.randrange(1, 10000),
+            int_exponent=rng.randrange(0, 3000),
+            int_decimals=rng.choice([0, 6, 18]),
+            fees=rng.choice([[], [0.1, 0.025]]),
+        )
+        sell, buy, fees = bonding_curve.get_prices_many(total_supply=supplies, **params)
+
+        for supply in supplies[::11]:
+            expected = bonding_curve.get_prices(total_supply=int(supply), **params)
+            assert (sell[supply], buy[supply], list(fees[supply])) == expected
+
+
+def test_prices_many_should_take_parameter_arrays():
+    np = pytest.importorskip('numpy')
+    exponents = np.array([1000, 1500, 2000])
+
+    sell, buy, fees = bonding_curve.get_prices_many(
+        int_base_price=int(10 * TOKEN_DECIMALS),
+        total_supply=5000,
+        initial_supply=1000,
+        int_smoothing=5000,
+        int_exponent=exponents,
+        fees=[0.1, 0.025],
+    )
+
+    assert fees.shape == (3, 2)
+    for i, exponent in enumerate(exponents):
+        expected = bonding_curve.get_prices(
+            int(10 * TOKEN_DECIMALS),
+            total_supply=5000,
+            initial_supply=1000,
+            int_smoothing=5000,
+            int_exponent=int(exponent),
+            fees=[0.1, 0.025],
+        )
+        assert (sell[i], buy[i], list(fees[i])) == expected
+
+
+def test_prices_many_should_price_values_past_int64():
+    np = pytest.importorskip('numpy')
+    base_prices = [int(10 * TOKEN_DECIMALS), 2**64, int(3 * TOKEN_DECIMALS)]
+
+    sell, buy, fees = bonding_curve.get_prices_many(
+        int_base_price=np.array(base_prices, dtype=object),
+        total_supply=[0, 1, 2500],
+        initial_supply=1000,
+        int_smoothing=5000,
+        int_exponent=1500,
+        fees=[0.1, 0.025],
+    )
+
+    for i, (base_price, supply) in enumerate(zip(base_prices, [0, 1, 2500])):
+        expected = bonding_curve.get_prices(
+            base_price,
+            total_supply=supply,
+            initial_supply=1000,
+            int_smoothing=5000,
+            int_exponent=1500,
+            fees=[0.1, 0.025],
+        )
+        assert (sell[i], buy[i], list(fees[i])) == expected
+
+def _reference_prices(int_base_price, total_supply, initial_supply, int_smoothing,
+                      int_exponent, int_decimals=6, round_decimals=4, fees=[]):
+    """
+    Prices computed with 80 digit decimals, rounding half to even.
+    """
+    with localcontext() as ctx:
+        ctx.prec = 80
+        unit = Decimal(10) ** -round_decimals
+
+        def poly(supply):
+            if supply < initial_supply:
+                return Decimal(int_base_price // 10**int_decimals)
+            x = Decimal(supply - initial_supply)
+            x_d = x ** (Decimal(int_exponent) / 1000) if x > 0 or int_exponent > 0 else Decimal(1)
+            return Decimal(int_base_price) / Decimal(10) ** int_decimals + x_d / int_smoothing
+
+        buy = poly(total_supply).quantize(unit, ROUND_HALF_EVEN)
+        if total_supply >= initial_supply:
+            rounded_fees = [(Decimal(str(f)) * buy).quantize(unit, ROUND_HALF_EVEN) for f in fees]
+            buy += sum(rounded_fees)
+        else:
+            rounded_fees = [Decimal(0) for f in fees]
+        sell = Decimal(0)
+        if total_supply > initial_supply:
+            sell = poly(total_supply - 1).quantize(unit, ROUND_HALF_EVEN)
+
+        def final(v):
+            return int((v * Decimal(10) ** int_decimals).quantize(Decimal(1), ROUND_HALF_EVEN))
+
+        return final(sell), final(buy), [final(f) for f in rounded_fees]
+
+
+def _random_curve(rng, int_decimals=6):
+    return dict(
+        int_base_price=rng.randrange(1, 100 * TOKEN_DECIMALS),
+        total_supply=rng.randrange(0, 3000),
+        initial_supply=rng.randrange(0, 500),
+        int_smoothing=rng.randrange(1, 100000),
+        int_exponent=rng.choice([1000, 1500, 2000, rng.randrange(0, 4000)]),
+        int_decimals=int_decimals,
+        fees=rng.choice([[], [0.1, 0.025]]),
+    )
+
+
+def test_iroot_should_floor_the_root():
+    for n in [0, 1, 2, 7, 8, 9, 10**50, 3**300, 2**1000 - 1]:
+        for k in [1, 2, 3, 5, 8, 125, 1000]:
+            r, exact = bonding_curve._iroot(n, k)
+            assert r**k <= n < (r + 1)**k
+            assert exact == (r**k == n)
+
+
+def test_fixed_prices_should_round_exactly():
+    rng = random.Random(1)
+
+    for _ in range(2000):
+        params = _random_curve(rng, int_decimals=rng.choice([0, 2, 6, 18]))
+
+        assert bonding_curve.get_prices_fixed(**params) == _reference_prices(**params)
+
+
+def test_fixed_prices_should_match_float_prices():
+    rng = random.Random(2)
+    mismatches = 0
+
+    for _ in range(2000):
+        params = _random_curve(rng)
+        float_sell, float_buy, float_fees = bonding_curve.get_prices(**params)
+        sell, buy, fees = bonding_curve.get_prices_fixed(**params)
+
+        # float error can only flip roundings that are (almost) half way,
+        # one 10**-4 step per rounded value
+        step = 10**(params['int_decimals'] - 4)
+        assert abs(sell - float_sell) <= step
+        assert abs(buy - float_buy) <= step * (1 + len(fees))
+        assert all(abs(f - ff) <= step for f, ff in zip(fees, float_fees))
+        mismatches += (sell, buy, fees) != (float_sell, float_buy, float_fees)
+
+    assert mismatches <= 2000 * 0.02
+
+
+def test_fixed_prices_should_match_float_prices_on_integer_curves():
+    base_price = int(10 * TOKEN_DECIMALS)
+
+    for exponent in [1000, 2000, 3000]:
+        for supply in range(0, 3000, 37):
+            params = dict(
+                int_base_price=base_price,
+                total_supply=supply,
+                initial_supply=1000,
+                int_smoothing=5000,
+                int_exponent=exponent,
+            )
+            assert bonding_curve.get_prices_fixed(**params) == bonding_curve.get_prices(**params)
+
+
+def test_prices_engine_should_reject_unknown_engines():
+    assert bonding_curve.get_prices_engine('fixed') is bonding_curve.get_prices_fixed
+
+    with pytest.raises(Exception):
+        bonding_curve.get_prices_engine('double')
+
+
+def test_quote_cache_should_return_cached_prices():
+    cache = bonding_curve.QuoteCache(maxsize=2)
+    params = dict(
+        int_base_price=int(10 * TOKEN_DECIMALS),
+        initial_supply=1000,
+        int_smoothing=5000,
+        int_exponent=2000,
+        fees=[0.1, 0.025],
+    )
+
+    first = cache.get_prices(total_supply=5000, **params)
+    second = cache.get_prices(total_supply=5000, **params)
+
+    assert first == second == bonding_curve.get_prices(total_supply=5000, **params)
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+
+    # the fees list handed out is a copy
+    first[2].append(0)
+    assert cache.get_prices(total_supply=5000, **params)[2] == second[2]
+
+
+def test_quote_cache_should_evict_least_recently_used():
+    cache = bonding_curve.QuoteCache(maxsize=2)
+    params = dict(int_base_price=int(10 * TOKEN_DECIMALS), initial_supply=10,
+                  int_smoothing=5000, int_exponent=2000)
+
+    cache.get_prices(total_supply=1, **params)
+    cache.get_prices(total_supply=2, **params)
+    cache.get_prices(total_supply=1, **params)
+    cache.get_prices(total_supply=3, **params) # evicts supply 2
+
+    assert len(cache) == 2
+    assert cache.stats['evictions'] == 1
+    cache.get_prices(total_supply=1, **params)
+    assert cache.stats['hits'] == 2
+    cache.get_prices(total_supply=2, **params)
+    assert cache.stats['misses'] == 4
+
+
+def test_quote_cache_should_invalidate_on_fee_change():
+    cache = bonding_curve.QuoteCache()
+    params = dict(int_base_price=int(10 * TOKEN_DECIMALS), total_supply=5000,
+                  initial_supply=1000, int_smoothing=5000, int_exponent=2000)
+
+    _, buy, _ = cache.get_prices(fees=[0.1, 0.025], **params)
+    _, new_buy, _ = cache.get_prices(fees=[0.2, 0.025], **params)
+
+    assert new_buy > buy
+    assert cache.stats['invalidations'] == 1
+    assert cache.stats['hits'] == 0
+    assert len(cache) == 1
+
+
+def test_quote_cache_should_key_by_engine():
+    cache = bonding_curve.QuoteCache()
+    params = dict(int_base_price=int(10 * TOKEN_DECIMALS), total_supply=5000,
+                  initial_supply=1000, int_smoothing=5000, int_exponent=1234)
+
+    cache.get_prices(engine='float', **params)
+    cache.get_prices(engine='fixed', **params)
+
+    assert cache.stats['misses'] == 2
@@ -0,0 +1,34 @@
+import random
+
+from app import chunk_store
+
+
+def _data(n, seed=0):
+    return random.Random(seed).randbytes(n)
+
+
+def test_chunks_should_cover_data_within_size_bounds():
+    data = _data(1 << 20)
+    boundaries = chunk_store.chunk_boundaries(data)
+    assert boundaries[0][0] == 0
+    assert boundaries[-1][1] == len(data)
+    assert all(a[1] == b[0] for a, b in zip(boundaries, boundaries[1:]))
+    sizes = [end - start for start, end in boundaries]
+    assert all(chunk_store.MIN_SIZE <= size <= chunk_store.MAX_SIZE for size in sizes[:-1])
+    assert chunk_store.AVG_SIZE / 2 < len(data) / len(sizes) < chunk_store.AVG_SIZE * 2
+
+
+def test_chunks_should_survive_insertions():
+    data = _data(256 * 1024)
+    edited = data[:1000] + b'inserted bytes' + data[1000:]
+    chunks = {chunk_id for chunk_id, _ in chunk_store.chunk_hashes(data)}
+    edited_chunks = [chunk_id for chunk_id, _ in chunk_store.chunk_hashes(edited)]
+    # only the chunks around the edit change
+    assert len([chunk_id for chunk_id in edited_chunks if chunk_id not in chunks]) <= 2
+
+
+def test_chunks_should_reassemble_data():
+    data = _data(100_000, seed=1)
+    assert b''.join(chunk for _, chunk in chunk_store.chunk_hashes(data)) == data
+    assert chunk_store.chunk_boundaries(b'') == []
+    assert chunk_store.chunk_boundaries(b'x') == [(0, 1)]
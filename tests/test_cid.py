@@ -0,0 +1,64 @@
+import os
+import random
+from hashlib import sha256
+
+import base58
+
+from app import cid
+from app.protobuf_models import unixfs_pb2, merkle_dag_pb2
+
+
+def _single_block_cid(data: bytes) -> str:
+    # reference: the protobuf messages get_cid used to build
+    unixf = unixfs_pb2.Data()
+    unixf.Type = 2
+    unixf.Data = data
+    unixf.filesize = len(data)
+    mdag = merkle_dag_pb2.MerkleNode()
+    mdag.Data = unixf.SerializeToString()
+    digest = sha256(mdag.SerializeToString()).digest()
+    return base58.b58encode(b'\x12\x20' + digest).decode('utf-8')
+
+
+def test_should_match_ipfs_cid():
+    assert cid.get_cid(b'hello world\n') == 'QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o'
+
+
+def test_should_match_single_block_protobuf_encoding():
+    for size in [0, 1, 127, 128, 16384, cid.CHUNK_SIZE]:
+        data = os.urandom(size)
+        assert cid.get_cid(data) == _single_block_cid(data)
+        assert cid.get_cid(memoryview(data)) == _single_block_cid(data)
+
+
+def test_should_chunk_large_payloads():
+    data = os.urandom(cid.CHUNK_SIZE + 1)
+    assert cid.get_cid(data) != _single_block_cid(data)
+
+
+def test_streaming_should_not_depend_on_update_sizes(tmp_path):
+    data = os.urandom(3 * cid.CHUNK_SIZE + 12345)
+    rng = random.Random(0)
+    builder = cid.CidBuilder()
+    i = 0
+    while i < len(data):
+        n = rng.randrange(1, 100000)
+        builder.update(data[i:i + n])
+        i += n
+    assert builder.cid() == cid.get_cid(data)
+
+    path = tmp_path / 'payload.bin'
+    path.write_bytes(data)
+    assert cid.get_cid(str(path)) == cid.get_cid(data)
+    with open(path, 'rb') as f:
+        assert cid.get_cid(f) == cid.get_cid(data)
+
+
+def test_should_build_multi_level_dags():
+    builder = cid.CidBuilder(chunk_size=4, max_links=3)
+    builder.update(b'abcdefghijklmnopqrstuvwxyz')
+    # the 2 byte tail stays buffered until the digest
+    assert len(builder._leaves) == 6
+    assert builder.cid().startswith('Qm')
+    # 7 leaves -> 3 parents -> 1 root
+    assert len(builder._leaves) == 7
@@ -0,0 +1,46 @@
+import pytest
+
+from app import pagination
+
+
+def test_cursor_should_round_trip():
+    cursor = pagination.encode_cursor(1234, 'ab' * 32)
+    assert '=' not in cursor
+    assert pagination.decode_cursor(cursor, int, str) == [1234, 'ab' * 32]
+
+
+@pytest.mark.parametrize('cursor', ['', 'garbage!', pagination.encode_cursor(1, 2), pagination.encode_cursor(1)])
+def test_should_refuse_invalid_cursors(cursor):
+    with pytest.raises(Exception, match='Invalid cursor'):
+        pagination.decode_cursor(cursor, int, str)
+
+
+def test_fetch_page_should_return_the_next_cursor():
+    rows = list(range(25))
+    page, cursor = pagination.fetch_page(rows, 10, lambda r: (r,))
+    assert page == rows[:10]
+    assert pagination.decode_cursor(cursor, int) == [9]
+
+    page, cursor = pagination.fetch_page(rows[20:], None, lambda r: (r,))
+    assert page == rows[20:]
+    assert cursor is None
+
+
+def test_page_cursor_should_continue_after_an_offset_page():
+    rows = list(range(25))
+    cursor = pagination.page_cursor(rows[10:20], 2, 10, len(rows), lambda r: (r,))
+    assert pagination.decode_cursor(cursor, int) == [19]
+
+    assert pagination.page_cursor(rows[20:], 3, 10, len(rows), lambda r: (r,)) is None
+    assert pagination.page_cursor([], 4, 10, len(rows), lambda r: (r,)) is None
+
+
+@pytest.mark.parametrize('page, page_size', [(0, None), (-1, 10), (None, 0), (1, -5)])
+def test_should_refuse_pages_below_one(page, page_size):
+    with pytest.raises(Exception, match='Invalid page'):
+        pagination.check_page(page, page_size)
+
+
+def test_fetch_page_should_refuse_empty_pages():
+    with pytest.raises(Exception, match='Invalid page size'):
+        pagination.fetch_page(list(range(5)), 0, lambda r: (r,))
@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+import pytest
+
+from app.pipeline import run_stages
+
+
+def test_stages_should_run_concurrently():
+    def stage(value):
+        def run(cancel):
+            time.sleep(0.2)
+            return value
+        return run
+
+    start = time.monotonic()
+    results, timings = run_stages({'a': stage(1), 'b': stage(2), 'c': stage(3)})
+    elapsed = time.monotonic() - start
+
+    assert results == {'a': 1, 'b': 2, 'c': 3}
+    assert set(timings) == {'a', 'b', 'c'}
+    assert all(t >= 0.2 for t in timings.values())
+    assert elapsed < 0.2 * 2
+
+
+def test_first_failure_should_cancel_other_stages():
+    cancelled = threading.Event()
+
+    def slow(cancel):
+        cancel.wait(5)
+        if cancel.is_set():
+            cancelled.set()
+
+    def bad(cancel):
+        time.sleep(0.05)
+        raise Exception("Invalid info")
+
+    start = time.monotonic()
+    with pytest.raises(Exception, match="Invalid info"):
+        run_stages({'slow': slow, 'bad': bad})
+    assert time.monotonic() - start < 1
+    assert cancelled.wait(1)
+
+
+def test_pending_stages_should_not_start_after_a_failure():
+    started = []
+
+    def bad(cancel):
+        raise Exception("Invalid info")
+
+    def later(cancel):
+        started.append('later')
+
+    with pytest.raises(Exception, match="Invalid info"):
+        run_stages({'bad': bad, 'later': later}, max_workers=1)
+    time.sleep(0.05)
+    assert started == []
+
+
+def test_failure_should_wait_for_running_stages(tmp_path):
+    image = tmp_path / 'image'
+    image.write_bytes(b'cartridge')
+    reads = []
+
+    def replay(cancel):
+        # a stage that needs a moment to notice the cancel
+        cancel.wait(5)
+        time.sleep(0.1)
+        reads.append(image.read_bytes())
+
+    def info(cancel):
+        raise Exception("Invalid info")
+
+    with pytest.raises(Exception, match="Invalid info"):
+        run_stages({'replay': replay, 'info': info})
+    # cleaning up once run_stages returns can't race with the replay
+    os.remove(image)
+    assert reads == [b'cartridge']
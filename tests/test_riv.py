@@ -0,0 +1,127 @@
+import json
+import lzma
+import os
+import struct
+import threading
+import time
+
+import pytest
+
+from app import riv
+
+
+def test_run_dirs_should_be_isolated_and_cleaned():
+    with riv.riv_run_dir() as first, riv.riv_run_dir() as second:
+        assert first != second
+        assert os.path.isdir(first) and os.path.isdir(second)
+    assert not os.path.exists(first)
+    assert not os.path.exists(second)
+
+
+def test_replay_log_many_should_run_concurrently(monkeypatch):
+    def fake_replay_log(cartridge_id, log, riv_args, in_card):
+        time.sleep(0.2)
+        return cartridge_id, log, b''
+
+    monkeypatch.setattr(riv, 'replay_log', fake_replay_log)
+    jobs = [(f"c{i}", bytes([i]), '', b'') for i in range(8)]
+
+    start = time.monotonic()
+    results = riv.replay_log_many(jobs, max_workers=8)
+    elapsed = time.monotonic() - start
+
+    assert results == [(f"c{i}", bytes([i]), b'') for i in range(8)]
+    assert elapsed < 0.2 * 4
+
+
+def test_replay_log_many_should_report_failures(monkeypatch):
+    def fake_replay_log(cartridge_id, log, riv_args, in_card):
+        if cartridge_id == 'bad':
+            raise Exception("Error processing replay")
+        return cartridge_id
+
+    monkeypatch.setattr(riv, 'replay_log', fake_replay_log)
+    jobs = [('good', b'', '', b''), ('bad', b'', '', b'')]
+
+    results = riv.replay_log_many(jobs, return_exceptions=True)
+    assert results[0] == 'good'
+    assert isinstance(results[1], Exception)
+
+    with pytest.raises(Exception, match='Error processing replay'):
+        riv.replay_log_many(jobs)
+
+
+def test_cancelled_run_should_kill_the_emulator(monkeypatch):
+    monkeypatch.setattr(riv.AppSettings, 'rivemu_path', '/bin/sleep')
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+
+    start = time.monotonic()
+    with pytest.raises(Exception, match='cancelled'):
+        riv._riv_run(['sleep', '10'], None, cancel)
+    assert time.monotonic() - start < 1
+
+
+@pytest.mark.parametrize('image,name', [
+    ('misc/2048.sqfs', '2048'),
+    ('misc/breakout.sqfs', 'Breakout'),
+    ('misc/monky.sqfs', 'Monky'),
+])
+def test_squashfs_reader_should_read_info(image, name):
+    with riv.SquashFsImage(image) as sqfs:
+        files = sqfs.read_files(['/info.json', '/cover.png'])
+    assert json.loads(files['/info.json'])['name'] == name
+    assert files['/cover.png'] is None
+
+
+def test_squashfs_reader_should_read_multi_block_files():
+    with riv.SquashFsImage('misc/monky.sqfs') as sqfs:
+        assert sqfs.block_size == 131072
+        data = sqfs.read_files(['/monky'])['/monky']
+    assert len(data) == 271232
+    assert data[:4] == b'\x7fELF'
+
+
+def test_squashfs_reader_should_reject_other_files():
+    with pytest.raises(Exception, match='squashfs'):
+        riv.SquashFsImage('misc/test.rivlog')
+
+
+@pytest.fixture()
+def bomb_image(tmp_path):
+    """
+    A copy of monky.sqfs with an appended xz block that inflates to 64MiB,
+    and the image offset of the block.
+    """
+    with open('misc/monky.sqfs', 'rb') as fin:
+        data = bytearray(fin.read())
+    bomb = lzma.compress(bytes(64 << 20), format=lzma.FORMAT_XZ)
+    assert len(bomb) < riv.SQUASHFS_METADATA_UNCOMPRESSED
+    bomb_pos = len(data)
+    data += struct.pack('<H', len(bomb)) + bomb
+    path = tmp_path / 'bomb.sqfs'
+    path.write_bytes(data)
+    return path, bomb_pos, bomb
+
+
+def test_squashfs_reader_should_cap_data_blocks(bomb_image):
+    path, bomb_pos, bomb = bomb_image
+    with riv.SquashFsImage(path) as sqfs:
+        with pytest.raises(ValueError, match='inflates'):
+            sqfs._read_block(bomb_pos + 2, len(bomb), sqfs.block_size)
+
+
+def test_squashfs_reader_should_reject_metadata_bombs(bomb_image, monkeypatch):
+    path, bomb_pos, _ = bomb_image
+    data = bytearray(path.read_bytes())
+    # point the root inode at the bomb
+    struct.pack_into('<Q', data, 32, 0)
+    struct.pack_into('<Q', data, 64, bomb_pos)
+    cartridges_path = path.parent / 'cartridges'
+    cartridges_path.mkdir()
+    (cartridges_path / 'bomb').write_bytes(data)
+
+    monkeypatch.setattr(riv.AppSettings, 'rivemu_path', '/bin/true')
+    monkeypatch.setattr(riv.AppSettings, 'cartridges_path', str(cartridges_path))
+    with pytest.raises(Exception, match='Corrupt cartridge image'):
+        riv.riv_get_cartridge_files('bomb', ['/info.json'])
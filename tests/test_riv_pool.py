@@ -0,0 +1,116 @@
+import json
+import sys
+import threading
+import time
+
+import pytest
+
+from app import riv_pool
+from app.settings import AppSettings
+
+
+WORKER_COMMAND = [sys.executable, '-m', 'app.riv_worker']
+# answers pings and never finishes any other job
+STUCK_WORKER_COMMAND = [sys.executable, '-c', """
+import sys
+for line in sys.stdin:
+    if b'ping' in line.encode():
+        print('{"result": "pong"}', flush=True)
+"""]
+# answers every job with the number of pings it got
+PING_COUNTING_WORKER_COMMAND = [sys.executable, '-c', """
+import json, sys
+pings = 0
+for line in sys.stdin:
+    if json.loads(line)['op'] == 'ping':
+        pings += 1
+        print(json.dumps({'result': 'pong'}), flush=True)
+    else:
+        print(json.dumps({'result': pings}), flush=True)
+"""]
+
+
+@pytest.fixture()
+def pool():
+    p = riv_pool.RivWorkerPool(size=2, max_jobs=3, command=WORKER_COMMAND)
+    yield p
+    p.close()
+
+
+def test_should_roundtrip_bytes_in_messages():
+    message = {'op': 'x', 'log': b'\x00\x01', 'result': [b'a', 'b', 1]}
+    decoded = riv_pool.decode_message(riv_pool.encode_message(message))
+    assert decoded == {'op': 'x', 'log': b'\x00\x01', 'result': [b'a', 'b', 1]}
+
+
+def test_should_reuse_worker(pool):
+    assert pool.run('ping') == 'pong'
+    pid = pool._idle[0].process.pid
+    assert pool.run('ping') == 'pong'
+    assert pool._idle[0].process.pid == pid
+
+
+def test_should_recycle_worker_after_max_jobs(pool):
+    pool.run('ping')
+    pid = pool._idle[0].process.pid
+    pool.run('ping')
+    pool.run('ping')
+    assert len(pool._idle) == 0
+    pool.run('ping')
+    assert pool._idle[0].process.pid != pid
+
+
+def test_should_replace_dead_worker(pool):
+    pool.run('ping')
+    worker = pool._idle[0]
+    worker.process.kill()
+    worker.process.wait()
+    assert pool.run('ping') == 'pong'
+    assert pool._idle[0] is not worker
+
+
+def test_should_raise_job_errors(pool):
+    with pytest.raises(Exception, match='Unknown operation'):
+        pool.run('bogus')
+    # the worker survives job errors
+    assert len(pool._idle) == 1
+
+
+def test_should_be_unavailable_when_worker_cant_start():
+    p = riv_pool.RivWorkerPool(size=1, max_jobs=0, command=['/nonexistent/worker'])
+    with pytest.raises(riv_pool.RivWorkerUnavailable):
+        p.run('ping')
+    assert p._workers == []
+
+
+def test_cancel_should_kill_the_running_job():
+    p = riv_pool.RivWorkerPool(size=1, max_jobs=0, command=STUCK_WORKER_COMMAND)
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    try:
+        start = time.monotonic()
+        with pytest.raises(Exception, match='cancelled'):
+            p.run('replay_log', cancel=cancel)
+        assert time.monotonic() - start < 1
+        # the killed worker isn't reused
+        assert p._workers == []
+    finally:
+        p.close()
+
+
+def test_should_ping_workers_only_on_startup():
+    p = riv_pool.RivWorkerPool(size=1, max_jobs=0, command=PING_COUNTING_WORKER_COMMAND)
+    try:
+        assert [p.run('replay_log') for _ in range(3)] == [1, 1, 1]
+    finally:
+        p.close()
+
+
+def test_worker_command_should_carry_the_settings(monkeypatch):
+    monkeypatch.setattr(AppSettings, 'riv_run_path', '/tmp/riv-runs')
+    monkeypatch.setattr(AppSettings, 'rivemu_path', '/opt/rivemu')
+    command = riv_pool.get_worker_command()
+    settings = json.loads(command[command.index('--settings') + 1])
+    assert settings['riv_run_path'] == '/tmp/riv-runs'
+    assert settings['rivemu_path'] == '/opt/rivemu'
+    assert settings['cartridges_path'] == AppSettings.cartridges_path
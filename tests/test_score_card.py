@@ -0,0 +1,69 @@
+import io
+import random
+
+from PIL import Image
+
+from app.common import ScoreCardRenderer, make_thumbnail
+
+
+def _screenshot(size=(256, 256), colors=16) -> bytes:
+    """
+    Make a screenshot of 8x8 tiles from a palette, like a riv game screen.
+    """
+    rng = random.Random(0)
+    palette = [tuple(rng.randrange(256) for _ in range(3)) for _ in range(colors)]
+    img = Image.new('RGB', size)
+    for y in range(0, size[1], 8):
+        for x in range(0, size[0], 8):
+            img.paste(palette[rng.randrange(colors)], (x, y, x + 8, y + 8))
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+
+def test_render_should_be_deterministic():
+    screenshot = _screenshot()
+    first = ScoreCardRenderer().render(screenshot, 'Snake', 10, 'user')
+    second = ScoreCardRenderer().render(screenshot, 'Snake', 10, 'user')
+    assert first == second
+
+
+def test_render_should_emit_palette_png_with_nearest_scaling():
+    screenshot = _screenshot()
+    card = Image.open(io.BytesIO(ScoreCardRenderer().render(screenshot, 'Snake', 10, 'user')))
+    assert card.format == 'PNG'
+    assert card.mode == 'P'
+    assert card.size == (512 + 400, 512)
+
+    # nearest scaling keeps the screenshot pixels as 2x2 blocks
+    original = Image.open(io.BytesIO(screenshot)).convert('RGB')
+    scaled = card.convert('RGB')
+    assert scaled.getpixel((2 * 37, 2 * 41)) == original.getpixel((37, 41))
+    assert scaled.crop((0, 0, 512, 512)).tobytes() == original.resize((512, 512), Image.Resampling.NEAREST).tobytes()
+
+
+def test_render_should_keep_colors_past_the_palette():
+    screenshot = _screenshot(colors=1024)
+    card = Image.open(io.BytesIO(ScoreCardRenderer().render(screenshot, 'Snake', 10, 'user')))
+    assert card.format == 'PNG'
+    assert card.mode == 'RGB'
+
+    original = Image.open(io.BytesIO(screenshot)).convert('RGB')
+    assert card.crop((0, 0, 512, 512)).tobytes() == original.resize((512, 512), Image.Resampling.NEAREST).tobytes()
+
+
+def test_render_should_emit_lossless_webp():
+    screenshot = _screenshot()
+    card = ScoreCardRenderer(image_format='webp').render(screenshot, 'Snake', 10, 'user')
+    assert Image.open(io.BytesIO(card)).format == 'WEBP'
+
+
+def test_thumbnail_should_fit_size_and_keep_pixels():
+    cover = _screenshot(size=(256, 128))
+    thumbnail = Image.open(io.BytesIO(make_thumbnail(cover, 64)))
+    assert thumbnail.format == 'PNG'
+    assert thumbnail.size == (64, 32)
+
+    # nearest scaling picks original pixels instead of blending them
+    original_colors = {c for _, c in Image.open(io.BytesIO(cover)).convert('RGB').getcolors()}
+    assert {c for _, c in thumbnail.convert('RGB').getcolors()} <= original_colors
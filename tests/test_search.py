@@ -0,0 +1,93 @@
+import random
+
+from app import search
+
+WEIGHTS = {'name': 4.0, 'description': 1.0}
+
+
+def _index():
+    index = search.SearchIndex(WEIGHTS)
+    index.add('snake', {'name': 'Snake', 'description': 'Traditional snake game'}, sort_key='snake')
+    index.add('tetrix', {'name': 'Tetrix', 'description': 'A puzzle game with falling shapes'}, sort_key='tetrix')
+    index.add('antcopter', {'name': 'Antcopter', 'description': 'A platform game about a gliding ant'}, sort_key='antcopter')
+    return index
+
+
+def _random_index(seed):
+    rng = random.Random(seed)
+    words = ['alpha', 'alps', 'beta', 'bet', 'gamma', 'game', 'delta']
+    index = search.SearchIndex(WEIGHTS)
+    for i in range(300):
+        index.add(
+            i,
+            {'name': ' '.join(rng.sample(words, 2)), 'description': ' '.join(rng.choices(words, k=5))},
+            sort_key=f"{rng.randrange(50):02d}"
+        )
+    return index
+
+
+def test_should_match_whole_words_prefixes_and_substrings():
+    index = _index()
+    assert index.search('snake')[1] == ['snake']
+    assert index.search('SNA')[1] == ['snake']
+    assert index.search('copter')[1] == ['antcopter']
+    assert index.search('ga')[1] == ['antcopter', 'snake', 'tetrix']
+    assert index.search('dragon')[1] == []
+    assert index.search('  !! ')[1] == []
+
+
+def test_should_require_every_term():
+    index = _index()
+    assert index.search('game puzzle')[1] == ['tetrix']
+    assert index.search('game dragon')[1] == []
+
+
+def test_should_rank_by_field_weight_and_match_kind():
+    index = _index()
+    # a name match beats a description match
+    index.add('ants', {'name': 'Ant Farm', 'description': 'Dig tunnels'}, sort_key='ant farm')
+    assert index.search('ant')[1] == ['ants', 'antcopter']
+    # a whole word beats a prefix
+    index.add('ant2', {'name': 'Antelope'}, sort_key='antelope')
+    assert index.search('ant')[1][0] == 'ants'
+
+
+def test_should_update_and_remove_documents():
+    index = _index()
+    index.add('snake', {'name': 'Worm', 'description': 'Traditional worm game'}, sort_key='worm')
+    assert index.search('snake')[1] == []
+    assert index.search('worm')[1] == ['snake']
+    assert len(index) == 3
+
+    index.remove('snake')
+    index.remove('missing')
+    assert 'snake' not in index
+    assert index.search('worm')[1] == []
+    assert index.search('wo')[1] == []
+    assert index.search('game')[1] == ['antcopter', 'tetrix']
+
+
+def test_pages_should_match_the_full_ranking():
+    index = _random_index(0)
+    for query in ('al', 'bet', 'game alp', 'ga de', 'delta'):
+        total, ranked = index.search(query)
+        assert total == len(ranked) > 0
+        pages = [index.search(query, offset, 7)[1] for offset in range(0, total, 7)]
+        assert sum(pages, []) == ranked
+        uncounted = [index.search(query, offset, 7, count=False) for offset in range(0, total, 7)]
+        assert sum((page for _, page in uncounted), []) == ranked
+        assert {total for total, _ in uncounted} == {None}
+
+        within = set(range(0, 300, 3))
+        within_total, within_ranked = index.search(query, within=within)
+        assert within_ranked == [i for i in ranked if i in within]
+        assert within_total == len(within_ranked)
+
+
+def test_looking_terms_up_in_documents_should_keep_the_ranking(monkeypatch):
+    index = _random_index(1)
+    queries = ('game alp', 'ga de', 'bet al delta')
+    expected = [index.search(query) for query in queries]
+    monkeypatch.setattr(search, 'PROBE_RATIO', 0)
+    index._term_cache.clear()
+    assert [index.search(query) for query in queries] == expected